@@ -8,6 +8,8 @@ import math
 import numpy as np
 from pyquaternion import Quaternion
 from datetime import datetime
+from isecc import symops
+from isecc import transform
 
 
 def getMinimalStarData( my_star, subparticle_header, subparticle_header_length, num_subparticles, subparticle_type=None ):
@@ -462,67 +464,97 @@ def generateSubparticleArray( ndarray_pent, header_pent, ndarray_hex, header_hex
     return subparticle_array, max_z
 
 
-def calculateNeighborDistance( reference, neighbor, relationship ):
-
-    """ Grab the parameters for the reference hexavalent """
-    ### Relevant parameters
-    reference_x_icos  = reference['SubparticleRelative_XYZ'][0]
-    reference_y_icos  = reference['SubparticleRelative_XYZ'][1]
-    reference_z_icos  = reference['SubparticleRelative_XYZ'][2]
-    ### Value >0 if localOrigin > icosOrigin. Verify the sign!
-    reference_delta_x = reference['SubparticleOrigin_local'][0] - reference['SubparticleOrigin_icos'][0]
-    reference_delta_y = reference['SubparticleOrigin_local'][1] - reference['SubparticleOrigin_icos'][1]
-    ### Add in the deltas
-    reference_x_local = reference['SubparticleRelative_XYZ'][0] + reference_delta_x
-    reference_y_local = reference['SubparticleRelative_XYZ'][1] + reference_delta_y
-    ### Flatten along z
-    reference_xy_icos  = np.array( [ reference_x_icos,  reference_y_icos,  0 ] )
-    reference_xy_local = np.array( [ reference_x_local, reference_y_local, 0 ] )
-    ### Maintain z
-    reference_xyz_icos = np.array( [ reference_x_icos, reference_y_icos, reference_z_icos ] )
-
-    ideal_distance_list=[]
-    real_distance_list=[]
-    delta_list=[]    
-
-    """ Grab parameters for neighbor """
-    ### Relevant parameters
-    neighbor_x_icos  = neighbor['SubparticleRelative_XYZ'][0]
-    neighbor_y_icos  = neighbor['SubparticleRelative_XYZ'][1]
-    neighbor_z_icos  = neighbor['SubparticleRelative_XYZ'][2]
-    ## Value >0 if localOrigin > icosOrigin. Verify the sign!
-    neighbor_delta_x = neighbor['SubparticleOrigin_local'][0] - neighbor['SubparticleOrigin_icos'][0]
-    neighbor_delta_y = neighbor['SubparticleOrigin_local'][1] - neighbor['SubparticleOrigin_icos'][1]
-    ### Add in the deltas
-    neighbor_x_local = neighbor['SubparticleRelative_XYZ'][0] + neighbor_delta_x
-    neighbor_y_local = neighbor['SubparticleRelative_XYZ'][1] + neighbor_delta_y
-    ### Flatten along z
-    neighbor_xy_icos  = np.array( [ neighbor_x_icos,  neighbor_y_icos, 0 ] )
-    neighbor_xy_local = np.array( [ neighbor_x_local, neighbor_y_local, 0 ] )
-    ### Maintain z
-    neighbor_xyz_icos = np.array( [ neighbor_x_icos, neighbor_y_icos, neighbor_z_icos ] )
-    
-    ### Run distance calculations
-    ideal_distance = np.around( assess3dDistance( reference_xyz_icos,  neighbor_xyz_icos ), decimals=1 )
-    ideal_distance_flattened = np.around( assess3dDistance( reference_xy_icos,  neighbor_xy_icos ), decimals=1 )
-    real_distance_flattened  = np.around( assess3dDistance( reference_xy_local, neighbor_xy_local ), decimals=1 )
-    delta_flattened = np.around( assess3dDistance( reference_xy_icos,  neighbor_xy_icos ) - assess3dDistance( reference_xy_local, neighbor_xy_local ), decimals=1 )
-
-    print( relationship )
-    print("This capsomer evaluated:", ideal_distance_flattened, real_distance_flattened, delta_flattened, "\n" )
-    
-    
-    #ideal_distance_list.append(ideal_distance_flattened)
-    #real_distance_list.append(real_distance_flattened)
-    #delta_list.append(delta_flattened)
+### Capsomers a-e around a fivefold, in order. Each neighbors the next, and e neighbors a.
+FIVEFOLD_SPECIFIC = np.array( [ b'a', b'b', b'c', b'd', b'e' ], dtype='|S1' )
 
-    return
+### Kinds of edge in the capsomer neighbor graph
+NEIGHBOR_RELATIONSHIPS = [ 'Twofold-hex', 'Threefold-hex', 'Fivefold-hex', 'Fivefold-pent', 'Diametric-pent', 'Diametric-hex' ]
 
-def correlateRefinedCapsomers( subparticle_array, max_z, inclusion_threshold, diameter_threshold ) :
 
-    particle_names = np.array( subparticle_array['ParticleSpecifier'] )
+def vertexAntipodes( roi ):
+    """ Number of the opposite vertex, for each vertex number in the vertex group strings (e.g. 5f01) """
+    """ Vertices are numbered as at expansion: images of the axis under the inverse symops, by first appearance. """
+    """ That numbering does not depend on particle pose. Index 0 is unused. """
+    axis = symops.I1_AXES[roi]
+    images = np.around( transform.quatRotate( transform.quatInverse( symops.getSymOps() ), axis ), decimals=3 )
+    unique_indices, membership = symops.uniqueOrbit( images, 0.1 * np.amax( np.absolute( axis ) ) )
+    vertices = images[unique_indices]
+
+    opposite = np.argmin( np.linalg.norm( vertices[:,np.newaxis,:] + vertices[np.newaxis,:,:], axis=2 ), axis=1 )
+    return np.concatenate( [ [0], opposite + 1 ] )
+
+
+def capsomerSlots( subparticle_array ):
+    """ Which capsomer of the capsid each subparticle is, from its type and vertex group """
+    """ Returns one row per distinct capsomer, and the slot of every subparticle """
+    slot_fields = [ 'Subparticle_type', 'Vertex5f_general', 'Vertex5f_specific', 'Vertex3f_general', 'Vertex3f_specific', 'Vertex2f_general', 'Vertex2f_specific' ]
+    keys = np.zeros( len(subparticle_array), dtype=np.dtype( [ ( field, subparticle_array.dtype[field] ) for field in slot_fields ] ) )
+    for field in slot_fields:
+        keys[field] = subparticle_array[field]
+
+    slots, slot_of_row = np.unique( keys, return_inverse=True )
+    return slots, slot_of_row.ravel()
+
+
+def buildNeighborGraph( slots ):
+    """ Directed edges ( relationship, reference slot, neighbor slot ) between capsomers, as for each reference: """
+    """   Twofold-hex    the other hexavalent on its twofold """
+    """   Threefold-hex  the other two hexavalents on its threefold """
+    """   Fivefold-hex   the hexavalents either side of it around its fivefold """
+    """   Fivefold-pent  the pentavalent on its fivefold """
+    """   Diametric-pent, Diametric-hex  the capsomer of its kind on the opposite side of the capsid """
+    """ The icosahedral orbit of a capsomer has no inversion, so a hexavalent has a diametric partner only """
+    """ when it sits on a mirror plane. Pentavalents always do. """
+    """ Built once from the vertex groups and the symmetry tables, then applied to every particle """
+
+    is_pent = slots['Subparticle_type'] == b'pentavalent'
+    is_hex  = slots['Subparticle_type'] == b'hexavalent'
+    fivefold_position = np.argmax( slots['Vertex5f_specific'][:,np.newaxis] == FIVEFOLD_SPECIFIC[np.newaxis,:], axis=1 )
+
+    antipode_5f = vertexAntipodes( 'fivefold' )
+    antipode_3f = vertexAntipodes( 'threefold' )
+    antipode_2f = vertexAntipodes( 'twofold' )
+
+    ### Every ordered pair of slots, then a condition per relationship
+    reference, neighbor = [ index.ravel() for index in np.meshgrid( np.arange( len(slots) ), np.arange( len(slots) ), indexing='ij' ) ]
+    ref = slots[reference]
+    nbr = slots[neighbor]
+    both_hex = is_hex[reference] & is_hex[neighbor]
+    same = dict( [ ( field, ref[field] == nbr[field] ) for field in [ 'Vertex5f_general', 'Vertex3f_general', 'Vertex3f_specific', 'Vertex2f_general', 'Vertex2f_specific' ] ] )
+
+    conditions = {}
+    conditions['Twofold-hex']   = both_hex & same['Vertex2f_general'] & ~same['Vertex2f_specific']
+    conditions['Threefold-hex'] = both_hex & same['Vertex3f_general'] & ~same['Vertex3f_specific']
+    conditions['Fivefold-hex']  = both_hex & same['Vertex5f_general'] & np.isin( np.mod( fivefold_position[reference] - fivefold_position[neighbor], 5 ), [ 1, 4 ] )
+    conditions['Fivefold-pent'] = is_hex[reference] & is_pent[neighbor] & same['Vertex5f_general']
+    conditions['Diametric-pent'] = is_pent[reference] & is_pent[neighbor] & ( antipode_5f[ ref['Vertex5f_general'] ] == nbr['Vertex5f_general'] )
+    conditions['Diametric-hex']  = both_hex & ( antipode_5f[ ref['Vertex5f_general'] ] == nbr['Vertex5f_general'] ) \
+                                            & ( antipode_3f[ ref['Vertex3f_general'] ] == nbr['Vertex3f_general'] ) \
+                                            & ( antipode_2f[ ref['Vertex2f_general'] ] == nbr['Vertex2f_general'] )
+
+    edges = [ ( np.full( np.sum( conditions[name] ), code ), reference[ conditions[name] ], neighbor[ conditions[name] ] )
+              for code, name in enumerate( NEIGHBOR_RELATIONSHIPS ) ]
+    return [ np.concatenate( column ) for column in zip( *edges ) ]
 
-    unique_particles = np.unique( particle_names )
+
+def neighborDistances( subparticle_array, rows, neighbor_rows ):
+    """ Ideal, flattened ideal, flattened locally refined and delta distances for pairs of subparticle rows """
+    """ Same quantities calculateNeighborDistance printed, one pair at a time """
+    xyz_icos = subparticle_array['SubparticleRelative_XYZ'].astype(np.float64)
+    delta = subparticle_array['SubparticleOrigin_local'] - subparticle_array['SubparticleOrigin_icos']
+    xy_local = xyz_icos[:,0:2] + delta
+
+    ideal_distance = np.linalg.norm( xyz_icos[rows] - xyz_icos[neighbor_rows], axis=1 )
+    ideal_distance_flattened = np.linalg.norm( xyz_icos[rows,0:2] - xyz_icos[neighbor_rows,0:2], axis=1 )
+    real_distance_flattened  = np.linalg.norm( xy_local[rows] - xy_local[neighbor_rows], axis=1 )
+
+    return ideal_distance, ideal_distance_flattened, real_distance_flattened, ideal_distance_flattened - real_distance_flattened
+
+
+def correlateRefinedCapsomers( subparticle_array, max_z, inclusion_threshold, diameter_threshold ) :
+    """ Distances across every edge of the capsomer neighbor graph, for every particle, as one array """
+    """ Neighbor edges count where the reference is near the top or bottom of the particle, and diametric """
+    """ edges where it is near the central plane, as before. Z is flattened for the local measures. """
 
     z_threshold = np.around( (inclusion_threshold * max_z), decimals = 2 )
     central_slice_threshold = np.around( ( diameter_threshold * max_z), decimals = 2 )
@@ -540,166 +572,48 @@ def correlateRefinedCapsomers( subparticle_array, max_z, inclusion_threshold, di
     print( '   This represents a threshold of:', diameter_threshold )
     print( '   Note: Z-dimension is flattened for this analysis.\n' )
 
+    ### Adjacency is the same for every particle
+    slots, slot_of_row = capsomerSlots( subparticle_array )
+    relationship, reference_slot, neighbor_slot = buildNeighborGraph( slots )
+    print( '  Neighbor graph has', len(relationship), 'edges between', len(slots), 'capsomers.' )
 
-#    sys.exit()
+    ### Row of each capsomer in each particle, or -1 where a particle lacks it
+    unique_particles, particle_of_row = np.unique( subparticle_array['ParticleSpecifier'], return_inverse=True )
+    capsomer_rows = np.full( ( len(unique_particles), len(slots) ), -1, dtype=np.int64 )
+    capsomer_rows[ particle_of_row.ravel(), slot_of_row ] = np.arange( len(subparticle_array) )
 
-    ### iterate through all the unique particles
-    for index, item in enumerate(unique_particles, start=0):
+    ### Every edge of every particle, as index arrays
+    rows = capsomer_rows[ :, reference_slot ]
+    neighbor_rows = capsomer_rows[ :, neighbor_slot ]
+    reference_z = subparticle_array['SubparticleRelative_XYZ'][ np.maximum( rows, 0 ), 2 ]
 
-        ### Particle specifier for printout
-        particle_specifier = str(index).rjust(5, '0')
+    is_diametric = np.isin( relationship, [ NEIGHBOR_RELATIONSHIPS.index('Diametric-pent'), NEIGHBOR_RELATIONSHIPS.index('Diametric-hex') ] )
+    near_pole = ( reference_z > z_threshold ) | ( reference_z < (-1*z_threshold) )
+    near_center = ( reference_z > (-1*central_slice_threshold) ) & ( reference_z < central_slice_threshold )
+    keep = ( rows >= 0 ) & ( neighbor_rows >= 0 ) & np.where( is_diametric[np.newaxis,:], near_center, near_pole )
 
-        # make temporary array with all subparticles from current particle
-        condition = subparticle_array['ParticleSpecifier'] == item
+    particle, edge = np.nonzero( keep )
+    rows = rows[ particle, edge ]
+    neighbor_rows = neighbor_rows[ particle, edge ]
 
-        #subparticles = np.extract( condition, subparticle_array )    # Don't need to use np.extract
-        subparticles = subparticle_array[condition]
+    neighbor_dtype = np.dtype( [ ( 'ParticleSpecifier', subparticle_array.dtype['ParticleSpecifier'] ),
+                                 ( 'Relationship', '|S14' ),
+                                 ( 'Reference', 'i8' ), ( 'Neighbor', 'i8' ),
+                                 ( 'IdealDistance', '<f4' ), ( 'IdealDistanceFlattened', '<f4' ),
+                                 ( 'RealDistanceFlattened', '<f4' ), ( 'DeltaFlattened', '<f4' ) ] )
+    neighbors = np.zeros( len(rows), dtype=neighbor_dtype )
+    neighbors['ParticleSpecifier'] = unique_particles[particle]
+    neighbors['Relationship'] = np.array( NEIGHBOR_RELATIONSHIPS, dtype='|S14' )[ relationship[edge] ]
+    neighbors['Reference'] = rows
+    neighbors['Neighbor'] = neighbor_rows
+    neighbors['IdealDistance'], neighbors['IdealDistanceFlattened'], neighbors['RealDistanceFlattened'], neighbors['DeltaFlattened'] = neighborDistances( subparticle_array, rows, neighbor_rows )
 
-        #### Check distances along central plane (Z~=0)
-        assessed_diameter = []
-        max_diameter = 0
+    for code, name in enumerate( NEIGHBOR_RELATIONSHIPS ):
+        this_relationship = neighbors['Relationship'] == name.encode()
+        if np.any( this_relationship ):
+            print( '  ', name.ljust(14), np.sum( this_relationship ), 'edges, mean flattened delta', np.around( np.mean( neighbors['DeltaFlattened'][this_relationship] ), decimals=2 ) )
 
-
-#        print( 'DEBUG', len(subparticles) )
-
-        for assessed_index, subparticle in enumerate(subparticles, start=0):
-
-            ### Icos coords
-            reference_x_icos  = subparticle['SubparticleRelative_XYZ'][0]
-            reference_y_icos  = subparticle['SubparticleRelative_XYZ'][1]
-            reference_z_icos  = subparticle['SubparticleRelative_XYZ'][2]
-            reference_xy_icos = np.array( [ reference_x_icos, reference_y_icos, 0 ] )
-            reference_xyz_icos = np.array( [ reference_x_icos, reference_y_icos, reference_z_icos ] )
-
-            ### Local coords
-            reference_delta_x = subparticle['SubparticleOrigin_local'][0] - subparticle['SubparticleOrigin_icos'][0]
-            reference_delta_y = subparticle['SubparticleOrigin_local'][1] - subparticle['SubparticleOrigin_icos'][1]
-            reference_x_local = subparticle['SubparticleRelative_XYZ'][0] + reference_delta_x
-            reference_y_local = subparticle['SubparticleRelative_XYZ'][1] + reference_delta_y
-            reference_xy_local = np.array( [ reference_x_local, reference_y_local, 0 ] )
-
-            """ This code is for diameter assessment """
-            if (reference_z_icos > (-1*central_slice_threshold)) and (reference_z_icos < central_slice_threshold) and (assessed_index not in assessed_diameter):
-
-                for compare_index, compare in enumerate(subparticles, start=0):
-
-                    ### Icos coords
-                    compare_x_icos  = compare['SubparticleRelative_XYZ'][0]
-                    compare_y_icos  = compare['SubparticleRelative_XYZ'][1]
-                    compare_z_icos  = compare['SubparticleRelative_XYZ'][2]
-                    compare_xy_icos = np.array( [ compare_x_icos, compare_y_icos, 0 ] )
-                    compare_xyz_icos = np.array( [ compare_x_icos, compare_y_icos, compare_z_icos ] )
-                    negate_compare_xyz_icos = -1 * compare_xyz_icos
-
-                    ### Local coords
-                    compare_delta_x = compare['SubparticleOrigin_local'][0] - compare['SubparticleOrigin_icos'][0]
-                    compare_delta_y = compare['SubparticleOrigin_local'][1] - compare['SubparticleOrigin_icos'][1]
-                    compare_x_local = compare['SubparticleRelative_XYZ'][0] + compare_delta_x
-                    compare_y_local = compare['SubparticleRelative_XYZ'][1] + compare_delta_y
-                    compare_xy_local = np.array( [ compare_x_local, compare_y_local, 0 ] )
-
-
-                    this_diameter = assess3dDistance( reference_xyz_icos, compare_xyz_icos )
-                    if this_diameter > max_diameter:
-                        max_diameter = this_diameter
-                        ideal_polar_distance = np.around( assess3dDistance( reference_xyz_icos, compare_xyz_icos ), decimals=2 )
-                        flattened_ideal_polar_distance = np.around( assess3dDistance( reference_xy_icos, compare_xy_icos ), decimals=2 )
-                        flattened_real_polar_distance  = np.around( assess3dDistance( reference_xy_local, compare_xy_local ), decimals=2 )
-
-                    if np.allclose(reference_xyz_icos, negate_compare_xyz_icos, atol=1):
-
-                        assessed_diameter.append(compare_index)
-
-                        """ Run calculations """
-                        ideal_polar_distance = np.around( assess3dDistance( reference_xyz_icos, compare_xyz_icos ), decimals=2 )
-                        flattened_ideal_polar_distance = np.around( assess3dDistance( reference_xy_icos, compare_xyz_icos ), decimals=2 )
-                        flattened_real_polar_distance = np.around( assess3dDistance( reference_xy_local, compare_xy_local ), decimals=2 )
-
-                        print( 'Difference ratio: ', np.around( np.true_divide(flattened_real_polar_distance,flattened_ideal_polar_distance), decimals=4) )
-
-#        sys.exit()
-
-        """ Here we'll get into the relative motions of neighboring capsomers """
-        unique_5f_vertices = np.unique( np.array( subparticles['Vertex5f_general'] ) )
-        unique_3f_vertices = np.unique( np.array( subparticles['Vertex3f_general'] ) )
-        unique_2f_vertices = np.unique( np.array( subparticles['Vertex2f_general'] ) )
-
-
-        pentavalent_condition = subparticles[ 'Subparticle_type' ] == b'pentavalent'     # b is from bytestring
-        hexavalent_condition  = subparticles[ 'Subparticle_type' ] == b'hexavalent'    # b is from bytestring
-
-        pentavalents = subparticles[ pentavalent_condition ]
-        hexavalents  = subparticles[ hexavalent_condition ]
-
-
-        """ New strategy is to attack this from the hexavalent side """
-        for index, hexavalent in enumerate(hexavalents):
-
-            """ If within a tolerance from zmax or zmin """
-            if (hexavalent['SubparticleRelative_XYZ'][2] > z_threshold) or (hexavalent['SubparticleRelative_XYZ'][2] < (-1*z_threshold)):
-
-                
-                """ Prepare conditions for twofold scenario first """
-                condition_2f_1 = hexavalents['Vertex2f_general']  == hexavalent['Vertex2f_general']     # Get this twofold
-                condition_2f_2 = hexavalents['Vertex2f_specific'] != hexavalent['Vertex2f_specific']    # Avoid chosing self
-                neighbor_twofold = hexavalents[ (condition_2f_1) & (condition_2f_2) ]                  # Store in array
-                
-                
-                """ Prepare conditions for threefold scenario next """
-                condition_3f_1 = hexavalents['Vertex3f_general']  == hexavalent['Vertex3f_general']     # Get this threefold
-                condition_3f_2 = hexavalents['Vertex3f_specific'] != hexavalent['Vertex3f_specific']    # Avoid chosing self
-                neighbors_threefold = hexavalents[ (condition_3f_1) & (condition_3f_2) ]                # Store in array
-                
-                
-                """ Prepare conditions for fivefold scenario next. Hexavalents only for now.
-                    Condition 1 returns all five hexavalents about the shared pentavalent.
-                    Conditions 2 and 3 will provide the two neighbors. """
-                condition_5f_1 = hexavalents['Vertex5f_general']  == hexavalent['Vertex5f_general']     # Get this fivefold
-
-                """ Sloppy definitions to get a-e neighbors """
-                if hexavalent['Vertex5f_specific'] == b'a':                     # if a, grab only b and e
-                    condition_5f_2 = hexavalents['Vertex5f_specific'] == b'b'   
-                    condition_5f_3 = hexavalents['Vertex5f_specific'] == b'e'
-                elif hexavalent['Vertex5f_specific'] == b'b':                   # if b, grab only a and c
-                    condition_5f_2 = hexavalents['Vertex5f_specific'] == b'a'
-                    condition_5f_3 = hexavalents['Vertex5f_specific'] == b'c'
-                elif hexavalent['Vertex5f_specific'] == b'c':                   # if c, grab only b and d
-                    condition_5f_2 = hexavalents['Vertex5f_specific'] == b'b'
-                    condition_5f_3 = hexavalents['Vertex5f_specific'] == b'd'
-                elif hexavalent['Vertex5f_specific'] == b'd':                   # if d, grab only c and e
-                    condition_5f_2 = hexavalents['Vertex5f_specific'] == b'c'
-                    condition_5f_3 = hexavalents['Vertex5f_specific'] == b'e'
-                elif hexavalent['Vertex5f_specific'] == b'e':                   # if b, grab only d and a
-                    condition_5f_2 = hexavalents['Vertex5f_specific'] == b'd'
-                    condition_5f_3 = hexavalents['Vertex5f_specific'] == b'a'
-                else:
-                    print("You have a logic error there bud.")
-                    sys.exit()
-                neighbors_fivefold = hexavalents[ (condition_5f_1) & ( condition_5f_2 or condition_5f_3 ) ]  # Store in array
-
-
-                """ Finally, grab the pentavalent neighbor """
-                condition_pentavalent = hexavalent['Vertex5f_general'] == pentavalents['Vertex5f_general']
-                neighbor_pentavalent = pentavalents[ condition_pentavalent ]
-        
-
-                """ Now we're ready to do the math """
-                """ Run the calculations for each neighbor """
-                # Twofold hexavalent
-                calculateNeighborDistance( hexavalent, neighbor_twofold, 'Twofold-hex' )
-                # Threefold hexavalents
-                for neighbor in neighbors_threefold:
-                    calculateNeighborDistance( hexavalent, neighbor, 'Threefold-hex' )
-                # Fivefold hexavalents
-                for neighbor in neighbors_fivefold:
-                    calculateNeighborDistance( hexavalent, neighbor, 'Fivefold-hex' )
-                # Fivefold pentavalent
-                calculateNeighborDistance( hexavalent, neighbor_pentavalent, 'Fivefold-pent' )
-
-            if index > 99:
-                sys.exit()
-    
-    return
+    return neighbors
 
 
 
@@ -754,7 +668,11 @@ def main(args):
 #    print( '\n', subparticle_array )
 
 
-    correlateRefinedCapsomers( subparticle_array, max_z, args.zmax_threshold, args.centsec_threshold )
+    neighbors = correlateRefinedCapsomers( subparticle_array, max_z, args.zmax_threshold, args.centsec_threshold )
+
+    ### One row per edge per particle. Reference and Neighbor are rows of the subparticle array.
+    np.save( args.output, neighbors )
+    print( "\nWrote", len(neighbors), "capsomer neighbor distances to", args.output )
 
     #generateSubparticleArray
 
@@ -771,6 +689,7 @@ if __name__ == "__main__":
     parser.add_argument("--hexavalent", required=True, help="Locally refined hexavalent capsomers")
     parser.add_argument("--zmax_threshold", type=float, default='0.90', help="Threshold for inclusion in motions analysis")
     parser.add_argument("--centsec_threshold", type=float, default='0.05', help="Threshold for inclusion in diameter analysis")
+    parser.add_argument("--output", type=str, default='capsomer_neighbors.npy', help="npy file for the per-edge neighbor distances")
 
     sys.exit(main(parser.parse_args()))
 
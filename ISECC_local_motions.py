@@ -25,6 +25,9 @@ from datetime import datetime
 from isecc import utils
 from isecc import starparse
 
+### Particles whose capsomer distance tensors are held in memory at once
+CORRELATE_CHUNK = 1024
+
 def getStarHeader( my_star, regen_string ):
     header = []
     header_index = int( 0 )
@@ -166,26 +169,22 @@ def generateSubparticleArray( ndarray_pent, header_pent, ndarray_hex, header_hex
                         ( 'SubparticleRelative_XYZ', '<f4', (3,) )  ] )
 
     subparticle_array = np.zeros( total_subparticle_number, dtype=subparticle_array_dtype )
+    pent = subparticle_array[ :len( ndarray_pent ) ]
+    hexa = subparticle_array[ len( ndarray_pent ): ]
+
+    ### Rotation letters back from the decoded vertex groups. -1, i.e. z, picks the last.
+    letters = np.array( list( starparse.VERTEX_ROTATION_LETTERS ) + [ 'z' ], dtype='|S1' )
 
-    ### Read everything into a subparticle array
+    ### Read everything into a subparticle array, a column at a time
     print( '\nAdding all pentavalent capsomers into subparticle array.' )
-    
+
     ### Start with the pentavalent
-    for index in range(0, len( ndarray_pent ) ):
-
-        # Particle Specifier
-        subparticle_array[ index ][ 'ParticleSpecifier' ] = ndarray_pent[ index ][ particleID_index_pent ]
-        # Subparticle Type
-        subparticle_array[ index ][ 'Subparticle_type' ] = 'pentavalent'
-        # X,Y Priors
-        subparticle_array[ index ][ 'SubparticleOrigin_icos' ] = ndarray_pent[ index ][ icos_X_index_pent ], ndarray_pent[ index ][ icos_Y_index_pent ]
-        # X,Y Locally Refined
-        subparticle_array[ index ][ 'SubparticleOrigin_local' ] = ndarray_pent[ index ][ local_X_index_pent ], ndarray_pent[ index ][ local_Y_index_pent ]
-        # Relative X,Y,Z with respect to particle center
-        subparticle_array[ index ][ 'SubparticleRelative_XYZ' ] = ndarray_pent[ index ][ relativeXYZ_index_pent ].split(',')
-        # Vertex Assignment
-        vertex_assignment = int( str( ndarray_pent[ index ][ vertexGroup_index_pent ] )[2:4] )  #example: '5f01'
-        subparticle_array[ index ][ 'Vertex5f_general' ] = vertex_assignment
+    pent['ParticleSpecifier'] = ndarray_pent[ :, particleID_index_pent ]
+    pent['Subparticle_type'] = 'pentavalent'
+    pent['SubparticleOrigin_icos'] = np.stack( [ ndarray_pent[ :, icos_X_index_pent ], ndarray_pent[ :, icos_Y_index_pent ] ], axis=1 ).astype( np.float64 )
+    pent['SubparticleOrigin_local'] = np.stack( [ ndarray_pent[ :, local_X_index_pent ], ndarray_pent[ :, local_Y_index_pent ] ], axis=1 ).astype( np.float64 )
+    pent['SubparticleRelative_XYZ'] = starparse.decodeXYZ( ndarray_pent[ :, relativeXYZ_index_pent ] )
+    pent['Vertex5f_general'] = starparse.decodeVertexGroups( ndarray_pent[ :, vertexGroup_index_pent ] )['Vertex5f_general']    #example: '5f01'
 
 
     ### Here we want to also find the max and min z values.
@@ -198,40 +197,80 @@ def generateSubparticleArray( ndarray_pent, header_pent, ndarray_hex, header_hex
     ### Add in the hexavalents
     print( 'Adding all hexavalent capsomers into subparticle array.' )
 
-    for index in range( 0, len( ndarray_hex ) ):
-
-        # Sort out the two indexes
-        hex_index = index
-        subpart_index = int( len( ndarray_pent ) + hex_index )
-
-        # Particle Specifier
-        subparticle_array[ subpart_index ][ 'ParticleSpecifier' ] = ndarray_hex[ hex_index ][ particleID_index_hex ]
-        # Subparticle Type
-        subparticle_array[ subpart_index ][ 'Subparticle_type' ] = 'hexavalent'
-        # X,Y Priors
-        subparticle_array[ subpart_index ][ 'SubparticleOrigin_icos' ] = ndarray_hex[ hex_index ][ icos_X_index_hex ], ndarray_hex[ hex_index ][ icos_Y_index_hex ]
-        # X,Y Locally Refined
-        subparticle_array[ subpart_index ][ 'SubparticleOrigin_local' ] = ndarray_hex[ hex_index ][ local_X_index_hex ], ndarray_hex[ hex_index ][ local_Y_index_hex ]
-        # Relative X,Y,Z with respect to particle center
-        subparticle_array[ subpart_index ][ 'SubparticleRelative_XYZ' ] = ndarray_hex[ hex_index ][ relativeXYZ_index_hex ].split(',')
-
-        # Vertex Assignment
-        vertex_assignment = str( ndarray_hex[ hex_index ][ vertexGroup_index_hex ] )    # example: '5f01a.3f01a.2f01a'
-        subparticle_array[ subpart_index ][ 'Vertex5f_general'  ] = vertex_assignment[2:4]    # character 3-4
-        subparticle_array[ subpart_index ][ 'Vertex5f_specific' ] = vertex_assignment[4]    # character 5
-        subparticle_array[ subpart_index ][ 'Vertex3f_general'  ] = vertex_assignment[8:10]    # character 9-10
-        subparticle_array[ subpart_index ][ 'Vertex3f_specific' ] = vertex_assignment[10]    # character 11
-        subparticle_array[ subpart_index ][ 'Vertex2f_general'  ] = vertex_assignment[14:16]    # character 15-16
-        subparticle_array[ subpart_index ][ 'Vertex2f_specific' ] = vertex_assignment[16]    # character 17
+    hexa['ParticleSpecifier'] = ndarray_hex[ :, particleID_index_hex ]
+    hexa['Subparticle_type'] = 'hexavalent'
+    hexa['SubparticleOrigin_icos'] = np.stack( [ ndarray_hex[ :, icos_X_index_hex ], ndarray_hex[ :, icos_Y_index_hex ] ], axis=1 ).astype( np.float64 )
+    hexa['SubparticleOrigin_local'] = np.stack( [ ndarray_hex[ :, local_X_index_hex ], ndarray_hex[ :, local_Y_index_hex ] ], axis=1 ).astype( np.float64 )
+    hexa['SubparticleRelative_XYZ'] = starparse.decodeXYZ( ndarray_hex[ :, relativeXYZ_index_hex ] )
+
+    # Vertex Assignment, example: '5f01a.3f01a.2f01a'
+    vertex_groups = starparse.decodeVertexGroups( ndarray_hex[ :, vertexGroup_index_hex ] )
+    for vertex in starparse.VERTEX_GROUP_ORDERS:
+        general = ''.join( [ 'Vertex', vertex, '_general' ] )
+        specific = ''.join( [ 'Vertex', vertex, '_specific' ] )
+        hexa[general] = vertex_groups[general]
+        hexa[specific] = letters[ vertex_groups[specific] ]
 
     return subparticle_array, max_z
 
 
-def correlateRefinedCapsomers( subparticle_array, max_z, inclusion_threshold ) :
+def groupByParticle( particle_names ):
+    """ Subparticle rows of each particle, particles in np.unique order and rows in file order """
+    """ Returns (n_particles, k) row indices and a mask of which are real, for particles of up to k subparticles """
+    order = np.argsort( particle_names, kind='stable' )
+    unique_particles, counts = np.unique( particle_names, return_counts=True )
 
-    particle_names = np.array( subparticle_array['ParticleSpecifier'] )
+    particle = np.repeat( np.arange( len(unique_particles) ), counts )
+    position = np.arange( len(order) ) - np.repeat( np.cumsum(counts) - counts, counts )
+
+    rows = np.zeros( ( len(unique_particles), np.amax(counts) ), dtype=np.int64 )
+    present = np.zeros( rows.shape, dtype=bool )
+    rows[ particle, position ] = order
+    present[ particle, position ] = True
+
+    return rows, present
+
+
+def pairDistance( point1, point2 ):
+    """ utils.assess3dDistance over stacks of points (..., 3). matmul takes the same dot product as np.linalg.norm. """
+    difference = point1 - point2
+    return np.sqrt( np.matmul( difference[...,np.newaxis,:], difference[...,:,np.newaxis] )[...,0,0] )
+
+
+def polarDiameters( subparticle_array, rows, present, central_slice_threshold ):
+    """ For each particle (n, k, k) capsomer distances at once, then the pair printed for each reference capsomer """
+    """ Reference capsomers are those near the central plane. As in the original loop, the widest pair so far """
+    """ in the particle is kept, and a tie keeps the earlier pair. Returns ( particle, reference, compare ) indices """
+    """ into rows for each printed line, with compare of -1 where no pair had been found yet. """
+
+    xyz_icos = subparticle_array['SubparticleRelative_XYZ'][rows]
+    diameter = pairDistance( xyz_icos[:,:,np.newaxis,:], xyz_icos[:,np.newaxis,:,:] )
+    diameter[ ~( present[:,:,np.newaxis] & present[:,np.newaxis,:] ) ] = -np.inf
+
+    z_icos = xyz_icos[:,:,2]
+    is_reference = present & ( z_icos > (-1*central_slice_threshold) ) & ( z_icos < central_slice_threshold )
+
+    ### Widest pair of each reference, then the running widest over the references of a particle
+    widest = np.where( is_reference, np.amax( diameter, axis=2 ), 0 )
+    widest_compare = np.argmax( diameter, axis=2 )
+    widest_before = np.concatenate( [ np.zeros( ( len(rows), 1 ), dtype=widest.dtype ), np.maximum.accumulate( widest, axis=1 )[:,:-1] ], axis=1 )
+    is_wider = widest > widest_before
+
+    reference_index = np.arange( rows.shape[1] )[np.newaxis,:]
+    kept_reference = np.maximum.accumulate( np.where( is_wider, reference_index, -1 ), axis=1 )
 
-    unique_particles = np.unique( particle_names )
+    particle, reference = np.nonzero( is_reference )
+    kept = kept_reference[ particle, reference ]
+    compare = np.where( kept >= 0, widest_compare[ particle, np.maximum( kept, 0 ) ], -1 )
+
+    return particle, np.maximum( kept, 0 ), compare
+
+
+def correlateRefinedCapsomers( subparticle_array, max_z, inclusion_threshold, chunk_size=CORRELATE_CHUNK ) :
+    """ Polar diameters of each particle, ideal and locally refined, printed one line per reference capsomer """
+    """ Particles are grouped by a sort and chunk_size of them are assessed at a time """
+
+    particle_names = np.array( subparticle_array['ParticleSpecifier'] )
 
     z_threshold = np.around( (inclusion_threshold * max_z), decimals = 2 )
     central_slice_limit = np.around( 1.05, decimals = 3 )
@@ -251,68 +290,34 @@ def correlateRefinedCapsomers( subparticle_array, max_z, inclusion_threshold ) :
     print( '   Note: Z-dimension is flattened for this analysis.\n' )
 
 
-    ### iterate through all the unique particles
-    for index, item in enumerate(unique_particles, start=0):
-
-        ### Particle specifier for printout
-        particle_specifier = str(index).rjust(5, '0')
-
-        # make temporary array with all subparticles from current particle
-        condition = subparticle_array['ParticleSpecifier'] == item
-
-        #subparticles = np.extract( condition, subparticle_array )    # Don't need to use np.extract
-        subparticles = subparticle_array[condition]
-
-        #### Check distances along central plane (Z~=0)
-        assessed_diameter = []
-        max_diameter = 0
-
-        for assessed_index, subparticle in enumerate(subparticles, start=0):
-
-            ### Icos coords
-            reference_x_icos  = subparticle['SubparticleRelative_XYZ'][0]
-            reference_y_icos  = subparticle['SubparticleRelative_XYZ'][1]
-            reference_z_icos  = subparticle['SubparticleRelative_XYZ'][2]
-            reference_xy_icos = np.array( [ reference_x_icos, reference_y_icos, 0 ] )
-            reference_xyz_icos = np.array( [ reference_x_icos, reference_y_icos, reference_z_icos ] )
-
-            ### Local coords
-            reference_delta_x = subparticle['SubparticleOrigin_local'][0] - subparticle['SubparticleOrigin_icos'][0]
-            reference_delta_y = subparticle['SubparticleOrigin_local'][1] - subparticle['SubparticleOrigin_icos'][1]
-            reference_x_local = subparticle['SubparticleRelative_XYZ'][0] + reference_delta_x
-            reference_y_local = subparticle['SubparticleRelative_XYZ'][1] + reference_delta_y
-            reference_xy_local = np.array( [ reference_x_local, reference_y_local, 0 ] )
-
-            """ This code looks for capsomers within a tolerance of the central plane """
-            if (reference_z_icos > (-1*central_slice_threshold)) and (reference_z_icos < central_slice_threshold) and (assessed_index not in assessed_diameter):
-
-                for compare_index, compare in enumerate(subparticles, start=0):
-
-                    ### Icos coords
-                    compare_x_icos  = compare['SubparticleRelative_XYZ'][0]
-                    compare_y_icos  = compare['SubparticleRelative_XYZ'][1]
-                    compare_z_icos  = compare['SubparticleRelative_XYZ'][2]
-                    compare_xy_icos = np.array( [ compare_x_icos, compare_y_icos, 0 ] )
-                    compare_xyz_icos = np.array( [ compare_x_icos, compare_y_icos, compare_z_icos ] )
-                    negate_compare_xyz_icos = -1 * compare_xyz_icos
-
-                    ### Local coords
-                    compare_delta_x = compare['SubparticleOrigin_local'][0] - compare['SubparticleOrigin_icos'][0]
-                    compare_delta_y = compare['SubparticleOrigin_local'][1] - compare['SubparticleOrigin_icos'][1]
-                    compare_x_local = compare['SubparticleRelative_XYZ'][0] + compare_delta_x
-                    compare_y_local = compare['SubparticleRelative_XYZ'][1] + compare_delta_y
-                    compare_xy_local = np.array( [ compare_x_local, compare_y_local, 0 ] )
+    rows, present = groupByParticle( particle_names )
 
+    ### Locally refined positions, flattened
+    xyz_icos = subparticle_array['SubparticleRelative_XYZ']
+    delta = subparticle_array['SubparticleOrigin_local'] - subparticle_array['SubparticleOrigin_icos']
+    xy_icos  = np.concatenate( [ xyz_icos[:,0:2].astype(np.float64), np.zeros( ( len(xyz_icos), 1 ) ) ], axis=1 )
+    xy_local = np.concatenate( [ ( xyz_icos[:,0:2] + delta ).astype(np.float64), np.zeros( ( len(xyz_icos), 1 ) ) ], axis=1 )
 
-                    this_diameter = utils.assess3dDistance( reference_xyz_icos, compare_xyz_icos )
-                    if this_diameter > max_diameter:
-                        max_diameter = this_diameter
-                        ideal_polar_distance = np.around( utils.assess3dDistance( reference_xyz_icos, compare_xyz_icos ), decimals=2 )
-                        flattened_ideal_polar_distance = np.around( utils.assess3dDistance( reference_xy_icos, compare_xy_icos ), decimals=2 )
-                        flattened_real_polar_distance  = np.around( utils.assess3dDistance( reference_xy_local, compare_xy_local ), decimals=2 )
+    last_line = None
+    for start in range( 0, len(rows), chunk_size ):
+        chunk_rows = rows[start:start+chunk_size]
+        particle, reference, compare = polarDiameters( subparticle_array, chunk_rows, present[start:start+chunk_size], central_slice_threshold )
 
-                print( ideal_polar_distance, flattened_ideal_polar_distance, flattened_real_polar_distance )
+        reference_rows = chunk_rows[ particle, reference ]
+        compare_rows = chunk_rows[ particle, np.maximum( compare, 0 ) ]
+        ideal_polar_distance = np.around( pairDistance( xyz_icos[reference_rows], xyz_icos[compare_rows] ), decimals=2 )
+        flattened_ideal_polar_distance = np.around( pairDistance( xy_icos[reference_rows], xy_icos[compare_rows] ), decimals=2 )
+        flattened_real_polar_distance  = np.around( pairDistance( xy_local[reference_rows], xy_local[compare_rows] ), decimals=2 )
 
+        lines = []
+        for line in range( len(particle) ):
+            ### A reference with no pair yet repeats the last line, as the loop did
+            if compare[line] >= 0:
+                last_line = ' '.join( [ str( ideal_polar_distance[line] ), str( flattened_ideal_polar_distance[line] ), str( flattened_real_polar_distance[line] ) ] )
+            if last_line is not None:
+                lines.append( last_line )
+        if lines:
+            print( '\n'.join( lines ) )
 
     return
 
@@ -328,9 +333,12 @@ def main(args):
     if args.pentavalent.endswith(".star"):
         filename = args.pentavalent
         print( "\nReading locally refined coordinates from:", filename )
-        pent_header, fullheader = getStarHeader( filename, regen_string )
-        stardata = getStarData( filename, len( pent_header ) )
-        pentavalent_ndarray = np.asarray( stardata, order='C' )
+        if args.cache:
+            pent_header, fullheader, pentavalent_ndarray, optics = starparse.getStarFile( filename, regen_string, cache=True )
+        else:
+            pent_header, fullheader = getStarHeader( filename, regen_string )
+            stardata = getStarData( filename, len( pent_header ) )
+            pentavalent_ndarray = np.asarray( stardata, order='C' )
     else:
         print( "Please provide a valid star file" )
         sys.exit()
@@ -339,9 +347,12 @@ def main(args):
     if args.hexavalent.endswith(".star"):
         filename = args.hexavalent
         print( "Reading locally refined coordinates from:", filename )
-        hex_header, fullheader = getStarHeader( filename, regen_string )
-        stardata = getStarData( filename, len( hex_header ) )
-        hexavalent_ndarray = np.asarray( stardata, order='C' )
+        if args.cache:
+            hex_header, fullheader, hexavalent_ndarray, optics = starparse.getStarFile( filename, regen_string, cache=True )
+        else:
+            hex_header, fullheader = getStarHeader( filename, regen_string )
+            stardata = getStarData( filename, len( hex_header ) )
+            hexavalent_ndarray = np.asarray( stardata, order='C' )
     else:
         print( "Please provide a valid star file" )
         sys.exit()
@@ -356,4 +367,5 @@ if __name__ == "__main__":
     parser.add_argument("--pentavalent", required=True, help="Locally refined pentavalent capsomers")
     parser.add_argument("--hexavalent", required=True, help="Locally refined hexavalent capsomers")
     parser.add_argument("--threshold", type=float, default='0.9', help="Threshold for inclusion")
+    parser.add_argument("--cache", action='store_true', help="keep a binary copy of parsed star columns next to each input (input.star.cache/) and reuse it while the file is unchanged")
     sys.exit(main(parser.parse_args()))
@@ -19,9 +19,13 @@ import sys
 import os
 import time
 import math
+import shutil
+import tempfile
+import multiprocessing
 import numpy as np
 import mrcfile
 from scipy import ndimage
+from scipy.spatial import cKDTree
 from pyquaternion import Quaternion
 from datetime import datetime
 from isecc import transform
@@ -38,58 +42,20 @@ from isecc.iseccFFT_v2 import swapAxes_ndimage
 ### Generate array containing I1 rotations ready for pyQuaternion in format [ a, bi, cj, dk ]
 I1Quaternions = symops.getSymOps()
 
+### Voxels beyond the capsomer box needed for its soft mask edge (three dilations)
+CAPSOMER_MASK_MARGIN = 3
 
-def rotate3d( my_ndimage, box_size, quat, residual ):
-    """Input boxsize as int"""
-
-    my_ndimage = swapAxes_ndimage( my_ndimage )
-    quat =  pyquat2scipy( quat )    # Convert from pyquaternion to scipy format
-
-    """Your rotation"""
-    q = R.from_quat( quat )         # Scipy
-    r = q.inv()     # invert, or not?
-    #r = q
-
-    x_max = np.true_divide(box_size, 2) - 1
-    x_min = (-1*x_max) - 1
-
-    x = np.linspace( x_min, x_max, int(box_size) )
-    y = np.copy(x)
-    z = np.copy(x)
+### Output planes divided and written at a time when accumulating out of core
+RECOMBINE_WRITE_SLAB = 16
 
-    """ Debug """
-    #print(x,y,z)
 
-    """ Add in the fraction of a pixel (or subtract?) """
-    x = x - residual[0]
-    y = y - residual[1]
-    z = z - residual[2]
-    #print(x,y,z)
-
-    coordStack_original = np.vstack(np.meshgrid(x,y,z)).reshape(3,-1).T 
-
-    print( "Making interpolator" )
-    f = scipy.interpolate.RegularGridInterpolator((x,y,z),my_ndimage,bounds_error=False, fill_value=0)
-    # 'fill_value=0' required to avoid nan, which will screw up downstream processing
-
-    """ Rotate the coordinate system """
-    coordStack_rotated=r.apply(coordStack_original)
+def rotate3d( my_ndimage, box_size, quat, residual ):
+    """Input boxsize as int"""
+    """ Trilinear resampling of the rotated grid, computed slab by slab straight into ZYX order. """
+    """ See transform.rotateVolume """
 
-    """ Interpolate data on the rotated coordinate system """
     print( "Interpolating data" )
-    rotated_data = f(coordStack_rotated)
-
-    """ Reshape the data to the original shape """
-    rotated_data = rotated_data.reshape( box_size, box_size, box_size )
-
-    ### The following lines are a hack. ### 
-    ### The reshape operation does not result ###
-    ### in the desired organization of the data. ###
-    """ Rotate 90 degrees, flip along z, swap axes to z,y,x ordering """
-    rotated_data = np.rot90( rotated_data, axes=(0,1) )
-    rotated_data = np.flip( rotated_data, axis=0 )
-    """Swap the axes back to z,y,x """
-    rotated_data = swapAxes_ndimage( rotated_data ) 
+    rotated_data = transform.rotateVolume( my_ndimage, Quaternion( quat ).elements, residual )
 
     return rotated_data
 
@@ -116,126 +82,106 @@ def getUniqueVertices( vertex_vector ):
     vertex_table['IdealVector'] = vertex_vector
     vertex_table['ExpandQuat'] = I1Quaternions
 
-    for index, vertex in enumerate( vertex_table, start=0) :
-
-        ### Invert for the vector transformation
-        expand_pose_inverse = Quaternion(I1Quaternions[index]).inverse
-
-        ### Transform the vertex vector
-        expand_vector = np.around( expand_pose_inverse.rotate( vertex_vector ), decimals=3)
+    ### Invert for the vector transformation, then transform the vertex vector. All 60 at once.
+    expand_pose_inverse = transform.quatInverse( I1Quaternions )
+    vertex_table['ExpandVector'] = np.around( transform.quatRotate( expand_pose_inverse, vertex_vector ), decimals=3 )
 
-        # Assess whether tranformed point is unique
-        unique_bool = True
-        for loop_index, item in enumerate( vertex_table, start=0) :
-            if np.allclose( expand_vector, vertex_table[loop_index]['ExpandVector'], atol=0.1) :
-                unique_bool = False
-
-        # Store the information
-        vertex_table[index]['Unique'] = unique_bool
-        vertex_table[index]['ExpandVector'] = expand_vector
-
-    ### Gather the unique vertices
-    unique_vertex_indices = np.where( vertex_table['Unique'] )[0]
+    # Assess whether tranformed points are unique
+    unique_vertex_indices, vertex_orbit = symops.uniqueOrbit( vertex_table['ExpandVector'], 0.1 )
+    vertex_table['Unique'][unique_vertex_indices] = True
 
     return unique_vertex_indices
 
 
-def padCapsomer( capsomer, vector, subbox, mapbox ):
-
-    """ vector, subbox, and mapbox should all be in pixels """
-    pad_pix = int( mapbox - subbox )    # total number of pixels to pad
+def capsomerBox( vector, subbox, mapbox, margin=0 ):
+    """ Where a capsomer lands in the map: slices into the map, and the matching slices into a """
+    """ box of subbox + 2*margin centered on the capsomer. Clipped at the edges of the map. """
+    """ vector (ZYX), subbox, and mapbox should all be in pixels. Same placement as padding to mapbox. """
 
-    """ convert vector to array offsets """
-    offset_x = vector[0] + np.true_divide(mapbox,2)
-    offset_y = vector[1] + np.true_divide(mapbox,2)
-    offset_z = vector[2] + np.true_divide(mapbox,2)
+    map_slices = []
+    box_slices = []
+    for axis in range(3):
+        """ Must use offset to determine the 'left' edge """
+        offset = vector[axis] + np.true_divide(mapbox,2)
+        start = int( offset - np.true_divide(subbox,2) ) - margin
+        stop = start + subbox + ( 2 * margin )
 
-    """ Must use offset to determine pixels to pad on the 'left' side """
-    pad_x1 = int( offset_x - np.true_divide(subbox,2) )
-    pad_y1 = int( offset_y - np.true_divide(subbox,2) )
-    pad_z1 = int( offset_z - np.true_divide(subbox,2) )
+        map_slices.append( slice( max(start,0), min(stop,mapbox) ) )
+        box_slices.append( slice( max(start,0) - start, min(stop,mapbox) - start ) )
 
-    """ Determine the padding for the 'right' side """
-    pad_x2 = int( pad_pix - pad_x1 )
-    pad_y2 = int( pad_pix - pad_y1 )
-    pad_z2 = int( pad_pix - pad_z1 )
+    return tuple(map_slices), tuple(box_slices)
 
-    """ Do the padding """
-    capsomer = np.pad(capsomer, ( (pad_x1,pad_x2), (pad_y1,pad_y2), (pad_z1,pad_z2) ), 'constant', constant_values=(0,0))
 
-    """ Some printing for debug purposes """
-    #print("Pad left:",  pad_x1, pad_y1, pad_z1)
-    #print("Pad right:", pad_x2, pad_y2, pad_z2)
+def maskCapsomer( capsomer, vector, capsomer_centers, center_tree, map_start, mapbox ):
+    """ Mask for the voxels closer to this capsomer center than to any other, with a soft edge """
+    """ capsomer is any box of the map, with capsomer[0,0,0] at map index map_start (ZYX) """
+    """ center_tree is a cKDTree of capsomer_centers, built once for all capsomers """
+    """ The soft edge reaches 3 voxels, so the box needs a margin of 3 beyond the capsomer """
+    """ for the mask to match one made over the whole map. Returns the masked capsomer and the mask. """
 
-    return capsomer
-
-
-def maskCapsomer( capsomer, correction_mask, vector, capsomer_centers ):
-
-    capsomer_mask = np.ones_like( capsomer )
-    #equidistance_mask = np.zeros_like( capsomer, dtype=np.bool )
-
-    nhalf = len(capsomer) // 2
-    x0, y0, z0 = np.meshgrid(*[np.arange(-nhalf - 0.5, nhalf - 0.5)] * 3, indexing="ij")
-    x = x0
-    y = y0
-    z = z0
+    """ Map coordinates of the box, as for a meshgrid over the whole map """
+    nhalf = mapbox // 2
+    x, y, z = np.meshgrid( *[ ( np.arange( capsomer.shape[axis] ) + map_start[axis] ) - nhalf - 0.5 for axis in range(3) ], indexing="ij" )
     print("Preparing to create mask for current subvolume")
     gold_distance = np.sqrt((x - vector[0])**2 + (y-vector[1])**2 + (z-vector[2])**2)
-    
-    for index, center in enumerate(capsomer_centers):
 
-        """ Don't compare this subvolume center against itself """
-        if not np.array_equal(vector,center.astype(int)):
+    """ Don't compare this subvolume center against itself """
+    is_self = np.all( capsomer_centers.astype(int) == vector, axis=1 )
 
-            """ This makes the evaluator """
-            x0, y0, z0 = np.meshgrid(*[np.arange(-nhalf - 0.5, nhalf - 0.5)] * 3, indexing="ij")
-            x = x0
-            y = y0
-            z = z0
+    """ Nearest other center of every voxel. One more neighbor than there are copies of this center is enough. """
+    voxels = np.stack( [ x.ravel(), y.ravel(), z.ravel() ], axis=1 )
+    num_neighbors = min( int( np.sum(is_self) ) + 1, len(capsomer_centers) )
+    neighbor_distance, neighbors = center_tree.query( voxels, k=num_neighbors )
+    neighbors = neighbors.reshape( len(voxels), num_neighbors )
+    neighbor_distance = neighbor_distance.reshape( len(voxels), num_neighbors )
 
-            """ A volume containing distances to the currently evaluated center """
-            dist_from_center = np.sqrt((x - center[0])**2 + (y-center[1])**2 + (z-center[2])**2)
+    if np.all( is_self ):
+        """ Nothing to compare against """
+        capsomer_mask = np.ones( capsomer.shape, dtype=bool )
+    else:
+        nearest_other = neighbors[ np.arange(len(voxels)), np.argmin( np.where( is_self[neighbors], np.inf, neighbor_distance ), axis=1 ) ]
 
-            """ Update overall mask """
-            mask = gold_distance <= dist_from_center
-            #mask_edge = gold_distance == dist_from_center
-            #equidistance_mask = equidistance_mask + mask_edge
-            capsomer_mask = capsomer_mask * mask.astype(np.int)
-            #print( np.unique(equidistance_mask) )
+        """ Exact distance to that center, as the comparison is <= and ties belong to both capsomers """
+        center = capsomer_centers[nearest_other]
+        dist_from_center = np.sqrt((x.ravel() - center[:,0])**2 + (y.ravel()-center[:,1])**2 + (z.ravel()-center[:,2])**2)
+        capsomer_mask = ( gold_distance.ravel() <= dist_from_center ).reshape( capsomer.shape )
 
     """ At this point, capsomer_mask contains all voxels belonging to the given capsomer """
     """ In the case of equidistance, those voxels are overrepresented """
     """ We now want to dilate and soften that mask to reduce nyquist artifacts """
-    soft_1 = ndimage.binary_dilation(capsomer_mask, iterations=1) - capsomer_mask
-    soft_2 = ndimage.binary_dilation(capsomer_mask, iterations=2) - (capsomer_mask + soft_1)
-    soft_3 = ndimage.binary_dilation(capsomer_mask, iterations=3) - (capsomer_mask + soft_1 + soft_2)
-    soft_1 = np.cos((1*np.pi)/8) * soft_1.astype(np.float32)
-    soft_2 = np.cos((2*np.pi)/8) * soft_2.astype(np.float32)
-    soft_3 = np.cos((3*np.pi)/8) * soft_3.astype(np.float32)
-
-    """ Add the soft mask to the capsomer mask """
-    capsomer_mask = capsomer_mask.astype(np.float32) + soft_1 + soft_2 + soft_3
-    #print( "Unique values in capsomer mask", np.unique(capsomer_mask) )
+    """ Voxels 1, 2 and 3 steps (taxicab) outside the mask get cos( n*pi/8 ), as three binary dilations gave """
+    capsomer_mask = softenMask( capsomer_mask )
 
     """ Only take the capsomer_mask where capsomer map has values """
-    capsomer_bool = (capsomer!=0).astype(np.int)
-    capsomer_mask = capsomer_mask * capsomer_bool
+    capsomer_mask[ capsomer == 0 ] = 0
 
     """ Multiply by mask """
-    capsomer = capsomer * capsomer_mask.astype(np.float32)
+    capsomer = capsomer * capsomer_mask
+
+    return capsomer, capsomer_mask
 
-    """ Find intersection of equidistance_mask and capsomer_mask """
-    #equidistance_mask = equidistance_mask * capsomer_mask.astype(np.bool)
 
-    """ Update the correction_mask """
-    correction_mask = correction_mask + capsomer_mask.astype(np.float32)
-    #print( "Unique values in correction mask", np.unique(correction_mask) )
+def softenMask( mask, edge=CAPSOMER_MASK_MARGIN ):
+    """ float32 mask with a cosine edge, from one taxicab distance transform of a boolean mask """
+    weights = np.cos( ( np.arange( edge + 1 ) * np.pi ) / 8 ).astype(np.float32)
+    weights[0] = 1
 
-    return capsomer, correction_mask
+    if not np.any( mask ):
+        return np.zeros( mask.shape, dtype=np.float32 )
 
+    steps = ndimage.distance_transform_cdt( ~mask, metric='taxicab' )
+    soft_mask = np.zeros( mask.shape, dtype=np.float32 )
+    within = steps <= edge
+    soft_mask[within] = weights[ steps[within] ]
+
+    return soft_mask
+
+
+def adjustCapsomer( capsomer, symop, quatZ, vector, capsomer_centers, center_tree, subbox, mapbox, fourier=None ):
+    """ Rotate, place and mask one capsomer, within its own bounding box of the map """
+    """ Returns the map slices, and the masked capsomer and mask to add over them """
+    """ fourier may hold ( FourierRotator, transform of capsomer ) to rotate in Fourier space instead """
 
-def adjustCapsomer( capsomer, correction_mask, symop, quatZ, vector, capsomer_centers, subbox, mapbox ):
     """ Must invert the symop """
     quaternion = Quaternion(symop).inverse
 
@@ -254,23 +200,103 @@ def adjustCapsomer( capsomer, correction_mask, symop, quatZ, vector, capsomer_ce
     vector = np.array( [vector[2], vector[1], vector[0]] )
     vector_decimal = np.array( [vector_decimal[2], vector_decimal[1], vector_decimal[0]] )
 
-    #print("DEBUG:", vector, capsomer_centers[index])
-
     """ Will need to rotate/interpolate the capsomer here """
-    rotated_data = rotate3d( capsomer, capsomer.shape[0], qpose, vector_decimal )
-    """ Move the capsomer to the appropriate location """
-    capsomer = padCapsomer(rotated_data, vector, subbox, mapbox)
+    if fourier is None:
+        rotated_data = rotate3d( capsomer, capsomer.shape[0], qpose, vector_decimal )
+    else:
+        rotator, capsomer_ft = fourier
+        print( "Rotating in Fourier space" )
+        rotated_data = rotator.rotate( capsomer_ft, qpose.elements, vector_decimal )
+
+    """ Move the capsomer to the appropriate location, in a box with room for the soft mask edge """
+    margin = CAPSOMER_MASK_MARGIN
+    region_slices, region_box = capsomerBox( vector, subbox, mapbox, margin )
+    map_slices, capsomer_box = capsomerBox( vector, subbox, mapbox )
+
+    region = np.zeros( ( subbox + 2*margin, ) * 3, dtype=rotated_data.dtype )
+    region[margin:margin+subbox, margin:margin+subbox, margin:margin+subbox] = rotated_data
+    region = region[region_box]
+
     """ Mask the capsomer to only voxels closest to this capsomer center"""
-    capsomer, correction_mask = maskCapsomer( capsomer, correction_mask, vector, capsomer_centers )
+    map_start = [ region_slice.start for region_slice in region_slices ]
+    capsomer, capsomer_mask = maskCapsomer( region, vector, capsomer_centers, center_tree, map_start, mapbox )
+
+    """ Outside the capsomer box everything is zero. Return just the box. """
+    inner = tuple( [ slice( map_slices[axis].start - region_slices[axis].start, map_slices[axis].stop - region_slices[axis].start ) for axis in range(3) ] )
+
+    return map_slices, capsomer[inner], capsomer_mask[inner]
+
+
+### Inherited by pool workers on fork, so the capsomer maps are not pickled per task
+_shared_capsomers = None
+
+def _adjustSharedCapsomer( task ):
+    kind, symop = task
+    capsomer, quatZ, vector, subbox = _shared_capsomers[kind]
+    fourier = _shared_capsomers['fourier'][kind] if _shared_capsomers['fourier'] else None
+    return adjustCapsomer( capsomer, symop, quatZ, vector, _shared_capsomers['centers'], _shared_capsomers['center_tree'], subbox, _shared_capsomers['mapbox'], fourier )
+
+
+def prepareFourierRotation( capsomers, threads=1 ):
+    """ ( FourierRotator, padded transform ) for each capsomer map, keyed as capsomers is """
+    """ Each map is transformed once. Maps of the same box size share one rotator, and so one pair of FFTW plans. """
+    rotators = {}
+    fourier = {}
+    for kind, capsomer in capsomers.items():
+        box_size = capsomer.shape[0]
+        if box_size not in rotators:
+            rotators[box_size] = FourierRotator( box_size, threads=threads )
+        fourier[kind] = ( rotators[box_size], rotators[box_size].transform( capsomer ) )
+    return fourier
 
-    return capsomer, correction_mask
 
+def accumulationBuffers( mapbox, scratch=None ):
+    """ Sum (float64, as adding float64 capsomers always produced) and weights (float32) for the map """
+    """ With scratch, both are .npy files memory-mapped from a new directory under scratch, so only the """
+    """ capsomer boxes being added are held in memory. Returns the two arrays and that directory. """
+    if scratch is None:
+        capsid = np.zeros( (mapbox,mapbox,mapbox), dtype=np.float64)
+        return capsid, np.zeros_like(capsid, dtype=np.float32), None
 
-def stitchCapsomers( mrc_pentavalent, mrc_hexavalent, vector_pent, vector_hex, mapbox, angpix, output ):
+    directory = tempfile.mkdtemp( prefix='recombine_', dir=scratch )
+    print( "  Note: Accumulating out of core in", directory, "\n" )
+    capsid = np.lib.format.open_memmap( os.path.join( directory, 'capsid.npy' ), mode='w+', dtype=np.float64, shape=(mapbox,mapbox,mapbox) )
+    correction_mask = np.lib.format.open_memmap( os.path.join( directory, 'correction_mask.npy' ), mode='w+', dtype=np.float32, shape=(mapbox,mapbox,mapbox) )
+    return capsid, correction_mask, directory
 
-    """ Make ndarray to store the output map """
-    capsid = np.zeros( (mapbox,mapbox,mapbox), dtype=np.float32)
-    correction_mask = np.zeros_like(capsid, dtype=np.float32)
+
+def writeCapsidSlabs( capsid, correction_mask, mapbox, angpix, output, slab=RECOMBINE_WRITE_SLAB ):
+    """ Divide by the weights and write the output mrc file a few planes at a time """
+    """ Same voxels as the in-memory route. Header statistics are accumulated in float64. """
+    mrc = mrcfile.new_mmap(output, shape=(mapbox,mapbox,mapbox), mrc_mode=2, overwrite=True)
+
+    minimum, maximum, total, total_squares = np.inf, -np.inf, 0.0, 0.0
+    for start in range( 0, mapbox, slab ):
+        planes = capsid[start:start+slab].astype(np.float32)
+        weights = correction_mask[start:start+slab]
+        planes = np.divide( planes, weights, out=np.zeros_like(planes), where=weights!=0 )
+        mrc.data[start:start+slab] = planes
+
+        minimum = min( minimum, planes.min() )
+        maximum = max( maximum, planes.max() )
+        total += np.sum( planes, dtype=np.float64 )
+        total_squares += np.sum( np.square( planes, dtype=np.float64 ) )
+
+    mean = total / ( mapbox ** 3 )
+    mrc.header.dmin = minimum
+    mrc.header.dmax = maximum
+    mrc.header.dmean = mean
+    mrc.header.rms = np.sqrt( max( ( total_squares / ( mapbox ** 3 ) ) - ( mean * mean ), 0 ) )
+    mrc.voxel_size = angpix
+    mrc.header.label[1] = str('Created using ISECC_recombine, Goetschius DJ 2020')
+    mrc.close()
+
+
+def stitchCapsomers( mrc_pentavalent, mrc_hexavalent, vector_pent, vector_hex, mapbox, angpix, output, jobs=1, interpolation='real', threads=1, scratch=None ):
+    global _shared_capsomers
+
+    """ Make ndarrays to store the output map and its weights, in memory or memory-mapped under scratch """
+    capsid, correction_mask, scratch_directory = accumulationBuffers( mapbox, scratch )
 
     """ Take input """
     vector_pentavalent = np.array([ vector_pent[0], vector_pent[1], vector_pent[2] ])
@@ -319,23 +345,53 @@ def stitchCapsomers( mrc_pentavalent, mrc_hexavalent, vector_pent, vector_hex, m
     """ Store the centers. Rotate before converting to ZYX ordering """
     for index, symop in enumerate(symops_pent, start=0):    # papillomavirus and polyomavirus
         center = Quaternion(symop).inverse.rotate(vector_pentavalent)
-        capsomer_centers[index] = np.array( [(1*center[2]), (-1*center[1]), (-1*center[0])] ).astype(np.int)
+        capsomer_centers[index] = np.array( [(1*center[2]), (-1*center[1]), (-1*center[0])] ).astype(int)
     for index, symop in enumerate(symops_hex, start=len(symops_pent)):    # papillomavirus and polyomavirus
         center = Quaternion(symop).inverse.rotate(vector_hexavalent)
-        capsomer_centers[index] = np.array( [(1*center[2]), (-1*center[1]), (-1*center[0])] ).astype(np.int)
-
-    """ Adjust the pentavalent capsomers """
-    for index, symop in enumerate(symops_pent, start=0): 
-        capsomer, correction_mask = adjustCapsomer( ndarray_pentavalent, correction_mask, symop, pent_quat, vector_pentavalent, capsomer_centers, subbox_pentavalent, mapbox )
-        capsid = np.add(capsid,capsomer)
-        print("Pentavalent capsomer", index, "completed." )
-
-    """ Adjust the hexavalent capsomers """
-    for index, symop in enumerate(symops_hex, start=0): 
-        capsomer, correction_mask = adjustCapsomer( ndarray_hexavalent, correction_mask, symop, hex_quat, vector_hexavalent, capsomer_centers, subbox_hexavalent, mapbox )
-        capsid = np.add(capsid,capsomer)
-        print("Hexavalent capsomer", index, "completed.")
-        #print("DEBUG: Correction_mask currently contains values", np.unique(correction_mask) )
+        capsomer_centers[index] = np.array( [(1*center[2]), (-1*center[1]), (-1*center[0])] ).astype(int)
+
+    """ Transform each capsomer once, before any workers start, for rotation in Fourier space """
+    fourier = None
+    if interpolation == 'fourier':
+        print( "  Note: Capsomers will be rotated in Fourier space using", threads, "FFTW threads.\n" )
+        fourier = prepareFourierRotation( { 'pentavalent': ndarray_pentavalent, 'hexavalent': ndarray_hexavalent }, threads )
+
+    """ Each capsomer is independent until it is added to the capsid """
+    _shared_capsomers = { 'pentavalent': ( ndarray_pentavalent, pent_quat, vector_pentavalent, subbox_pentavalent ),
+                          'hexavalent':  ( ndarray_hexavalent,  hex_quat,  vector_hexavalent,  subbox_hexavalent ),
+                          'centers': capsomer_centers, 'center_tree': cKDTree( capsomer_centers ), 'mapbox': mapbox,
+                          'fourier': fourier }
+    tasks = [ ( 'pentavalent', symop ) for symop in symops_pent ] + [ ( 'hexavalent', symop ) for symop in symops_hex ]
+
+    if jobs > 1:
+        print( "  Note: Capsomers will be placed using", jobs, "processes.\n" )
+        pool = multiprocessing.get_context( 'fork' ).Pool( jobs )
+        placed = pool.imap( _adjustSharedCapsomer, tasks )
+    else:
+        pool = None
+        placed = map( _adjustSharedCapsomer, tasks )
+
+    """ Sum in the same order as a serial run, so the map does not depend on jobs """
+    try:
+        for task_index, ( map_slices, capsomer, capsomer_mask ) in enumerate( placed ):
+            capsid[map_slices] += capsomer
+            correction_mask[map_slices] += capsomer_mask
+            if task_index < len(symops_pent):
+                print("Pentavalent capsomer", task_index, "completed." )
+            else:
+                print("Hexavalent capsomer", task_index - len(symops_pent), "completed.")
+    finally:
+        if pool is not None:
+            pool.terminate()
+        _shared_capsomers = None
+
+    if scratch_directory is not None:
+        try:
+            writeCapsidSlabs( capsid, correction_mask, mapbox, angpix, output )
+        finally:
+            del capsid, correction_mask
+            shutil.rmtree( scratch_directory )
+        return
 
     """ Cast to float32. Might be unneccessary """
     capsid = capsid.astype(np.float32)
@@ -371,7 +427,7 @@ def main(args):
     vector_hexavalent  = np.true_divide( args.hexavalent_vector,  args.angpix )
 
     """ Pass parameters to main program """
-    stitchCapsomers(args.pentavalent, args.hexavalent, vector_pentavalent, vector_hexavalent, args.output_box, args.angpix, args.output )
+    stitchCapsomers(args.pentavalent, args.hexavalent, vector_pentavalent, vector_hexavalent, args.output_box, args.angpix, args.output, args.jobs, args.interpolation, args.threads, args.scratch )
 
     return 0
 
@@ -385,5 +441,9 @@ if __name__ == "__main__":
     parser.add_argument("--output_box", type=int, help="box size for output map", required=True)
     parser.add_argument("--output", type=str, help="name for output mrc file", default='icosahedron.mrc')
     parser.add_argument("--angpix", type=float, help="pixel size in the input maps", default='1.1')
+    parser.add_argument("--jobs", type=int, default=1, help="number of processes used to rotate and mask capsomers. Output is identical to a serial run.")
+    parser.add_argument("--interpolation", type=str, choices=['real','fourier'], default='real', help="rotate capsomers by trilinear interpolation in real space, or in padded Fourier space with grid correction. Fourier needs even capsomer boxes.")
+    parser.add_argument("--threads", type=int, default=1, help="FFTW threads for --interpolation fourier")
+    parser.add_argument("--scratch", type=str, default=None, help="directory for memory-mapped sum and weight buffers. For large output boxes: memory then scales with the capsomer box, not the map.")
     sys.exit(main(parser.parse_args()))
 
@@ -16,20 +16,41 @@
 
 import argparse
 import sys
+import collections
 import os
 import time
 import math
 import numpy as np
-from pyquaternion import Quaternion
 from datetime import datetime
 from isecc import transform
 from isecc import utils
 from isecc import starparse
 from isecc import symops
+from isecc.isecc_classes import RunningStatistics
+
+### Summary of each distribution
+DYNAMICS_PERCENTILES = ( 5, 25, 50, 75, 95 )
+DYNAMICS_HISTOGRAM_BINS = 75
+
+### Fixed histogram ranges for --stream, in Angstroms and degrees. Values outside are counted, not binned.
+DYNAMICS_XY_RANGE = ( 0.0, 15.0 )
+DYNAMICS_POSE_RANGE = ( 0.0, 15.0 )
+
+### Breakdowns for --stream, when the star file has the label
+DYNAMICS_GROUP_LABELS = collections.OrderedDict( [ ( 'rlnClassNumber', 'Class' ),
+                                                   ( 'rlnCustomVertexGroup', 'Vertex group' ) ] )
+
+### Only these columns are read from the star file
+DYNAMICS_LABELS = [ 'rlnAngleRot', 'rlnAngleTilt', 'rlnAnglePsi',
+                    'rlnAngleRotPrior', 'rlnAngleTiltPrior', 'rlnAnglePsiPrior',
+                    'rlnOriginXAngst', 'rlnOriginYAngst',
+                    'rlnOriginXPriorAngst', 'rlnOriginYPriorAngst' ]
+
 
 def calculateDeltaXY( XAngst, YAngst, XPriorAngst, YPriorAngst ) :
-    deltaX = float( XAngst ) - float( XPriorAngst )
-    deltaY = float( YAngst ) - float( YPriorAngst )
+    """ Scalars or arrays of equal length """
+    deltaX = np.asarray( XAngst, dtype=np.float64 ) - np.asarray( XPriorAngst, dtype=np.float64 )
+    deltaY = np.asarray( YAngst, dtype=np.float64 ) - np.asarray( YPriorAngst, dtype=np.float64 )
     deltaX2 = deltaX ** 2
     deltaY2 = deltaY ** 2
 
@@ -38,166 +59,210 @@ def calculateDeltaXY( XAngst, YAngst, XPriorAngst, YPriorAngst ) :
 
     return deltaX, deltaY, deltaXY
 
-def calculateDeltaPose( quaternionLocalPose, quaternionPriorPose ) :
+def calculateDeltaPoseArray( eulers, eulerPriors ) :
+    """ Geodesic distance in radians between local and prior poses, as Quaternion.distance, for every row at once """
+    """ eulers and eulerPriors are ( rot, tilt, psi ) in degrees, each an array """
+    localPoses = transform.myEuler2QuatArray( *[ np.radians( np.asarray( angle, dtype=np.float64 ) ) for angle in eulers ] )
+    priorPoses = transform.myEuler2QuatArray( *[ np.radians( np.asarray( angle, dtype=np.float64 ) ) for angle in eulerPriors ] )
+    return transform.quatDistance( localPoses, priorPoses )
+
+
+def summarizeDistribution( values, percentiles=DYNAMICS_PERCENTILES, bins=DYNAMICS_HISTOGRAM_BINS ) :
+    """ Mean, stdev, percentiles and histogram of a 1D array """
+    counts, edges = np.histogram( values, bins=bins )
+    summary = { 'average' : np.average( values ),
+                'stdev' : np.std( values ),
+                'percentiles' : np.asarray( percentiles ),
+                'percentile_values' : np.percentile( values, percentiles ),
+                'histogram' : counts,
+                'bin_edges' : edges }
+    return summary
 
-    # Finds the length of the chord of the shortest arc. We don't want this.
-    #deltaPoseChord = Quaternion.absolute_distance( quaternionLocalPose, quaternionPriorPose )
 
-    # Finds the length of the geodesic curve between poses
-    # Returns positive value
-    deltaPoseGeodesic = Quaternion.distance( quaternionLocalPose, quaternionPriorPose )
+def printPercentiles( name, summary, units ) :
+    values = ', '.join( [ ''.join( [ 'p', str( percentile ), '=', str( np.around( value, 4 ) ) ] ) for percentile, value in zip( summary['percentiles'], summary['percentile_values'] ) ] )
+    print( "      ", name, "percentiles:", values, units )
 
-    # Finds the length of the geodesic curve between poses    
-    #deltaPoseSym = Quaternion.sym_distance( quaternionLocalPose, quaternionPriorPose )
 
-    return deltaPoseGeodesic
-    
+def printSummaries( deltaXY_summary, deltaPose_summary ) :
+    print( "FINAL: Average deltaXY is:", np.around(deltaXY_summary['average'],2), "Angstroms" )
+    print( "       Stdev on deltaXY is", np.around(deltaXY_summary['stdev'],3) )
+    printPercentiles( "deltaXY", deltaXY_summary, "Angstroms" )
+    print( "FINAL: Average deltaPose is:", np.around(deltaPose_summary['average'],4), "degrees" )
+    print( "       Stdev on deltaPose is", np.around(deltaPose_summary['stdev'],4) )
+    printPercentiles( "deltaPose", deltaPose_summary, "degrees" )
 
-def myProgram( my_ndarray, header, fullheader ) :
 
-    ### Parse star file
-    rot_index, tilt_index, psi_index = starparse.getEulers( header )
-    rotPrior_index, tiltPrior_index, psiPrior_index = starparse.getEulerPriors( header )
+def myProgram( star_table ) :
+    """ star_table is a StarTable, e.g. from starparse.getStarTable """
+    """ Returns deltaXY (Angstroms) and deltaPose (degrees) for every subparticle, with a summary of each """
 
-    originXAngst_index, originYAngst_index = starparse.getOffsetsAngst( header )
-    originXPriorAngst_index, originYPriorAngst_index = starparse.getOffsetPriorsAngst( header )
+    ### Parse star file. Getters return the columns themselves for a StarTable.
+    eulers = starparse.getEulers( star_table )
+    eulerPriors = starparse.getEulerPriors( star_table )
 
-    # Not currently needed
-#    defocusU_index, defocusV_index, defocusAngle_index = starparse.getDefocus( header )
-#    class_index = starparse.getClass( header )
-#    micrographname_index, imagename_index, particleID_index = starparse.getMicrographName( header )
+    originXAngst, originYAngst = starparse.getOffsetsAngst( star_table )
+    originXPriorAngst, originYPriorAngst = starparse.getOffsetPriorsAngst( star_table )
 
+    deltaX, deltaY, deltaXY_list = calculateDeltaXY( originXAngst, originYAngst, originXPriorAngst, originYPriorAngst )
+    deltaPose_list = np.degrees( calculateDeltaPoseArray( eulers, eulerPriors ) )
 
-    deltaXY_list = np.zeros( len(my_ndarray) )
-    deltaPose_list = np.zeros( len(my_ndarray) )
-    
-    ### Iterate through the entire array, modify values for a single rotation operation
-    for x in range(0,len(my_ndarray)):        # Iterate over all particles
+    deltaXY_summary = summarizeDistribution( deltaXY_list )
+    deltaPose_summary = summarizeDistribution( deltaPose_list )
 
-        ### Obtain Offsets
-        my_originXAngst = my_ndarray[x][originXAngst_index]
-        my_originYAngst = my_ndarray[x][originYAngst_index]
+    printSummaries( deltaXY_summary, deltaPose_summary )
 
-        my_originXPriorAngst = my_ndarray[x][originXPriorAngst_index]
-        my_originYPriorAngst = my_ndarray[x][originYPriorAngst_index]
+    return { 'deltaXY' : deltaXY_list, 'deltaPose' : deltaPose_list,
+             'deltaXY_summary' : deltaXY_summary, 'deltaPose_summary' : deltaPose_summary }
 
-        deltaX, deltaY, deltaXY = calculateDeltaXY( my_originXAngst, my_originYAngst, my_originXPriorAngst, my_originYPriorAngst )
-        deltaXY_list[x] = deltaXY
 
-        my_rotrad  = np.radians( float( my_ndarray[x][rot_index]  ) )
-        my_tiltrad = np.radians( float( my_ndarray[x][tilt_index] ) )
-        my_psirad  = np.radians( float( my_ndarray[x][psi_index]  ) )
+def newDynamicsStatistics( xy_range=DYNAMICS_XY_RANGE, pose_range=DYNAMICS_POSE_RANGE ) :
+    return { 'deltaXY' : RunningStatistics( DYNAMICS_HISTOGRAM_BINS, xy_range ),
+             'deltaPose' : RunningStatistics( DYNAMICS_HISTOGRAM_BINS, pose_range ) }
 
-        my_rotradPrior  = np.radians( float( my_ndarray[x][rotPrior_index]  ) )
-        my_tiltradPrior = np.radians( float( my_ndarray[x][tiltPrior_index] ) )
-        my_psiradPrior  = np.radians( float( my_ndarray[x][psiPrior_index]  ) )    
 
-        
-        quaternionLocalPose = Quaternion( transform.myEuler2Quat( my_rotrad, my_tiltrad, my_psirad ) )
-        quaternionPriorPose = Quaternion( transform.myEuler2Quat( my_rotradPrior, my_tiltradPrior, my_psiradPrior ) )
+def runningSummary( statistics, percentiles=DYNAMICS_PERCENTILES ) :
+    """ RunningStatistics in the form summarizeDistribution gives """
+    summary = { 'count' : statistics.count,
+                'average' : statistics.mean,
+                'stdev' : statistics.stdev(),
+                'percentiles' : np.asarray( percentiles ),
+                'percentile_values' : statistics.percentile( percentiles ),
+                'histogram' : statistics.histogram,
+                'bin_edges' : statistics.bin_edges,
+                'underflow' : statistics.underflow,
+                'overflow' : statistics.overflow }
+    return summary
 
-        deltaPose = calculateDeltaPose( quaternionLocalPose, quaternionPriorPose )
-        deltaPose_list[x] = deltaPose
 
-        if ( x % 50000 ) < 0.1 :
-            print( "Subparticle", x, "of", len(my_ndarray) )
-            print( "  deltaXY is:", np.around( deltaXY, 2 ), "Angstroms" )
-            print( "  deltaPose is:", np.around( np.degrees(deltaPose), 4 ), "degrees" )
+def updateGroups( groups, keys, deltaXY, deltaPose, xy_range, pose_range ) :
+    """ Add each row's deltas to the statistics kept for its key, e.g. its class number """
+    unique_keys, inverse = np.unique( keys, return_inverse=True )
+    order = np.argsort( inverse, kind='stable' )
+    boundaries = np.cumsum( np.bincount( inverse ) )[:-1]
 
-    deltaXY_average = np.average( deltaXY_list )
-    deltaXY_stdev = np.std( deltaXY_list )
-    deltaPose_average = np.average( deltaPose_list )
-    deltaPose_average = np.degrees( deltaPose_average )
+    for key, rows in zip( unique_keys.tolist(), np.split( order, boundaries ) ):
+        if key not in groups:
+            groups[key] = newDynamicsStatistics( xy_range, pose_range )
+        groups[key]['deltaXY'].update( deltaXY[rows] )
+        groups[key]['deltaPose'].update( deltaPose[rows] )
 
-    print( "FINAL: Average deltaXY is:", np.around(deltaXY_average,2), "Angstroms" )
-    print( "       Stdev on deltaXY is", np.around(deltaXY_stdev,3) )
-    print( "FINAL: Average deltaPose is:", np.around(deltaPose_average,4), "degrees" )
 
-    return
-    
+def starChunks( filename, labels, chunk_size, cache=False ) :
+    """ StarTables of at most chunk_size rows: from the text, or with cache as slices of the memory-mapped sidecar """
+    if not cache:
+        return starparse.iterStarTable( filename, labels=labels, chunk_size=chunk_size )
 
-def getStarHeader( my_star ):
-    header = []
-    header_index = int( 0 )
-    full_header = []
-    
-    # Add run info to output star file
-    date = str( datetime.now() )
-    append_this = ''.join( [ '# SCRIPT_RUN_DATE: ', date ] )
-    full_header.append( append_this.strip() )
-    print( append_this )
+    star_table = starparse.getStarTable( filename, labels=labels, chunk_size=chunk_size, cache=True )
+    return ( star_table.take( slice( start, start + chunk_size ) ) for start in range( 0, len( star_table ), chunk_size ) )
 
-    append_this = ''.join( [ '# SCRIPT_VERSION: ', sys.argv[0] ] )
-    full_header.append( append_this.strip() )
-    print( append_this )
 
-    arguments = ' '.join( sys.argv[1:] )
-    append_this = ''.join( [ '# SCRIPT_ARGS: ', arguments ] )
-    full_header.append( append_this.strip() )
-    print( append_this, "\n" )
+def streamProgram( filenames, chunk_size=starparse.STAR_READ_CHUNK, xy_range=DYNAMICS_XY_RANGE, pose_range=DYNAMICS_POSE_RANGE, cache=False ) :
+    """ As myProgram, over any number of star files, chunk_size rows at a time """
+    """ Keeps running statistics rather than the deltas, so memory does not grow with the number of rows """
+    """ Also broken down by each label in DYNAMICS_GROUP_LABELS that the files have """
 
-    with open(my_star, "r") as my_star:
-        
-        START_PARSE = None    # Needed for relion 3.1 star format
+    overall = newDynamicsStatistics( xy_range, pose_range )
+    breakdowns = collections.OrderedDict( [ ( label, collections.OrderedDict() ) for label in DYNAMICS_GROUP_LABELS ] )
 
-        for line in my_star:
+    for filename in filenames:
+        num_rows = 0
 
-            if START_PARSE == None:
-                ### Store full header for final output
-                full_header.append( line.strip() )
+        for star_table in starChunks( filename, DYNAMICS_LABELS + list( DYNAMICS_GROUP_LABELS ), chunk_size, cache ):
 
-            if line.strip() == 'data_particles':
-                START_PARSE = True
+            missing = [ label for label in DYNAMICS_LABELS if label not in star_table ]
+            if missing:
+                print( "Error:", filename, "is missing", ' '.join( missing ), ". Exiting now." )
+                sys.exit()
 
-            if START_PARSE:
-                if line.startswith('loop_'):
-                    full_header.append( '' )
-                    full_header.append( line.strip() )
-                if line.startswith('_rln'):
-                    full_header.append( line.strip() )
-                    header_index = int( header_index + 1 )
-                    header.append( line[1:].split()[0] )
+            eulers = starparse.getEulers( star_table )
+            eulerPriors = starparse.getEulerPriors( star_table )
+            originXAngst, originYAngst = starparse.getOffsetsAngst( star_table )
+            originXPriorAngst, originYPriorAngst = starparse.getOffsetPriorsAngst( star_table )
 
-    if 'rlnImageOriginalName' not in header:
-        header.append( 'rlnImageOriginalName' )
-        header_index = int( header_index + 1 )
+            deltaX, deltaY, deltaXY = calculateDeltaXY( originXAngst, originYAngst, originXPriorAngst, originYPriorAngst )
+            deltaPose = np.degrees( calculateDeltaPoseArray( eulers, eulerPriors ) )
 
-        append_this = ''.join( [ '_rlnImageOriginalName #', str(header_index) ] )
+            overall['deltaXY'].update( deltaXY )
+            overall['deltaPose'].update( deltaPose )
 
-        full_header.append( append_this )
+            for label, groups in breakdowns.items():
+                if label in star_table:
+                    updateGroups( groups, star_table[label], deltaXY, deltaPose, xy_range, pose_range )
 
-    return header, full_header
+            num_rows = num_rows + len( star_table )
 
+        print( "  Read", num_rows, "subparticles from", filename )
 
-def getStarData( my_star, header_length ):
-    with open(my_star, "r") as my_star:
-        stardata = []
+    results = { 'all' : { name : runningSummary( statistics ) for name, statistics in overall.items() } }
+    for label, groups in breakdowns.items():
+        results[label] = collections.OrderedDict( [ ( key, { name : runningSummary( statistics ) for name, statistics in group.items() } ) for key, group in sorted( groups.items() ) ] )
 
-        START_PARSE = None      # Needed for relion 3.1 star format
+    printSummaries( results['all']['deltaXY'], results['all']['deltaPose'] )
+    for name in [ 'deltaXY', 'deltaPose' ]:
+        if results['all'][name]['underflow'] or results['all'][name]['overflow']:
+            print( "      ", name, "outside the histogram range:", results['all'][name]['underflow'], "below,", results['all'][name]['overflow'], "above" )
 
-        for line in my_star:
+    for label, description in DYNAMICS_GROUP_LABELS.items():
+        for key, summary in results[label].items():
+            print( "  ", description, key, ":", summary['deltaXY']['count'], "subparticles,",
+                   "deltaXY", np.around( summary['deltaXY']['average'], 2 ), "+/-", np.around( summary['deltaXY']['stdev'], 3 ), "Angstroms,",
+                   "deltaPose", np.around( summary['deltaPose']['average'], 4 ), "+/-", np.around( summary['deltaPose']['stdev'], 4 ), "degrees" )
 
-            if line.strip() == 'data_particles':
-                START_PARSE = True
+    return results
 
-            if START_PARSE:
-                line = ''.join( [ line, 'FILLER' ] )
-                linesplit = line.split()
-                if len( linesplit ) == header_length:
-                    if line[0] != '#':      # avoid the stupid comment line
-                        stardata.append( linesplit )
-    return stardata
+
+def saveSummaries( filename, results ) :
+    """ Summaries from streamProgram as one npz, e.g. Class_3_deltaPose_histogram """
+    arrays = {}
+    for label, groups in results.items():
+        if label == 'all':
+            groups = { None : groups }
+        for key, group in groups.items():
+            for name, summary in group.items():
+                prefix = name if key is None else '_'.join( [ DYNAMICS_GROUP_LABELS[label].replace( ' ', '' ), str( key ), name ] )
+                for item, value in summary.items():
+                    arrays[ '_'.join( [ prefix, item ] ) ] = value
+    np.savez( filename, **arrays )
+
+
+def saveDistributions( filename, results ) :
+    """ Per-subparticle deltas and both summaries, as one npz """
+    arrays = { 'deltaXY' : results['deltaXY'], 'deltaPose' : results['deltaPose'] }
+    for name in [ 'deltaXY', 'deltaPose' ]:
+        for key, value in results[ ''.join( [ name, '_summary' ] ) ].items():
+            arrays[ '_'.join( [ name, key ] ) ] = value
+    np.savez( filename, **arrays )
 
 
 def main(args):
 
-    if args.input.endswith(".star"):
-        filename = args.input
-        header, fullheader = getStarHeader( filename )
-        stardata = getStarData( filename, len( header ) )
-        my_ndarray = np.asarray( stardata, order='C' )
+    if all( [ filename.endswith(".star") for filename in args.input ] ):
+
+        # Add run info to output
+        print( ''.join( [ '# SCRIPT_RUN_DATE: ', str( datetime.now() ) ] ) )
+        print( ''.join( [ '# SCRIPT_VERSION: ', sys.argv[0] ] ) )
+        print( ''.join( [ '# SCRIPT_ARGS: ', ' '.join( sys.argv[1:] ) ] ), "\n" )
+
+        if args.stream or len( args.input ) > 1:
+            results = streamProgram( args.input, xy_range=args.xy_range, pose_range=args.pose_range, cache=args.cache )
+            if args.output:
+                saveSummaries( args.output, results )
+                print( "Wrote summaries to", args.output )
+            sys.exit()
+
+        filename = args.input[0]
+        star_table = starparse.getStarTable( filename, labels=DYNAMICS_LABELS, cache=args.cache )
+        missing = [ label for label in DYNAMICS_LABELS if label not in star_table ]
+        if missing:
+            print( "Error: star file is missing", ' '.join( missing ), ". Exiting now." )
+            sys.exit()
+
+        results = myProgram( star_table )
 
-        myProgram( my_ndarray, header, fullheader )
+        if args.output:
+            saveDistributions( args.output, results )
+            print( "Wrote distributions to", args.output )
     else:
         print( "Please provide a valid input file." )
     sys.exit()
@@ -207,6 +272,11 @@ def main(args):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("input", help="path to locally refined star file")
+    parser.add_argument("input", nargs='+', help="path to locally refined star file(s). More than one implies --stream")
+    parser.add_argument("--stream", action='store_true', help="summarize in chunks with running statistics, per class and vertex group, without holding every delta")
+    parser.add_argument("--xy_range", type=float, nargs=2, default=DYNAMICS_XY_RANGE, help="histogram range for deltaXY with --stream, in Angstroms")
+    parser.add_argument("--pose_range", type=float, nargs=2, default=DYNAMICS_POSE_RANGE, help="histogram range for deltaPose with --stream, in degrees")
+    parser.add_argument("--cache", action='store_true', help="keep a binary copy of parsed star columns next to each input (input.star.cache/) and reuse it while the file is unchanged. With --stream, the first run holds one file's columns in memory to build it.")
+    parser.add_argument("--output", help="optional .npz for per-subparticle deltas, percentiles and histograms. With --stream, summaries only")
     sys.exit(main(parser.parse_args()))
 
@@ -27,6 +27,8 @@ from isecc import starparse
 from isecc import symops
 from isecc import checks
 from isecc import utils
+from isecc import expand
+from isecc import extract
 from isecc.isecc_classes import Particle
 from isecc.isecc_classes import AreaOfInterest
 
@@ -72,37 +74,16 @@ def vertexExpand( particle_index, particle_pose, transformed_pose_array, vertex_
     vertex_table['ExpandQuat'] = I1Quaternions
     vertex_table['OriginalPose'] = particle_pose
 
-    ### Pose of the particle
-    particle_pose = Quaternion( particle_pose )
+    ### Transformed pose for this particle
+    vertex_table['TransformedPose'] = transformed_pose_array
 
-    for index, vertex in enumerate( vertex_table, start=0) :
-
-        ### Transformed pose for this particle
-        transformed_pose_numpy = transformed_pose_array[index]
-        transformed_pose = Quaternion(transformed_pose_array[index])
-        vertex_table[index]['TransformedPose'] = transformed_pose_numpy
-
-        ### Invert for the vector transformation
-        transformed_pose_inverse = transformed_pose.inverse
-
-        ### Transform the vertex vector
-        transformed_vector = np.around( transformed_pose_inverse.rotate( vertex_vector ), decimals=3)
-
-        # Assess whether tranformed point is unique
-        unique_bool = True
-        for loop_index, item in enumerate( vertex_table, start=0) :
-            if np.allclose( transformed_vector, vertex_table[loop_index]['TransformedVector'], rtol=0.1) :
-                unique_bool = False
-
-        # Store the information
-        vertex_table[index]['TransformedVector'] = transformed_vector
-        vertex_table[index]['Unique'] = unique_bool
-
-
-    ### Gather the unique vertices
-    unique_vertex_indices = np.where( vertex_table['Unique'] )[0]
-    unique_vertex_table = vertex_table[ np.where( vertex_table['Unique'] ) ]
+    ### Invert for the vector transformation, then transform the vertex vector. All 60 at once.
+    transformed_pose_inverse = transform.quatInverse( transformed_pose_array )
+    vertex_table['TransformedVector'] = np.around( transform.quatRotate( transformed_pose_inverse, vertex_vector ), decimals=3 )
 
+    # Assess whether tranformed points are unique
+    unique_vertex_indices, vertex_orbit = symops.uniqueOrbit( vertex_table['TransformedVector'], 0.1 * np.amax( np.absolute( vertex_vector ) ) )
+    vertex_table['Unique'][unique_vertex_indices] = True
 
     return vertex_table, unique_vertex_indices
 
@@ -159,48 +140,28 @@ def prepareSubparticleTable( star_array, user_vector, header, ROI ):
         master_table[particle_index]['OriginalPose'] = original_pose_numpy
 
 
-        ### Array that we'll send to vertex determiner
-        transformed_pose_array = np.zeros( (60,4), dtype='<f4' )
-            
-
-        ### Per subparticle values
-        for subparticle_index, subparticle in enumerate(master_table[particle_index]['TransformedPose']):
-
-            ####
-            ## Quaternion/pose
-            ####
-
-            expand_quat = master_table[particle_index]['ExpandQuat'][subparticle_index]
-            expand_quat = Quaternion( expand_quat )
-
-            ### Transformed pose for calculations. Inverse for vector rotation.
-            transformed_pose = expand_quat * original_pose
-            transformed_pose_inverse = transformed_pose.inverse
-
-            ### Transformed pose for master_table
-            transformed_pose_numpy = transformed_pose.elements
-            master_table[particle_index]['TransformedPose'][subparticle_index] = transformed_pose_numpy
-
-            ### Store to send for vertex determination
-            transformed_pose_array[subparticle_index] = transformed_pose_numpy
+        ####
+        ## Quaternion/pose. Transformed pose for all 60 symops at once. Inverse for vector rotation.
+        ####
 
+        expand_quats = master_table[particle_index]['ExpandQuat']
+        transformed_poses = transform.quatMultiply( expand_quats, original_pose_numpy )
+        transformed_poses_inverse = transform.quatInverse( transformed_poses )
 
-            ####
-            ## Transformed user_vector
-            ####
+        ### Transformed pose for master_table. Array that we'll send to vertex determiner.
+        master_table[particle_index]['TransformedPose'] = transformed_poses
+        transformed_pose_array = master_table[particle_index]['TransformedPose']
 
-            transformed_vector = np.around( transformed_pose_inverse.rotate( user_vector ), decimals=3)
 
+        ####
+        ## Transformed user_vector
+        ####
 
-            # Assess whether tranformed point is unique
-            unique_bool = True
-            for loop_index, item in enumerate( master_table[particle_index]['TransformedVector'], start=0) :
-                if np.allclose( transformed_vector, master_table[particle_index]['TransformedVector'][loop_index], rtol=0.01) :
-                    unique_bool = False
+        master_table[particle_index]['TransformedVector'] = np.around( transform.quatRotate( transformed_poses_inverse, user_vector ), decimals=3 )
 
-            # Store the information
-            master_table[particle_index]['TransformedVector'][subparticle_index] = transformed_vector
-            master_table[particle_index]['Unique'][subparticle_index] = unique_bool
+        # Assess whether tranformed points are unique
+        unique_indices, vector_orbit = symops.uniqueOrbit( master_table[particle_index]['TransformedVector'], 0.01 * np.amax( np.absolute( user_vector ) ) )
+        master_table[particle_index]['Unique'][unique_indices] = True
 
 
         ### Determine the vertices
@@ -231,12 +192,10 @@ def prepareSubparticleTable( star_array, user_vector, header, ROI ):
 
 
         this_particle = np.zeros( 60, dtype=my_dtype )
-        for index, item in enumerate(this_particle):
-
-            ### Copy the minimal number of values over to avoid schenanigans
 
-            this_particle[index]['TransformedVector'] = master_table[particle_index]['TransformedVector'][index]
-            this_particle[index]['ExpandQuatIndex'] = master_table[particle_index]['ExpandQuatIndex'][index]
+        ### Copy the minimal number of values over to avoid schenanigans
+        this_particle['TransformedVector'] = master_table[particle_index]['TransformedVector']
+        this_particle['ExpandQuatIndex'] = master_table[particle_index]['ExpandQuatIndex'][:,0]
 
         ####
         ## Nearest vertex
@@ -251,22 +210,15 @@ def prepareSubparticleTable( star_array, user_vector, header, ROI ):
 
 
         ####
-        ## Copy the values back to the real array. Ugly, but it works
+        ## Copy the values back to the real array
         ###
 
-        for index, item in enumerate(this_particle):
-            master_table[particle_index]['Vertex_5f_general'][index] = this_particle[index]['Vertex_5f_general']
-            master_table[particle_index]['Vertex_3f_general'][index] = this_particle[index]['Vertex_3f_general']
-            master_table[particle_index]['Vertex_2f_general'][index] = this_particle[index]['Vertex_2f_general']
+        for field in [ 'Vertex_5f_general', 'Vertex_3f_general', 'Vertex_2f_general', 'Vertex_5f_specific', 'Vertex_3f_specific', 'Vertex_2f_specific' ]:
+            master_table[particle_index][field][:,0] = this_particle[field]
 
-            master_table[particle_index]['Vertex_5f_specific'][index] = this_particle[index]['Vertex_5f_specific']
-            master_table[particle_index]['Vertex_3f_specific'][index] = this_particle[index]['Vertex_3f_specific']
-            master_table[particle_index]['Vertex_2f_specific'][index] = this_particle[index]['Vertex_2f_specific']
+        for field in [ 'Vertex_5f_coords', 'Vertex_3f_coords', 'Vertex_2f_coords' ]:
+            master_table[particle_index][field] = this_particle[field]
 
-            master_table[particle_index]['Vertex_5f_coords'][index] = this_particle[index]['Vertex_5f_coords']
-            master_table[particle_index]['Vertex_3f_coords'][index] = this_particle[index]['Vertex_3f_coords']
-            master_table[particle_index]['Vertex_2f_coords'][index] = this_particle[index]['Vertex_2f_coords']
-            
     if ROI == 'fullexpand':        return master_table, np.arange(0,60)
     elif ROI == 'fivefold':        return master_table, unique_5f_indices
     elif ROI == 'threefold':    return master_table, unique_3f_indices
@@ -327,34 +279,12 @@ def ZZdefineAreaOfInterest(ROI, user_vector, user_fudge, higher_order_sym):
 
 
 def getSymRelatedVertexGroup( index ) :
-    I1_fivefold  = np.array( [0.000, 0.618, 1.000] )
-    I1_threefold = np.array( [0.382, 0.000, 1.000] )
-    I1_twofold   = np.array( [0.000, 0.000, 1.000] )
-
-    current_quaternion = Quaternion( I1Quaternions[index] )
-
-    current_5F = np.around(current_quaternion.rotate( I1_fivefold  ), decimals=3)
-    current_3F = np.around(current_quaternion.rotate( I1_threefold ), decimals=3)
-    current_2F = np.around(current_quaternion.rotate( I1_twofold   ), decimals=3)
+    """ Symops that place the 5f, 3f and 2f vertices where symop index does. Table lookup in the cached group. """
+    I1_group = symops.getSymmetryGroup( 'I1' )
 
-    this_5f_symgroup = list()
-    this_3f_symgroup = list()
-    this_2f_symgroup = list()
-
-    for loop_index, pose in enumerate(I1Quaternions, start=0):
-
-        compare_quaternion = Quaternion( pose )
-
-        rotated_5F = np.around(compare_quaternion.rotate( I1_fivefold  ), decimals=3)
-        rotated_3F = np.around(compare_quaternion.rotate( I1_threefold ), decimals=3)
-        rotated_2F = np.around(compare_quaternion.rotate( I1_twofold   ), decimals=3)
-
-        if np.array_equal( rotated_5F, current_5F  ):    
-            this_5f_symgroup.append( int(loop_index) )
-        if np.array_equal( rotated_3F, current_3F ):    
-            this_3f_symgroup.append( int(loop_index) )
-        if np.array_equal( rotated_2F, current_2F   ):    
-            this_2f_symgroup.append( int(loop_index) )
+    this_5f_symgroup = list( map( int, I1_group.relatedOperators( index, 'fivefold'  ) ) )
+    this_3f_symgroup = list( map( int, I1_group.relatedOperators( index, 'threefold' ) ) )
+    this_2f_symgroup = list( map( int, I1_group.relatedOperators( index, 'twofold'   ) ) )
 
     return this_5f_symgroup, this_3f_symgroup, this_2f_symgroup
 
@@ -377,249 +307,123 @@ def extractRotationAssignment( rotation_assignment ):
 
 
 def returnNearestVertex( expanded_user_vector, expanded_vertex, my_vertex, ROI ):
-
-    ####
-    ## First, make array containing unique vertices as points
-    ####
+    """ Nearest unique vertex for each of the 60 expanded user vectors, and the a/b/c/d/e rotation about it """
+    """ Rotations are read from the group tables rather than found by rotating and comparing points """
 
     if my_vertex == 'fivefold'  :
-        array_size = 12
+        short_vertex = '5f'
         per_vertex = 5
+        rotation_degrees = 72
         rot_designation = np.array(['a','b','c','d','e'], dtype='|S1')
     if my_vertex == 'threefold' :
-        array_size = 20
+        short_vertex = '3f'
         per_vertex = 3
+        rotation_degrees = 120
         rot_designation = np.array(['a','b','c'], dtype='|S1')
     if my_vertex == 'twofold'   :
-        array_size = 30
+        short_vertex = '2f'
         per_vertex = 2
+        rotation_degrees = 180
         rot_designation = np.array(['a','b'], dtype='|S1')
-    
-    my_dtype = np.dtype( [  ( 'VertexNumber', 'i4'),
-                ( 'VertexCoords', '<f4', (3,) ) ] )
-
-    unique_vertices    =  np.zeros( (array_size,), dtype=my_dtype )
-    index = 0
 
-    for vertex in expanded_vertex:
+    general_field  = ''.join( [ 'Vertex_', short_vertex, '_general'  ] )
+    specific_field = ''.join( [ 'Vertex_', short_vertex, '_specific' ] )
+    coords_field   = ''.join( [ 'Vertex_', short_vertex, '_coords'   ] )
 
-        if vertex['Unique'] == True:
-            unique_vertices[index]['VertexNumber'] = index + 1
-            unique_vertices[index]['VertexCoords'] = vertex['TransformedVector'] 
-            index = index + 1
+    I1_group = symops.getSymmetryGroup( 'I1' )
 
     ####
-    ## Now, assess distance between transformed user_vector and unique vertices
+    ## First, make array containing unique vertices as points
     ####
 
-    for point in expanded_user_vector:
-
-        closest_distance = 999
-
-        for vertex in unique_vertices:
+    vertex_indices = np.where( expanded_vertex['Unique'] )[0]
+    vertex_coords  = expanded_vertex['TransformedVector'][vertex_indices]
 
-            distance_check = utils.assess3dDistance( point['TransformedVector'], vertex['VertexCoords'])
-            distance_check = np.around(distance_check, decimals=3)
-            if distance_check < closest_distance:
-                closest_distance = distance_check
-
-                if my_vertex == 'fivefold'  :
-                    point['Vertex_5f_general'] = vertex['VertexNumber']
-                    point['Vertex_5f_coords']  = vertex['VertexCoords']
-
-                if my_vertex == 'threefold' :
-                    point['Vertex_3f_general'] = vertex['VertexNumber']
-                    point['Vertex_3f_coords']  = vertex['VertexCoords']
+    ####
+    ## Now, assess distance between transformed user_vector and unique vertices. First closest wins.
+    ####
 
-                if my_vertex == 'twofold'   :
-                    point['Vertex_2f_general'] = vertex['VertexNumber']
-                    point['Vertex_2f_coords']  = vertex['VertexCoords']
+    points = expanded_user_vector['TransformedVector']
+    distances = np.around( np.linalg.norm( points[:,np.newaxis,:] - vertex_coords[np.newaxis,:,:], axis=2 ), decimals=3 )
+    nearest = np.argmin( distances, axis=1 )
 
+    expanded_user_vector[general_field] = nearest + 1
+    expanded_user_vector[coords_field]  = vertex_coords[nearest]
 
     ####
     ## Finally, assess the vertex rotational assignment
     ####
 
-    assigned_rotations = np.array([])    # Empty array to store list of assigned rotations
-
-    for point_index, point in enumerate( expanded_user_vector, start=0 ):
-
-        if my_vertex == 'fivefold'  :
-            my_unique_vertex = point['Vertex_5f_general']
-            my_vertex_partners = np.where( expanded_user_vector['Vertex_5f_general'] == my_unique_vertex )
-        if my_vertex == 'threefold' :
-            my_unique_vertex = point['Vertex_3f_general']
-            my_vertex_partners = np.where( expanded_user_vector['Vertex_3f_general'] == my_unique_vertex )
-        if my_vertex == 'twofold'   :
-            my_unique_vertex = point['Vertex_2f_general']
-            my_vertex_partners = np.where( expanded_user_vector['Vertex_2f_general'] == my_unique_vertex )
-
-        if not np.isin( point_index, assigned_rotations ):
-
-            ####
-            ## Make subarray containing only this vertex group
-            ####
-
-            sub_array = np.zeros( per_vertex, dtype=expanded_user_vector.dtype )
-            for index, item in enumerate(sub_array):
-                try:
-                    sub_array[index] = expanded_user_vector[ my_vertex_partners[0][index] ]
-                except:
-                    print("Ambiguous Yet Fatal Error. Is your vector roughly equidistant to two or more", ROI, "vertices?" )
-                    print("That would be break ASU addresses. Try shifting your vector a bit.")
-                    sys.exit()
-
-            ####
-            ## Add these points into the assigned rotations group
-            ##   ...we don't want to assign them again
-            ####
-
-            for item in my_vertex_partners[0]:
-                assigned_rotations = np.append( assigned_rotations, item )
-
-
-            # Definitions for the rotation testing
-            if my_vertex == 'fivefold'  :
-                rotation_axis = sub_array[0]['Vertex_5f_coords']
-                rotation_degrees = 72
-            if my_vertex == 'threefold'  :
-                rotation_axis = sub_array[0]['Vertex_3f_coords']
-                rotation_degrees = 120
-            if my_vertex == 'twofold'  :
-                rotation_axis = sub_array[0]['Vertex_2f_coords']
-                rotation_degrees = 180
-
-
-            my_dtype = np.dtype( [  ( 'Point', '<f4', (3,) ),
-                        ( 'Rotation', 'i4' ),
-                        ( 'Designation', '|S1' ) ] )
-
-            rotated_points=np.zeros( (per_vertex), dtype=my_dtype )
-
-
-            rotation_order = np.zeros( len(rot_designation), dtype='|S1' )
-
-            for x in range(0, per_vertex):
-
-                my_rotation = int( rotation_degrees * x )
-                rotation_quaternion = Quaternion(axis=rotation_axis, degrees=my_rotation)
-
-                new_point = rotation_quaternion.rotate(sub_array[0]['TransformedVector'])
-                new_point = np.around(new_point, decimals=3)
-
-                rotated_points[x]['Point']       = new_point
-                rotated_points[x]['Rotation']    = my_rotation
-                rotated_points[x]['Designation'] = rot_designation[x]
+    ### Points sharing a vertex, in symop order. The first of each is rotation 'a'.
+    vertex_ids, first_point, vertex_counts = np.unique( nearest, return_index=True, return_counts=True )
+    if np.any( vertex_counts < per_vertex ):
+        print("Ambiguous Yet Fatal Error. Is your vector roughly equidistant to two or more", ROI, "vertices?" )
+        print("That would be break ASU addresses. Try shifting your vector a bit.")
+        sys.exit()
 
+    by_vertex = np.argsort( nearest, kind='mergesort' )
+    rank = np.empty( len( nearest ), dtype=int )
+    rank[by_vertex] = np.arange( len( nearest ) ) - np.repeat( np.cumsum( vertex_counts ) - vertex_counts, vertex_counts )
 
-            for x in range(0, per_vertex):
+    group_position = np.searchsorted( vertex_ids, nearest )
+    expand_index = expanded_user_vector['ExpandQuatIndex']
+    first_index = expand_index[ first_point[group_position] ]
 
-                for y in range(0, per_vertex):
+    ### Operator taking the first point of the group to this one, i.e. inverse(symop) * first symop
+    relative_quats = I1_group.quaternions[ I1_group.multiplication_table[ I1_group.inverse[expand_index], first_index ] ]
 
-                    if np.allclose( sub_array[x]['TransformedVector'], rotated_points[y]['Point'], atol=1):
+    ### This vertex in the frame of the group. Sets the handedness of the rotation about it.
+    vertex_symops = vertex_indices[nearest]
+    group_vertex = np.matmul( I1_group.rotation_matrices[ I1_group.inverse[vertex_symops] ], I1_group.axes[my_vertex] )
 
-                        # atol allows up to 1 angstrom math error
-                        rotation_order[x] = rot_designation[y]
+    sine = np.linalg.norm( relative_quats[:,1:], axis=1 )
+    handedness = np.where( np.sum( relative_quats[:,1:] * group_vertex, axis=1 ) < 0, -1, 1 )
+    relative_degrees = np.degrees( 2 * np.arctan2( sine, relative_quats[:,0] ) ) * handedness
+    rotation_order = np.mod( np.rint( relative_degrees / rotation_degrees ).astype(int), per_vertex )
 
-        ####
-        ## Now just need to apply these to expanded_user_vector
-        ## Store them in sub_array, then copy to expanded_user_vector
-        ####
+    ### Near the vertex axis several rotations of the first point land within 1 A of this one.
+    ### Those were given the last designation that matched, so keep that rule there.
+    rotation_axis = vertex_coords[nearest] / np.linalg.norm( vertex_coords[nearest], axis=1, keepdims=True )
+    half_angles = np.radians( rotation_degrees * np.arange( per_vertex ) / 2.0 )
+    axis_quats = np.concatenate( [ np.broadcast_to( np.cos( half_angles )[np.newaxis,:,np.newaxis], ( len(points), per_vertex, 1 ) ),
+                                   np.sin( half_angles )[np.newaxis,:,np.newaxis] * rotation_axis[:,np.newaxis,:] ], axis=-1 )
+    first_points = points[ first_point[group_position] ]
+    rotated_points = np.around( transform.quatRotate( axis_quats, first_points[:,np.newaxis,:] ), decimals=3 )
+    matches = np.all( np.isclose( points[:,np.newaxis,:], rotated_points, atol=1 ), axis=-1 )
 
-        for z in range(0, len(sub_array) ):
+    ambiguous = np.sum( matches, axis=1 ) > 1
+    last_match = per_vertex - 1 - np.argmax( matches[:,::-1], axis=1 )
+    rotation_order[ambiguous] = last_match[ambiguous]
 
-            if my_vertex == 'fivefold'  :
-                sub_array[z]['Vertex_5f_specific'] = rotation_order[z]
-            if my_vertex == 'threefold'  :
-                sub_array[z]['Vertex_3f_specific'] = rotation_order[z]
-            if my_vertex == 'twofold'  :
-                sub_array[z]['Vertex_2f_specific'] = rotation_order[z]
-
-            insert_where = np.where( expanded_user_vector['ExpandQuatIndex'] == sub_array[z]['ExpandQuatIndex'] )
-            insert_here = insert_where[0][0]
-
-            expanded_user_vector[insert_here] = sub_array[z]
+    specific = rot_designation[rotation_order]
+    specific[ rank >= per_vertex ] = b''
+    expanded_user_vector[specific_field] = specific
 
     return expanded_user_vector
 
 
-### Generate array containing I1 rotations ready for pyQuaternion in format [ a, bi, cj, dk ]
 I1Quaternions = symops.getSymOps()
 
 
 
-def defineSubparticles( my_ndarray, ROI, user_vector, user_fudge, user_subbox, higher_order_sym, user_testmode, user_batch_size, header, fullheader, RUN_ID, regen_string, user_batch=None ) :
-
-    print( '\nInitializing.' )
-    print( '  Note: Sign of local defocus adjustment has been corrected as of 20 Dec 2019.' )
-
-    """ Intercept user_vector and return idealized_vector within desired asymmetric unit. """
-    """ This is essential for proper nearest_vertex assignment. """
-    user_vector = checks.idealizeUserVector( user_vector, ROI )
-
-    checks.checkVector(user_vector, ROI, higher_order_sym)
-
-
-    """ Testmode generates 10k subparticles from a random subset of particles """
-    if user_testmode:
-        my_ndarray = utils.random_subsample( my_ndarray , ROI)
-
-    """ Keep unaltered version of original values """
-    pristine = my_ndarray.copy(order='C')
-    total_particles = len(pristine)
-
-    """ Get parameters for requested symmetry operation """
-    expand_params = AreaOfInterest( ROI, user_vector )
-    expand_params.apply_fudge( user_fudge )
-
-    """ Stupid assignments """
-    my_vector = expand_params.vector
-    model_sym = expand_params.model_sym
-    short_roi = expand_params.short_roi
+def legacyExpand( pristine, header, symops, quatZ, my_vector, vertex_groups, RUN_ID, BATCH_MODE=None, batch_size=None ) :
+    """ Original per-particle expansion using the Particle class. Yields ( symop index, star array ) per symop. """
+    """ Kept for validation of the vectorized engine in isecc.expand """
 
     """ Parse star file header """
     rot_index, tilt_index, psi_index = starparse.getEulers( header )
     originXAngst_index, originYAngst_index = starparse.getOffsetAngst( header )
     defocusU_index, defocusV_index, defocusAngle_index = starparse.getDefocus( header )
-    class_index = starparse.getClass( header )
     micrographname_index, imagename_index, particleID_index = starparse.getMicrographName( header )
     uid_index = starparse.getUID( header )
     vertexGroup_index = starparse.getVertexGroup( header )
     OriginXYZAngstWrtParticleCenter_index = starparse.getOriginXYZAngstWrtParticleCenter( header )
     relativePose_index = starparse.getCustomRelativePose( header )
 
-
-    BATCH_MODE = None
-    if user_batch == True:
-        BATCH_MODE = True
-        batch_size = user_batch_size
-        print( "  Note: Batch mode will be used to speed subparticle generation in relion." )
-        print( "  Note: Requested batch size is", batch_size, "\n" )
-
     ## Initialize subparticle index at 0. Will be used to generate subparticle UID
     subparticle_index = 0
 
 
-    ####
-    ## Generate vertex assignments from a single particle.
-    ## These will then be applied to all particles.
-    ## Any given symop will always result in the same vertex assignment.
-    ####
-
-    vertex_check_array = pristine[0:1]
-
-    """ Fetch the indices for non-redundant symmetry operations """
-    if (expand_params.roi == 'fivefold') or (expand_params.roi == 'threefold') or (expand_params.roi == 'twofold') or (expand_params.roi == 'fullexpand'):
-        master_array, unique_indices = prepareSubparticleTable( vertex_check_array, user_vector, header, ROI )
-    else:
-        """ when roi is null """
-        master_array = prepareSubparticleTable( vertex_check_array, user_vector, header, ROI )
-        unique_indices = np.arange(1)
-
-    """ Update to use only the unique symmetry operations """
-    expand_params.updateSymIndices( unique_indices )
-    symops = I1Quaternions[ expand_params.symindices ]
-
     # Start iterating through the star file
     for index, symop in enumerate(symops, start=0):        # Iterate over all symmetry ops
 
@@ -631,7 +435,7 @@ def defineSubparticles( my_ndarray, ROI, user_vector, user_fudge, user_subbox, h
 
         """ Format items for the current symop """
         relativePose_string = str(symop_quat).strip().replace(" ", ",")
-        my_vertexGroup = formatVertexAssignment( master_array[0], expand_params.symindices[index], ROI )
+        my_vertexGroup = vertex_groups[index]
 
         """ Inform user of progress """
         print( "  Applying symmetry rotation", symop_quat, "  (", index+1, "of", len(symops), ") (", my_vertexGroup, ")"  )
@@ -679,7 +483,7 @@ def defineSubparticles( my_ndarray, ROI, user_vector, user_fudge, user_subbox, h
 
             """ Rotate Particle, define subparticles """
             my_quat = particle.pose
-            particle.rotateParticle( symop_quat, expand_params.quatZ )
+            particle.rotateParticle( symop_quat, quatZ )
             particle.defineSubparticle( my_vector )
 
             """ Assign for writing to star file """
@@ -708,26 +512,91 @@ def defineSubparticles( my_ndarray, ROI, user_vector, user_fudge, user_subbox, h
             """ Increment subparticle index """
             subparticle_index = subparticle_index + 1
 
-        if index == 0:
-            expanded_star = my_ndarray.copy(order='C')
-        if index != 0:
-            expanded_star = np.concatenate( ( expanded_star, my_ndarray ) ,axis=0)
+        """ Hand back each symop block rather than growing one array """
+        yield index, my_ndarray
+
+
+def defineSubparticles( my_ndarray, ROI, user_vector, user_fudge, user_subbox, higher_order_sym, user_testmode, user_batch_size, header, fullheader, RUN_ID, regen_string, user_batch=None, user_engine='vectorized', user_chunk_size=None, user_jobs=1, user_extractor='native' ) :
+
+    print( '\nInitializing.' )
+    print( '  Note: Sign of local defocus adjustment has been corrected as of 20 Dec 2019.' )
+
+    """ Intercept user_vector and return idealized_vector within desired asymmetric unit. """
+    """ This is essential for proper nearest_vertex assignment. """
+    user_vector = checks.idealizeUserVector( user_vector, ROI )
 
+    checks.checkVector(user_vector, ROI, higher_order_sym)
 
-    ### end loop through the symmetry-operators
 
-    """ Write star file, begin operations in relion """
+    """ Testmode generates 10k subparticles from a random subset of particles """
+    if user_testmode:
+        my_ndarray = utils.random_subsample( my_ndarray , ROI)
+
+    """ Keep unaltered version of original values """
+    pristine = my_ndarray.copy(order='C')
+    total_particles = len(pristine)
 
-    ### Prepare the output star file
+    """ Get parameters for requested symmetry operation """
+    expand_params = AreaOfInterest( ROI, user_vector )
+    expand_params.apply_fudge( user_fudge )
+
+    """ Stupid assignments """
+    my_vector = expand_params.vector
+    model_sym = expand_params.model_sym
+    short_roi = expand_params.short_roi
+
+    BATCH_MODE = None
+    batch_size = None
+    if user_batch == True:
+        BATCH_MODE = True
+        batch_size = user_batch_size
+        print( "  Note: Batch mode will be used to speed subparticle generation in relion." )
+        print( "  Note: Requested batch size is", batch_size, "\n" )
+
+
+    ####
+    ## Generate vertex assignments from a single particle.
+    ## These will then be applied to all particles.
+    ## Any given symop will always result in the same vertex assignment.
+    ####
+
+    vertex_check_array = pristine[0:1]
+
+    """ Fetch the indices for non-redundant symmetry operations """
+    if (expand_params.roi == 'fivefold') or (expand_params.roi == 'threefold') or (expand_params.roi == 'twofold') or (expand_params.roi == 'fullexpand'):
+        master_array, unique_indices = prepareSubparticleTable( vertex_check_array, user_vector, header, ROI )
+    else:
+        """ when roi is null """
+        master_array = prepareSubparticleTable( vertex_check_array, user_vector, header, ROI )
+        unique_indices = np.arange(1)
+
+    """ Update to use only the unique symmetry operations """
+    expand_params.updateSymIndices( unique_indices )
+    symops = I1Quaternions[ expand_params.symindices ]
+
+    vertex_groups = [ formatVertexAssignment( master_array[0], sym_index, ROI ) for sym_index in expand_params.symindices ]
+
+    ### Prepare the output star file, write the particles to it
     filename = ''.join( [ ROI, 'subparticle_alignments.star' ])
-    f = open( filename, 'w' )
-    np.savetxt( f, fullheader, delimiter=' ', fmt="%s" )
+
+    if user_engine == 'legacy':
+        blocks = legacyExpand( pristine, header, symops, expand_params.quatZ, my_vector, vertex_groups, RUN_ID, BATCH_MODE, batch_size )
+    elif user_jobs > 1:
+        print( "  Note: Subparticles will be defined using", user_jobs, "processes.\n" )
+        blocks = expand.expandSubparticlesParallel( pristine, header, symops, expand_params.quatZ, my_vector, vertex_groups, RUN_ID, batch_size, user_chunk_size, user_jobs )
+    else:
+        blocks = expand.expandSubparticles( pristine, header, symops, expand_params.quatZ, my_vector, vertex_groups, RUN_ID, batch_size, user_chunk_size )
+
+    ### Blocks are streamed to disk in output order, so cost is linear in the number of symops
+    f = starparse.openStarFile( filename, fullheader )
+    previous_index = None
+    for index, block in blocks:
+        if ( user_engine != 'legacy' ) and ( index != previous_index ):
+            print( "  Applying symmetry rotation", Quaternion( symops[index] ), "  (", index+1, "of", len(symops), ") (", vertex_groups[index], ")"  )
+        previous_index = index
+        starparse.writeStarRows( f, block )
     f.close()
 
-    ### Write the particles to the star file
-    f = open( filename, 'a' )
-    np.savetxt( f, expanded_star, delimiter=' ', fmt="%s")
-    f.close()    
 
     ### DEBUG
     print( '\nWrote', filename )
@@ -753,48 +622,56 @@ def defineSubparticles( my_ndarray, ROI, user_vector, user_fudge, user_subbox, h
         input = fullstar
 
 
-    ## This step recenters on subparticle origins
-    cmd = ''.join( ['relion_stack_create --i ', input, ' --o ', ROI, ' --apply_rounded_offsets_only --split_per_micrograph > /dev/null' ] )
-    print( "Executing command:", cmd )
-    print( "\n  NOTE: This will take some time..." )
-    utils.slowPrint( str('             ...isn\'t it a nice day for a bike ride?') )
-    os.system( cmd )
+    if user_extractor == 'native':
+        ## Recenter on the rounded subparticle origins and crop to the final box in one step
+        print( "\nExtracting subparticles at box size", user_subbox )
+        print( "\n  NOTE: This will take some time..." )
+        utils.slowPrint( str('             ...isn\'t it a nice day for a bike ride?') )
+        filename = extract.extractSubparticles( input, fullheader, ROI, user_subbox )
 
-    new_box = str(user_subbox)
-    cmd = ''.join( [ 'relion_image_handler --i ', ROI,'.star --o subpart --new_box ', new_box ] )
-    print( "\nExecuting command:", cmd )
-    os.system( cmd )
+    else:
+        ## This step recenters on subparticle origins
+        cmd = ''.join( ['relion_stack_create --i ', input, ' --o ', ROI, ' --apply_rounded_offsets_only --split_per_micrograph > /dev/null' ] )
+        print( "Executing command:", cmd )
+        print( "\n  NOTE: This will take some time..." )
+        utils.slowPrint( str('             ...isn\'t it a nice day for a bike ride?') )
+        os.system( cmd )
 
+        new_box = str(user_subbox)
+        cmd = ''.join( [ 'relion_image_handler --i ', ROI,'.star --o subpart --new_box ', new_box ] )
+        print( "\nExecuting command:", cmd )
+        os.system( cmd )
 
-    ### Add comments to roi_subpart.star file
-    filename = ''.join( [ ROI, '_subpart.star' ] )
-    file_comments = fullheader[:3]
-    ### Add info for how to regenerate subparticles
-    if '--timestamp_run' not in file_comments[2] :
-        file_comments[2] = ' '.join( [ file_comments[2], '--timestamp_run', regen_string ] )
-    new_filename = ''.join( [ ROI, '_subpart.star.temp' ] )
-
-    f = open( new_filename, 'w' )
-    np.savetxt( f, file_comments, delimiter=' ', fmt="%s" )
-    f.close()
 
-    cmd = ' '.join( [ 'cat', filename, ">>", new_filename ] )
-    os.system( cmd )
-    cmd = ' '.join( [ 'mv', new_filename, filename ] )
-    os.system( cmd )
-#    filename = new_filename
+        ### Add comments to roi_subpart.star file
+        filename = ''.join( [ ROI, '_subpart.star' ] )
+        file_comments = fullheader[:3]
+        ### Add info for how to regenerate subparticles
+        if '--timestamp_run' not in file_comments[2] :
+            file_comments[2] = ' '.join( [ file_comments[2], '--timestamp_run', regen_string ] )
+        new_filename = ''.join( [ ROI, '_subpart.star.temp' ] )
 
+        f = open( new_filename, 'w' )
+        np.savetxt( f, file_comments, delimiter=' ', fmt="%s" )
+        f.close()
 
-    ## Delete whole particle images
-    ## Example path is fivefold_subparticles/fivefold/particle000000001.mrcs
-    if BATCH_MODE:
-        particle_files = ''.join( [ ROI, '_subparticles/', RUN_ID, '/Micrographs/batch??????.mrcs' ] )
-    else:
-        particle_files = ''.join( [ ROI, '_subparticles/', RUN_ID, '/Micrographs/particle?????????.mrcs' ] )
+        cmd = ' '.join( [ 'cat', filename, ">>", new_filename ] )
+        os.system( cmd )
+        cmd = ' '.join( [ 'mv', new_filename, filename ] )
+        os.system( cmd )
+#        filename = new_filename
 
-    cmd = ''.join( ['rm ', particle_files ] )
-    print( "Executing command:", cmd )
-    os.system( cmd )
+
+        ## Delete whole particle images
+        ## Example path is fivefold_subparticles/fivefold/particle000000001.mrcs
+        if BATCH_MODE:
+            particle_files = ''.join( [ ROI, '_subparticles/', RUN_ID, '/Micrographs/batch??????.mrcs' ] )
+        else:
+            particle_files = ''.join( [ ROI, '_subparticles/', RUN_ID, '/Micrographs/particle?????????.mrcs' ] )
+
+        cmd = ''.join( ['rm ', particle_files ] )
+        print( "Executing command:", cmd )
+        os.system( cmd )
 
 
     ## Make initial model star file from 1st 10k lines of ROI_subpart.star
@@ -849,6 +726,8 @@ def defineSubparticles( my_ndarray, ROI, user_vector, user_fudge, user_subbox, h
     to_move = np.array( [filename, filename_PRIOR, initialmodel_mrc, initialmodel_star, roi_star, roi_alignments ] )
 
     for file in to_move :
+        if not os.path.exists( file ):
+            continue        # e.g. ROI.star, which only relion_stack_create writes
         cmd = ' '.join( [ 'mv', file, job_directory ] )
         os.system( cmd )
     if user_testmode:
@@ -884,10 +763,8 @@ def main(args):
 
     if args.input.endswith(".star"):
         filename = args.input
-        header, fullheader = starparse.getStarHeader( filename, regen_string )
-        stardata = starparse.getStarData( filename, len( header ) )
-        my_ndarray = np.asarray( stardata, order='C' )
-        defineSubparticles(  my_ndarray, args.roi, np.array(args.vector), args.fudge, args.subpart_box, args.supersym, user_testmode, args.batchsize, header, fullheader, RUN_ID, regen_string, user_batch )
+        header, fullheader, my_ndarray, optics = starparse.getStarFile( filename, regen_string, cache=args.cache )
+        defineSubparticles(  my_ndarray, args.roi, np.array(args.vector), args.fudge, args.subpart_box, args.supersym, user_testmode, args.batchsize, header, fullheader, RUN_ID, regen_string, user_batch, args.engine, args.chunk_size, args.jobs, args.extractor )
     else:
         print( "Please provide a valid input file." )
     sys.exit()
@@ -906,6 +783,11 @@ if __name__ == "__main__":
     parser.add_argument("--batch", choices=['true', 'false'], type=str.lower, default='true', help="relion will process in batches rather than per-particle")
     parser.add_argument("--batchsize", type=int, default=3000)
     parser.add_argument("--testmode", choices=['true', 'false'], type=str.lower, default='false', help="Generate ~10k subparticles so you can verify settings by inspecting the initial model")
+    parser.add_argument("--engine", choices=['vectorized', 'legacy'], type=str.lower, default='vectorized', help="legacy uses the original per-particle loop")
+    parser.add_argument("--chunk_size", type=int, required=False, help="Pose this many particles at a time. Bounds memory use, e.g. for fullexpand on very large datasets.")
+    parser.add_argument("--jobs", type=int, default=1, help="number of processes used to define subparticles. Output is identical to a serial run.")
+    parser.add_argument("--extractor", choices=['native', 'relion'], type=str.lower, default='native', help="relion uses relion_stack_create and relion_image_handler, writing full-size intermediate stacks")
+    parser.add_argument("--cache", action='store_true', help="keep a binary copy of parsed star columns next to each input (input.star.cache/) and reuse it while the file is unchanged")
     parser.add_argument("--timestamp_run", type=str, required=False, help="Allows you to re-create subparticles from a previous run of the script. Manually sets the timestamp string in the output path.")
     sys.exit(main(parser.parse_args()))
 
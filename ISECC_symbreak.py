@@ -22,6 +22,7 @@ import math
 import numpy as np
 from pyquaternion import Quaternion
 from datetime import datetime
+from isecc import starparse
 
 
 def idealizeUserVector( user_vector, ROI ) :
@@ -716,59 +717,6 @@ def getStarData( my_star, header_length, header ):
         return stardata
 
 
-def getMinimalStarData( my_star, subparticle_header, subparticle_header_length, num_particles ):
-
-        my_dtype = np.dtype( [  ( 'ParticleImageName', 'U200'),
-                                ( 'Class', '<i4' ),
-                                ( 'EulerRot', '<f4' ), ( 'EulerTilt', '<f4' ), ( 'EulerPsi', '<f4' ) ] ) 
-            
-        minimal_subparticle_array    =  np.zeros( ( (num_particles * 60),), dtype=my_dtype ) 
-        subparticle_index = 0
-
-        ## This function should only return class and eulers
-        rot_indexSP, tilt_indexSP, psi_indexSP = getEulers( subparticle_header )
-        class_indexSP = getClass( subparticle_header )
-        micrographname_indexSP, imagename_indexSP, particleID_indexSP = getMicrographName( subparticle_header )
-    
-        with open(my_star, "r") as my_star:
-                stardata = []
-
-                START_PARSE = None      # Needed for relion 3.1 star format
-
-                for line in my_star:
-
-                        if line.strip() == 'data_particles':
-                                START_PARSE = True
-
-                        if START_PARSE:
-
-                                linesplit = line.split()
-
-                                if len( linesplit ) > 4:    # get beyond the metadata labels
-
-                                    line = ' '.join( [ linesplit[particleID_indexSP], linesplit[class_indexSP], linesplit[rot_indexSP], linesplit[tilt_indexSP], linesplit[psi_indexSP] ] )
-
-                                    if line[0] != '#':      # avoid the stupid comment line
-                                        stardata.append( line )
-
-                                        minimal_subparticle_array[subparticle_index]['ParticleImageName'] = linesplit[particleID_indexSP] 
-                                        minimal_subparticle_array[subparticle_index]['Class']     = linesplit[ class_indexSP ]
-                                        minimal_subparticle_array[subparticle_index]['EulerRot']  = linesplit[ rot_indexSP   ]
-                                        minimal_subparticle_array[subparticle_index]['EulerTilt'] = linesplit[ tilt_indexSP  ]
-                                        minimal_subparticle_array[subparticle_index]['EulerPsi']  = linesplit[ psi_indexSP   ]
-
-                                        subparticle_index = subparticle_index + 1
-
-        print( "  --> sorting based on particle image name." )
-        minimal_subparticle_array.sort(order='ParticleImageName')
-        print( "  --> done!" )
-
-#        sys.exit()
-
-        return minimal_subparticle_array
-
-
-
 def getApix( header ):
         det_pixelsize_index= header.index('rlnDetectorPixelSize')
         mag_index = header.index('rlnMagnification')
@@ -1112,21 +1060,23 @@ I1Quaternions = np.array(   [   [ 1.000, 0.000, 0.000, 0.000 ],    [ 0.000, 1.00
                                 [ 0.000, 0.309, 0.809, 0.500 ],    [ 0.000, -0.309, 0.809, -0.500 ],
                                 [ 0.000, 0.500, -0.309, 0.809 ],   [ 0.000, 0.000, 1.000, 0.000 ]     ]    )
 
-def doSymbreak( particle_ndarray, particle_header, particle_fullheader, subparticle_ndarray ) :
+def joinSubparticles( particle_ids, subparticle_ids ):
+        """ Sort-merge join on interned particle image name. subparticle_ids must already be sorted. """
+        """ Returns the first subparticle row, and the number of subparticles, for each particle. """
+        first_child = np.searchsorted( subparticle_ids, particle_ids, side='left' )
+        last_child  = np.searchsorted( subparticle_ids, particle_ids, side='right' )
 
-        print( '\nInitializing.' )
+        return first_child, last_child - first_child
 
-        #### Keep unaltered version of original values
-        pristineP = particle_ndarray.copy(order='C')
-        pristineSP = subparticle_ndarray.copy(order='C')
 
-        total_particles = len(pristineP)
-        total_subparticles = total_particles * 60
+def doSymbreak( particle_ndarray, particle_header, particle_fullheader, subparticle_ndarray, name_ids, select_class=None ) :
+
+        print( '\nInitializing.' )
+
+        total_particles = len(particle_ndarray)
 
         ### Parse particle star file
         rot_indexP, tilt_indexP, psi_indexP = getEulers( particle_header )
-        originXAngst_indexP, originYAngst_indexP = getOffsetAngst( particle_header )
-        defocusU_indexP, defocusV_indexP, defocusAngle_indexP = getDefocus( particle_header )
         class_indexP = getClass( particle_header )
         micrographname_indexP, imagename_indexP, particleID_indexP = getMicrographName( particle_header )
         uid_indexP = getUID( particle_header )
@@ -1134,68 +1084,71 @@ def doSymbreak( particle_ndarray, particle_header, particle_fullheader, subparti
         OriginXYZAngstWrtParticleCenter_indexP = getOriginXYZAngstWrtParticleCenter( particle_header )
         relativePose_indexP = getCustomRelativePose( particle_header )
 
-        ## Initialize subparticle index at 0. Will be used to generate subparticle UID
-        subparticle_index = 0
-       
-        subpart_per_particle = int( np.true_divide( total_subparticles, total_particles ) )
-
 
         ## Sort the particle array by image name
         print( "  Sorting particle array by particle image name." )
-#        print( "  Original item 568:", particle_ndarray[568][imagename_indexP] )
         particle_ndarray = particle_ndarray[ particle_ndarray[:,imagename_indexP].argsort()]
-#        print( "  Sorted item   568:", particle_ndarray[568][imagename_indexP] )
         print( "  --> done!\n" )
 
+        ## Subparticles of each particle, joined on particle image name. Unknown names get no subparticles.
+        particle_ids = np.array( [ name_ids.get( name, -1 ) for name in particle_ndarray[:,imagename_indexP] ], dtype=np.int64 )
+        first_child, num_children = joinSubparticles( particle_ids, subparticle_ndarray['ParticleID'] )
+        if np.any( num_children == 0 ):
+                print( "  Note:", np.sum( num_children == 0 ), "particles have no subparticles and will not be written." )
 
-        print( "Looping through all particles and subparticles." )
-        slowPrint( "  --> Back-applying eulers and classes to parent particles.\n" )
+        ### Blank out placeholder values. Remnants of an earlier script
+        columns = list( particle_ndarray.T )
+        for blank_index in [ relativePose_indexP, OriginXYZAngstWrtParticleCenter_indexP, vertexGroup_indexP, particleID_indexP, uid_indexP ]:
+                columns[blank_index] = ""
 
-        ## We need to copy the subparticle Eulers over the particle Eulers
-        ## We also need the class
-        for outer_index in range(0, subpart_per_particle):          # 0 thru 59
+        ### Make the file, add the header
+        filename = ''.join( [ 'symbreak', '.star' ])
+        f = starparse.openStarFile( filename, particle_fullheader )
 
-                ## Loop through all the particles
-                for particle_index in range(0, total_particles):    # 0 thru max particle number
+        if select_class:
+                ### Only the first subparticle in the selected class, one row per particle
+                print( "Writing the class", select_class, "subparticle of each particle." )
+                in_class = np.where( subparticle_ndarray['Class'] == select_class )[0]
+                first_in_class, num_in_class = joinSubparticles( particle_ids, subparticle_ndarray['ParticleID'][in_class] )
 
-                    subparticle_index = ( 60 * particle_index ) + outer_index
-                    this_subpart = subparticle_index
+                has_variant = num_in_class > 0
+                this_subpart = in_class[ first_in_class[has_variant] ]
+                writeSymbreakBlock( f, columns, has_variant, this_subpart, subparticle_ndarray, class_indexP, rot_indexP, tilt_indexP, psi_indexP )
 
-#                    print( subparticle_index )
+                print( " ", np.sum( has_variant ), "of", total_particles, "particles have a subparticle in class", select_class )
 
-#                    child_subparticles = np.where( subparticle_ndarray['ParticleImageName'] == particle_ndarray[particle_index][imagename_indexP] )
+        else:
+                print( "Writing all symmetry-broken variants of each particle." )
+                slowPrint( "  --> Back-applying eulers and classes to parent particles.\n" )
 
-#                    print( child_subparticles )
+                ## We need to copy the subparticle Eulers over the particle Eulers
+                ## We also need the class. All particles at once for each variant.
+                for outer_index in range( 0, np.amax( num_children, initial=0 ) ):          # 0 thru 59
 
-                    ### Assign values from child to parent ###
-                    particle_ndarray[particle_index][class_indexP ] = subparticle_ndarray[this_subpart]['Class'] 
-                    particle_ndarray[particle_index][rot_indexP ] = subparticle_ndarray[this_subpart]['EulerRot'] 
-                    particle_ndarray[particle_index][tilt_indexP] = subparticle_ndarray[this_subpart]['EulerTilt'] 
-                    particle_ndarray[particle_index][psi_indexP ] = subparticle_ndarray[this_subpart]['EulerPsi'] 
+                        has_variant = num_children > outer_index
+                        this_subpart = first_child[has_variant] + outer_index
+                        writeSymbreakBlock( f, columns, has_variant, this_subpart, subparticle_ndarray, class_indexP, rot_indexP, tilt_indexP, psi_indexP )
 
-                    ### Blank out placeholder values. Remnants of an earlier script
-                    particle_ndarray[particle_index][ relativePose_indexP ] = ""
-                    particle_ndarray[particle_index][ OriginXYZAngstWrtParticleCenter_indexP ] = ""
-                    particle_ndarray[particle_index][ vertexGroup_indexP ] = ""
-                    particle_ndarray[particle_index][ particleID_indexP ] = ""
-                    particle_ndarray[particle_index][ uid_indexP ] = ""
+                        if len( this_subpart ) > 0:
+                                print( 'Iteration:', outer_index )
+                                print( '  Particle: 0 :', subparticle_ndarray[this_subpart[0]]['Class'], subparticle_ndarray[this_subpart[0]]['EulerRot'], subparticle_ndarray[this_subpart[0]]['EulerTilt'], subparticle_ndarray[this_subpart[0]]['EulerPsi'] )
 
+        f.close()
 
-                    if ( particle_index == 0 ) :
-                        print( 'Iteration:', outer_index )
-                        print( '  Particle:', particle_index, ':', particle_ndarray[particle_index][class_indexP ], particle_ndarray[particle_index][rot_indexP ], particle_ndarray[particle_index][tilt_indexP ], particle_ndarray[particle_index][psi_indexP ]  )
+        return
 
-                ### Make the file, add the header, only once per run
-                if outer_index == 0:
-                        filename = ''.join( [ 'symbreak', '.star' ])
-                        f = open( filename, 'w' )
-                        np.savetxt( f, particle_fullheader, delimiter=' ', fmt="%s" )
-                        f.close()
 
-                ### Write current batch of particles to the star file each iteration
-                f = open( filename, 'a' )       # open in append mode
-                np.savetxt( f, particle_ndarray, delimiter=' ', fmt="%s")
-                f.close()       
+def writeSymbreakBlock( f, columns, has_variant, this_subpart, subparticle_ndarray, class_indexP, rot_indexP, tilt_indexP, psi_indexP ):
+        """ Write the particles in has_variant, with class and Eulers from rows this_subpart of subparticle_ndarray """
+        block = [ column if np.ndim( column ) == 0 else column[has_variant] for column in columns ]
+
+        ### Assign values from child to parent ###
+        block[class_indexP] = subparticle_ndarray['Class'][this_subpart]
+        block[rot_indexP ]  = subparticle_ndarray['EulerRot'][this_subpart]
+        block[tilt_indexP]  = subparticle_ndarray['EulerTilt'][this_subpart]
+        block[psi_indexP ]  = subparticle_ndarray['EulerPsi'][this_subpart]
+
+        starparse.writeStarRows( f, block )
 
         return
 
@@ -1205,24 +1158,31 @@ def main(args):
         if args.particle_file.endswith(".star"):
                 print( "  Parsing particle star file." )
                 particle_filename = args.particle_file
-                particle_header, particle_fullheader = getStarHeader( particle_filename )
-                particle_stardata = getStarData( particle_filename, len( particle_header ), particle_header )
-                particle_ndarray = np.asarray( particle_stardata, order='C' )
+                if args.cache:
+                        particle_header, particle_fullheader, particle_ndarray, optics = starparse.getStarFile( particle_filename, cache=True )
+                else:
+                        particle_header, particle_fullheader = getStarHeader( particle_filename )
+                        particle_stardata = getStarData( particle_filename, len( particle_header ), particle_header )
+                        particle_ndarray = np.asarray( particle_stardata, order='C' )
 
                 num_particles = ( len(particle_ndarray) )
 
         if args.subparticle_file.endswith(".star"):
                 print( "  Parsing subparticle star file." )
                 subparticle_filename = args.subparticle_file
-                subparticle_header, subparticle_fullheader = getStarHeader( subparticle_filename )
+                if args.cache:
+                        ### Labels come from the sidecar, so the header need not be read
+                        subparticle_header = None
+                else:
+                        subparticle_header, subparticle_fullheader = getStarHeader( subparticle_filename )
                 print( "  --> done!" )
                 print( "  Making ndarray with minimal necessary items." )
-                subparticle_ndarray = getMinimalStarData( subparticle_filename, subparticle_header, len( subparticle_header ), num_particles )
+                subparticle_ndarray, name_ids = starparse.getMinimalStarData( subparticle_filename, subparticle_header, cache=args.cache )
 
         else:
                 print( "Please provide valid input files." )
 
-        doSymbreak( particle_ndarray, particle_header, particle_fullheader, subparticle_ndarray )
+        doSymbreak( particle_ndarray, particle_header, particle_fullheader, subparticle_ndarray, name_ids, args.select_class )
 
         return 0
 
@@ -1231,5 +1191,7 @@ if __name__ == "__main__":
         parser = argparse.ArgumentParser()
         parser.add_argument("--particle_file", type=str, required=True)
         parser.add_argument("--subparticle_file", type=str, required=True)
+        parser.add_argument("--select_class", type=int, required=False, help="only write the subparticle in this class for each particle, rather than all 60")
+        parser.add_argument("--cache", action='store_true', help="keep a binary copy of parsed star columns next to each input (input.star.cache/) and reuse it while the file is unchanged")
         sys.exit(main(parser.parse_args()))
 
@@ -22,6 +22,7 @@ import math
 import numpy as np
 from pyquaternion import Quaternion
 from datetime import datetime
+from isecc import starparse
 
 print( 'This program currently doesn\'t work. Use bash script instead.' )
 sys.exit()
@@ -787,6 +788,30 @@ def getMinimalStarData( my_star, subparticle_header, subparticle_header_length,
 
 
 
+def getCachedMinimalStarData( my_star ):
+        """ As getMinimalStarData, from memory-mapped sidecar columns rather than the star text """
+
+        table = starparse.getStarTable( my_star, labels=starparse.MINIMAL_STAR_LABELS, cache=True )
+
+        my_dtype = np.dtype( [  ( 'ParticleImageName', 'U200'),
+                                ( 'Class', '<i4' ),
+                                ( 'EulerRot', '<f4' ), ( 'EulerTilt', '<f4' ), ( 'EulerPsi', '<f4' ) ] ) 
+
+        minimal_subparticle_array = np.zeros( len( table ), dtype=my_dtype )
+        minimal_subparticle_array['ParticleImageName'] = table['rlnImageOriginalName']
+        minimal_subparticle_array['Class']     = table['rlnClassNumber']
+        minimal_subparticle_array['EulerRot']  = table['rlnAngleRot']
+        minimal_subparticle_array['EulerTilt'] = table['rlnAngleTilt']
+        minimal_subparticle_array['EulerPsi']  = table['rlnAnglePsi']
+
+        print( "  --> sorting based on particle image name." )
+        minimal_subparticle_array.sort(order='ParticleImageName')
+        print( "  --> done!" )
+
+        return minimal_subparticle_array
+
+
+
 def getApix( header ):
         det_pixelsize_index= header.index('rlnDetectorPixelSize')
         mag_index = header.index('rlnMagnification')
@@ -1227,9 +1252,12 @@ def main(args):
         if args.particle_file.endswith(".star"):
                 print( "  Parsing particle star file." )
                 particle_filename = args.particle_file
-                particle_header, particle_fullheader = getStarHeader( particle_filename )
-                particle_stardata = getStarData( particle_filename, len( particle_header ), particle_header )
-                particle_ndarray = np.asarray( particle_stardata, order='C' )
+                if args.cache:
+                        particle_header, particle_fullheader, particle_ndarray, optics = starparse.getStarFile( particle_filename, cache=True )
+                else:
+                        particle_header, particle_fullheader = getStarHeader( particle_filename )
+                        particle_stardata = getStarData( particle_filename, len( particle_header ), particle_header )
+                        particle_ndarray = np.asarray( particle_stardata, order='C' )
 
 #                print( particle_ndarray.dtype )
 #                print( particle_ndarray.fields )
@@ -1240,10 +1268,13 @@ def main(args):
         if args.subparticle_file.endswith(".star"):
                 print( "  Parsing subparticle star file." )
                 subparticle_filename = args.subparticle_file
-                subparticle_header, subparticle_fullheader = getStarHeader( subparticle_filename )
-                print( "  --> done!" )
                 print( "  Making ndarray with minimal necessary items." )
-                subparticle_ndarray = getMinimalStarData( subparticle_filename, subparticle_header, len( subparticle_header ), num_particles )
+                if args.cache:
+                        subparticle_ndarray = getCachedMinimalStarData( subparticle_filename )
+                else:
+                        subparticle_header, subparticle_fullheader = getStarHeader( subparticle_filename )
+                        print( "  --> done!" )
+                        subparticle_ndarray = getMinimalStarData( subparticle_filename, subparticle_header, len( subparticle_header ), num_particles )
 #                print( "  Converting to ndarray." )
 #                subparticle_ndarray = np.asarray( subparticle_stardata, order='C' )
 #               defineSubparticles(  my_ndarray, args.roi, np.array(args.vector), args.fudge, args.subpart_box, args.supersym, user_testmode, args.batchsize, args.reverse_defocus , header, fullheader, RUN_ID, regen_string, user_batch )
@@ -1265,5 +1296,6 @@ if __name__ == "__main__":
         parser = argparse.ArgumentParser()
         parser.add_argument("--particle_file", type=str, required=True)
         parser.add_argument("--subparticle_file", type=str, required=True)
+        parser.add_argument("--cache", action='store_true', help="keep a binary copy of parsed star columns next to each input (input.star.cache/) and reuse it while the file is unchanged")
         sys.exit(main(parser.parse_args()))
 
@@ -6,4 +6,6 @@ from . import iseccFFT_v2
 from . import checks
 from . import symops
 from . import isecc_classes
+from . import expand
+from . import extract
 from . import isecc_display2d
@@ -40,17 +40,15 @@ def idealizeUserVector( user_vector, ROI ) :
 
     expanded_user_vector = np.zeros( (60), dtype=my_dtype )
 
-    for index, numpy_quat in enumerate(I1Quaternions, start=0 ):
+    """ All 60 rotations of user_vector at once """
+    rotated_vectors = np.around( transform.quatRotate( I1Quaternions, user_vector ), decimals=3 )
 
-        quat = Quaternion( numpy_quat )
-        rotated_vector = np.around( quat.rotate( user_vector ), decimals=3 )
-
-        expanded_user_vector[index]['vector'] = rotated_vector
-        expanded_user_vector[index]['5f_distance']   = np.around( utils.assess3dDistance( rotated_vector, I1_fivefold  ), decimals=3 )
-        expanded_user_vector[index]['3f_distance']   = np.around( utils.assess3dDistance( rotated_vector, I1_threefold ), decimals=3 )
-        expanded_user_vector[index]['2f_distance']   = np.around( utils.assess3dDistance( rotated_vector, I1_twofold   ), decimals=3 )
-        expanded_user_vector[index]['ASU_distance']  = np.around( utils.assess3dDistance( rotated_vector, ASU_center  ), decimals=3 )
-        expanded_user_vector[index]['ASU2_distance'] = np.around( utils.assess3dDistance( rotated_vector, ASU_center2 ), decimals=3 )
+    expanded_user_vector['vector'] = rotated_vectors
+    expanded_user_vector['5f_distance']   = np.around( np.linalg.norm( rotated_vectors - I1_fivefold,  axis=1 ), decimals=3 )
+    expanded_user_vector['3f_distance']   = np.around( np.linalg.norm( rotated_vectors - I1_threefold, axis=1 ), decimals=3 )
+    expanded_user_vector['2f_distance']   = np.around( np.linalg.norm( rotated_vectors - I1_twofold,   axis=1 ), decimals=3 )
+    expanded_user_vector['ASU_distance']  = np.around( np.linalg.norm( rotated_vectors - ASU_center,   axis=1 ), decimals=3 )
+    expanded_user_vector['ASU2_distance'] = np.around( np.linalg.norm( rotated_vectors - ASU_center2,  axis=1 ), decimals=3 )
 
     min_5f_distance = np.amin( expanded_user_vector['5f_distance'] )
     min_3f_distance = np.amin( expanded_user_vector['3f_distance'] )
@@ -58,15 +56,12 @@ def idealizeUserVector( user_vector, ROI ) :
 
     ideal_index = 999
 
-    for index, item in enumerate(expanded_user_vector):
-
-        """ Removed check for nearest threefold. """
-        """ Having that check unintentionally limits you to half of the ASU """
-
-        #if np.isclose(expanded_user_vector[index]['5f_distance'], min_5f_distance, atol=1) and np.isclose(expanded_user_vector[index]['3f_distance'], min_3f_distance, atol=1) and np.isclose(expanded_user_vector[index]['2f_distance'], min_2f_distance, atol=1):
-        if np.isclose(expanded_user_vector[index]['5f_distance'], min_5f_distance, rtol=0.001) and np.isclose(expanded_user_vector[index]['2f_distance'], min_2f_distance, rtol=0.001):
-            ideal_index = index
-
+    """ Removed check for nearest threefold. """
+    """ Having that check unintentionally limits you to half of the ASU """
+    """ Last rotation nearest to both the fivefold and the twofold """
+    is_ideal = np.isclose( expanded_user_vector['5f_distance'], min_5f_distance, rtol=0.001 ) & np.isclose( expanded_user_vector['2f_distance'], min_2f_distance, rtol=0.001 )
+    if np.any( is_ideal ):
+        ideal_index = np.where( is_ideal )[0][-1]
 
     if ideal_index != 999:
         idealized_vector = np.around( expanded_user_vector[ideal_index]['vector'], decimals=3 )
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3.5
+
+import sys
+import multiprocessing
+import numpy as np
+from pyquaternion import Quaternion
+from . import transform
+from . import starparse
+
+
+def subparticlePoses( rot, tilt, psi, symops, quatZ, vector ):
+        """ Subparticle Eulers and offsets for every (symop, particle) pair at once """
+        """ rot, tilt, psi are (N,) in degrees. symops is (S,4). Returns (S,N) Eulers and (S,N,3) offsets. """
+        """ Same operations as Particle.rotateParticle and Particle.defineSubparticle """
+
+        pose = transform.myEuler2QuatArray( np.radians( rot ), np.radians( tilt ), np.radians( psi ) )
+
+        ### Apply the rotation
+        newpose  = transform.quatMultiply( symops[:,np.newaxis,:], pose[np.newaxis,:,:] )
+        newposeZ = transform.quatMultiply( Quaternion( quatZ ).elements, newpose )
+
+        ### Subparticle location with respect to the particle center
+        rotated_vector = transform.quatRotate( transform.quatInverse( newpose ), vector )
+
+        ### Must invert for conversion to Eulers
+        subpart_rot, subpart_tilt, subpart_psi = transform.quat2EulerArray( transform.quatInverse( newposeZ ) )
+
+        return subpart_rot, subpart_tilt, subpart_psi, rotated_vector
+
+
+def formatRelativePose( symop ):
+        """ rlnCustomRelativePose string for a symop, e.g. 0.809,-0.500i,+0.000j,+0.309k """
+        return str( Quaternion( symop ) ).strip().replace( " ", "," )
+
+
+def formatBatchNames( particle_numbers, RUN_ID, batch_size_symop ):
+        """ rlnMicrographName for batch mode. Subparticles from a given particle share a batch. """
+        batch_num = ( particle_numbers // batch_size_symop ) + 1
+        batch_num = np.char.zfill( batch_num.astype( str ), 6 )    # pad to 6 digits
+        prefix = ''.join( [ 'subparticles/', RUN_ID, '/Micrographs/batch' ] )
+        return np.char.add( np.char.add( prefix, batch_num ), '.mrcs' )
+
+
+def formatUIDs( subparticle_indices ):
+        """ rlnCustomUID for zero-based subparticle indices """
+        subparticleUID = np.char.zfill( ( subparticle_indices + 1 ).astype( str ), 9 )
+        return np.char.add( 'subparticleUID_', subparticleUID )
+
+
+def formatXYZ( rotated_vector ):
+        """ rlnCustomOriginXYZAngstWrtParticleCenter strings for (N,3) offsets """
+        rounded = np.around( rotated_vector, decimals=4 ).astype( str )
+        XYZ_string = np.char.add( np.char.add( rounded[:,0], ',' ), rounded[:,1] )
+        return np.char.add( np.char.add( XYZ_string, ',' ), rounded[:,2] )
+
+
+def prepareExpansion( my_ndarray, header, symops, quatZ, vector, vertex_groups, RUN_ID=None, batch_size=None ):
+        """ Typed inputs shared by every expansion block. Only recalculated columns are converted from text. """
+
+        inputs = {}
+        inputs['my_ndarray'] = my_ndarray
+        inputs['symops'] = symops
+        inputs['quatZ'] = quatZ
+        inputs['vector'] = vector
+        inputs['vertex_groups'] = vertex_groups
+        inputs['RUN_ID'] = RUN_ID
+        inputs['batch_size'] = batch_size
+        inputs['num_particles'] = len( my_ndarray )
+
+        ### Parse star file header
+        inputs['rot_index'], inputs['tilt_index'], inputs['psi_index'] = starparse.getEulers( header )
+        inputs['originXAngst_index'], inputs['originYAngst_index'] = starparse.getOffsetAngst( header )
+        inputs['defocusU_index'], inputs['defocusV_index'], defocusAngle_index = starparse.getDefocus( header )
+        inputs['micrographname_index'], inputs['imagename_index'], inputs['particleID_index'] = starparse.getMicrographName( header )
+        inputs['uid_index'] = starparse.getUID( header )
+        inputs['vertexGroup_index'] = starparse.getVertexGroup( header )
+        inputs['OriginXYZAngstWrtParticleCenter_index'] = starparse.getOriginXYZAngstWrtParticleCenter( header )
+        inputs['relativePose_index'] = starparse.getCustomRelativePose( header )
+
+        for label in [ 'rot', 'tilt', 'psi', 'originXAngst', 'originYAngst', 'defocusU', 'defocusV' ]:
+                inputs[label] = my_ndarray[:,inputs[ ''.join( [ label, '_index' ] ) ]].astype( np.float64 )
+
+        if batch_size:
+                inputs['batch_size_symop'] = int( batch_size / len( symops ) )
+
+        return inputs
+
+
+def expandBlock( inputs, index, start, stop, poses=None ):
+        """ Star columns for symop index and particles start:stop """
+        """ poses may hold this block's output of subparticlePoses, otherwise it is calculated here """
+
+        my_ndarray = inputs['my_ndarray']
+        particle_numbers = np.arange( start, stop )
+
+        if poses is None:
+                poses = [ pose[0] for pose in subparticlePoses( inputs['rot'][start:stop], inputs['tilt'][start:stop], inputs['psi'][start:stop],
+                                                                inputs['symops'][index:index+1], inputs['quatZ'], inputs['vector'] ) ]
+        subpart_rot, subpart_tilt, subpart_psi, rotated_vector = poses
+
+        columns = list( my_ndarray[start:stop].T )
+
+        ### Renaming hack to implement batchmode
+        if inputs['batch_size']:
+                """ Store original name; assign new name """
+                columns[inputs['particleID_index']] = my_ndarray[start:stop,inputs['imagename_index']]
+                columns[inputs['micrographname_index']] = formatBatchNames( particle_numbers, inputs['RUN_ID'], inputs['batch_size_symop'] )
+
+        """ Assign for writing to star file """
+        columns[inputs['rot_index']]  = np.around( subpart_rot,  decimals=6 )
+        columns[inputs['tilt_index']] = np.around( subpart_tilt, decimals=6 )
+        columns[inputs['psi_index']]  = np.around( subpart_psi,  decimals=6 )
+        columns[inputs['originXAngst_index']] = np.around( inputs['originXAngst'][start:stop] - rotated_vector[:,0], decimals=6 )
+        columns[inputs['originYAngst_index']] = np.around( inputs['originYAngst'][start:stop] - rotated_vector[:,1], decimals=6 )
+        columns[inputs['defocusU_index']] = np.around( inputs['defocusU'][start:stop] + rotated_vector[:,2], decimals=6 )
+        columns[inputs['defocusV_index']] = np.around( inputs['defocusV'][start:stop] + rotated_vector[:,2], decimals=6 )
+
+        """ Assign CustomUID, VertexGroup, relativePose, XYZ string """
+        columns[inputs['uid_index']] = formatUIDs( ( index * inputs['num_particles'] ) + particle_numbers )
+        columns[inputs['vertexGroup_index']]  = inputs['vertex_groups'][index]
+        columns[inputs['relativePose_index']] = formatRelativePose( inputs['symops'][index] )
+        columns[inputs['OriginXYZAngstWrtParticleCenter_index']] = formatXYZ( rotated_vector )
+
+        return columns
+
+
+def expansionBlocks( num_symops, num_particles, chunk_size ):
+        """ ( symop index, start, stop ) for every block, in output order """
+        return [ ( index, start, min( start + chunk_size, num_particles ) )
+                 for index in range( num_symops )
+                 for start in range( 0, num_particles, chunk_size ) ]
+
+
+def expandSubparticles( my_ndarray, header, symops, quatZ, vector, vertex_groups, RUN_ID=None, batch_size=None, chunk_size=None ):
+        """ Generator over the blocks of the expanded star file, in output order """
+        """ Yields ( symop index, columns ) where columns is ready for starparse.writeStarRows """
+        """ Columns that are not recalculated are passed through as the original text """
+        """ By default all symops and particles are posed at once. With chunk_size, one symop and """
+        """ chunk_size particles are posed per block, which bounds memory use for fullexpand. """
+
+        inputs = prepareExpansion( my_ndarray, header, symops, quatZ, vector, vertex_groups, RUN_ID, batch_size )
+        num_particles = inputs['num_particles']
+
+        if ( not chunk_size ) or ( chunk_size >= num_particles ):
+                ### Every (symop, particle) pair in one pass
+                poses = subparticlePoses( inputs['rot'], inputs['tilt'], inputs['psi'], symops, quatZ, vector )
+                for index in range( len( symops ) ):
+                        yield index, expandBlock( inputs, index, 0, num_particles, [ pose[index] for pose in poses ] )
+                return
+
+        for index, start, stop in expansionBlocks( len( symops ), num_particles, chunk_size ):
+                yield index, expandBlock( inputs, index, start, stop )
+
+
+### Inherited by pool workers on fork, so the star array is not pickled per task
+_shared_inputs = None
+
+def _formatBlock( block ):
+        index, start, stop = block
+        return index, starparse.formatStarRows( expandBlock( _shared_inputs, index, start, stop ) )
+
+
+def expandSubparticlesParallel( my_ndarray, header, symops, quatZ, vector, vertex_groups, RUN_ID=None, batch_size=None, chunk_size=None, jobs=1 ):
+        """ As expandSubparticles, with blocks posed and formatted across a pool of jobs processes """
+        """ Yields ( symop index, text ). Blocks come back in output order, so UIDs and batch names """
+        """ are identical to a serial run. """
+        global _shared_inputs
+
+        _shared_inputs = prepareExpansion( my_ndarray, header, symops, quatZ, vector, vertex_groups, RUN_ID, batch_size )
+        num_particles = _shared_inputs['num_particles']
+
+        ### Enough blocks to keep every process busy when there are few symops
+        if not chunk_size:
+                chunks_per_symop = int( np.ceil( np.true_divide( 4 * jobs, len( symops ) ) ) )
+                chunk_size = int( np.ceil( np.true_divide( num_particles, chunks_per_symop ) ) )
+        chunk_size = max( chunk_size, 1 )
+
+        pool = multiprocessing.get_context( 'fork' ).Pool( jobs )
+        try:
+                for index, text in pool.imap( _formatBlock, expansionBlocks( len( symops ), num_particles, chunk_size ) ):
+                        yield index, text
+        finally:
+                pool.terminate()
+                _shared_inputs = None
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3.5
+
+import sys
+import os
+import collections
+import numpy as np
+import mrcfile
+from . import starparse
+
+
+### Output stacks kept memory-mapped at once while cutting subparticles
+EXTRACT_MAX_OPEN_STACKS = 64
+
+
+def roundOffsets( origin_angst, angpix ):
+        """ Whole-pixel part of an origin, and the remainder in Angstroms """
+        """ Rounds as relion's ROUND does for --apply_rounded_offsets_only, i.e. halves away from zero """
+        origin_pixels = np.true_divide( origin_angst, angpix )
+        rounded = np.where( origin_pixels > 0, np.floor( origin_pixels + 0.5 ), np.ceil( origin_pixels - 0.5 ) )
+        remainder = np.around( ( origin_pixels - rounded ) * angpix, decimals=6 )
+        return rounded.astype( np.int64 ), remainder
+
+
+def cropWindows( image, shift_x, shift_y, new_box ):
+        """ new_box crops of one image, each after shifting by whole pixels ( shift_x, shift_y ) """
+        """ Same result as relion_stack_create --apply_rounded_offsets_only followed by """
+        """ relion_image_handler --new_box: shift without wrapping, zero fill, then window about the center """
+        """ shift_x and shift_y are (K,). Returns (K, new_box, new_box) float32. """
+
+        box_y, box_x = image.shape
+        window = np.arange( new_box ) - ( new_box // 2 )
+
+        ### Pixel in the shifted image, then the source pixel, for each output pixel
+        shifted_rows = ( box_y // 2 ) + window
+        shifted_cols = ( box_x // 2 ) + window
+        rows = shifted_rows[np.newaxis,:] - np.asarray( shift_y )[:,np.newaxis]
+        cols = shifted_cols[np.newaxis,:] - np.asarray( shift_x )[:,np.newaxis]
+
+        ### Both must be in the box. The first only matters when new_box is larger than the box.
+        inside_rows = ( rows >= 0 ) & ( rows < box_y ) & ( shifted_rows >= 0 ) & ( shifted_rows < box_y )
+        inside_cols = ( cols >= 0 ) & ( cols < box_x ) & ( shifted_cols >= 0 ) & ( shifted_cols < box_x )
+        inside = inside_rows[:,:,np.newaxis] & inside_cols[:,np.newaxis,:]
+
+        rows = np.clip( rows, 0, box_y - 1 )
+        cols = np.clip( cols, 0, box_x - 1 )
+        crops = np.asarray( image, dtype=np.float32 )[ rows[:,:,np.newaxis], cols[:,np.newaxis,:] ]
+        crops[ ~inside ] = 0
+
+        return crops
+
+
+def splitImageName( image_names ):
+        """ 000001@Extract/particles.mrcs -> ( 0, 'Extract/particles.mrcs' ). Slices are zero-based. """
+        image_names = np.asarray( image_names ).astype( str )
+        split = np.char.partition( image_names, '@' )
+        return split[:,0].astype( np.int64 ) - 1, split[:,2]
+
+
+def subparticleStackName( micrograph_name, ROI ):
+        """ Output stack, named as the relion_stack_create + relion_image_handler route names it """
+        """ e.g. subparticles/RUN/Micrographs/batch000001.mrcs -> fivefold_subparticles/RUN/Micrographs/batch000001_subpart.mrcs """
+        stack_name = ''.join( [ ROI, '_', os.path.splitext( micrograph_name )[0], '_subpart.mrcs' ] )
+        return os.path.normpath( stack_name )
+
+
+def scheduleExtraction( source_names, source_index ):
+        """ Read order for extraction: ( source stack, slice, rows cut from that slice ) """
+        """ Stacks come in order of first appearance and slices in ascending order, so every stack is """
+        """ opened once and read front to back, and every particle image is read once for all of its """
+        """ subparticles, wherever their rows fall in the star file. """
+
+        stacks, first_row, stack_of_row = np.unique( source_names, return_index=True, return_inverse=True )
+        stack_rank = np.argsort( np.argsort( first_row ) )[stack_of_row]
+
+        order = np.lexsort( ( source_index, stack_rank ) )
+        keys = np.stack( [ stack_rank[order], source_index[order] ], axis=1 )
+        boundaries = np.flatnonzero( np.any( keys[1:] != keys[:-1], axis=1 ) ) + 1
+
+        return [ ( source_names[group[0]], source_index[group[0]], group ) for group in np.split( order, boundaries ) if len( group ) ]
+
+
+def stackPositions( stack_of_row ):
+        """ Zero-based position of each row within its output stack, keeping star file order """
+        order = np.argsort( stack_of_row, kind='stable' )
+        counts = np.bincount( stack_of_row )
+        starts = np.cumsum( counts ) - counts
+        positions = np.empty( len( stack_of_row ), dtype=np.int64 )
+        positions[order] = np.arange( len( stack_of_row ) ) - np.repeat( starts, counts )
+        return positions
+
+
+class SubparticleStacks:
+        """ Output stacks filled in any order. At most max_open are memory-mapped at a time. """
+
+        def __init__( self, stack_names, stack_sizes, new_box, angpix, max_open=EXTRACT_MAX_OPEN_STACKS ):
+                self.stack_names = stack_names
+                self.new_box = new_box
+                self.max_open = max_open
+                self.open_stacks = collections.OrderedDict()
+
+                ### Running statistics for the header, so stacks need not be read back
+                self.minimum = np.full( len( stack_names ), np.inf )
+                self.maximum = np.full( len( stack_names ), -np.inf )
+                self.total = np.zeros( len( stack_names ) )
+                self.total_squares = np.zeros( len( stack_names ) )
+                self.count = np.zeros( len( stack_names ) )
+
+                for stack, stack_name in enumerate( stack_names ):
+                        stack_directory = os.path.dirname( stack_name )
+                        if stack_directory:
+                                os.makedirs( stack_directory, exist_ok=True )
+                        mrc = mrcfile.new_mmap( stack_name, shape=( stack_sizes[stack], new_box, new_box ), mrc_mode=2, overwrite=True )
+                        mrc.set_image_stack()
+                        mrc.voxel_size = angpix[stack]
+                        mrc.close()
+
+        def write( self, stack, positions, crops ):
+                if stack in self.open_stacks:
+                        self.open_stacks.move_to_end( stack )
+                else:
+                        if len( self.open_stacks ) >= self.max_open:
+                                self.open_stacks.popitem( last=False )[1].close()
+                        self.open_stacks[stack] = mrcfile.mmap( self.stack_names[stack], mode='r+' )
+
+                self.open_stacks[stack].data[positions] = crops
+
+                self.minimum[stack] = min( self.minimum[stack], crops.min() )
+                self.maximum[stack] = max( self.maximum[stack], crops.max() )
+                self.total[stack] += np.sum( crops, dtype=np.float64 )
+                self.total_squares[stack] += np.sum( np.square( crops, dtype=np.float64 ) )
+                self.count[stack] += crops.size
+
+        def close( self ):
+                while self.open_stacks:
+                        self.open_stacks.popitem( last=False )[1].close()
+
+                ### Header statistics, as mrcfile's update_header_stats would set them
+                for stack, stack_name in enumerate( self.stack_names ):
+                        if self.count[stack] == 0:
+                                continue
+                        mean = self.total[stack] / self.count[stack]
+                        rms = np.sqrt( max( self.total_squares[stack] / self.count[stack] - ( mean * mean ), 0 ) )
+                        with mrcfile.mmap( stack_name, mode='r+' ) as mrc:
+                                mrc.header.dmin = self.minimum[stack]
+                                mrc.header.dmax = self.maximum[stack]
+                                mrc.header.dmean = mean
+                                mrc.header.rms = rms
+
+
+def openSourceStack( filename ):
+        """ Memory-mapped source stack """
+        if not os.path.isfile( filename ):
+                print( "Error: could not find particle stack", filename, ". Exiting now." )
+                sys.exit()
+        return mrcfile.mmap( filename, mode='r', permissive=True )
+
+
+def extractSubparticles( input_star, fullheader, ROI, new_box ):
+        """ In-process replacement for relion_stack_create --apply_rounded_offsets_only --split_per_micrograph """
+        """ followed by relion_image_handler --new_box. Only the final new_box stacks are written. """
+        """ Subparticles go to one stack per rlnMicrographName, in star file order. Writes ROI_subpart.star, """
+        """ with the new image names, the sub-pixel remainder of each origin, and rlnImageSize of new_box. """
+
+        tables = starparse.getStarBlocks( input_star, text_blocks=( 'data_particles', ) )
+        particles = tables['data_particles']
+        starparse.joinOptics( particles, tables['data_optics'], [ 'rlnImagePixelSize' ] )
+        angpix = particles['rlnImagePixelSize']
+
+        shift_x, remainder_x = roundOffsets( particles['rlnOriginXAngst'].astype( np.float64 ), angpix )
+        shift_y, remainder_y = roundOffsets( particles['rlnOriginYAngst'].astype( np.float64 ), angpix )
+        source_index, source_names = splitImageName( particles['rlnImageName'] )
+
+        ### One output stack per micrograph. Positions within a stack follow the star file,
+        ### so image names line up with UIDs and batch names whatever order images are cut in.
+        micrographs, first_row, stack_of_row = np.unique( particles['rlnMicrographName'], return_index=True, return_inverse=True )
+        stack_names = [ subparticleStackName( micrograph, ROI ) for micrograph in micrographs ]
+        positions = stackPositions( stack_of_row )
+
+        stacks = SubparticleStacks( stack_names, np.bincount( stack_of_row ), new_box, angpix[first_row] )
+        schedule = scheduleExtraction( source_names, source_index )
+        print( "  Cutting", len( particles ), "subparticles from", len( schedule ), "particle images into", len( stack_names ), "stacks" )
+
+        source_name = None
+        source = None
+        try:
+                for next_source_name, slice_index, rows in schedule:
+
+                        if next_source_name != source_name:
+                                if source is not None:
+                                        source.close()
+                                source_name = next_source_name
+                                source = openSourceStack( source_name )
+                                print( "  Reading", source_name )
+
+                        image = source.data if source.data.ndim == 2 else source.data[slice_index]
+                        crops = cropWindows( image, shift_x[rows], shift_y[rows], new_box )
+
+                        ### Usually one output stack per image, as subparticles of a particle share a batch
+                        for stack in np.unique( stack_of_row[rows] ):
+                                in_stack = stack_of_row[rows] == stack
+                                stacks.write( stack, positions[rows[in_stack]], crops[in_stack] )
+        finally:
+                if source is not None:
+                        source.close()
+                stacks.close()
+
+        slice_numbers = np.char.zfill( ( positions + 1 ).astype( str ), 6 )
+        image_names = np.char.add( np.char.add( slice_numbers, '@' ), np.array( stack_names )[stack_of_row] )
+
+        columns = [ particles[label] for label in particles.labels if label != 'rlnImagePixelSize' ]
+        labels = [ label for label in particles.labels if label != 'rlnImagePixelSize' ]
+        columns[ labels.index( 'rlnImageName' ) ] = image_names
+        columns[ labels.index( 'rlnOriginXAngst' ) ] = remainder_x
+        columns[ labels.index( 'rlnOriginYAngst' ) ] = remainder_y
+
+        filename = ''.join( [ ROI, '_subpart.star' ] )
+        header = starparse.setStarHeaderValue( fullheader, 'data_optics', 'rlnImageSize', new_box )
+        starparse.writeStarFile( filename, header, columns )
+
+        return filename
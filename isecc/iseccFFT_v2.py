@@ -9,11 +9,17 @@ from scipy.spatial.transform import Rotation as R
 import scipy.interpolate
 import mrcfile
 from pyfftw.interfaces.numpy_fft import rfftn
+import pyfftw
+from scipy import ndimage
 import warnings
 from pyem import *
 import sys
+from . import transform
 warnings.filterwarnings('ignore', message='Casting complex values')
 
+### Output planes resampled at a time by FourierRotator
+FOURIER_ROTATE_SLAB = 16
+
 
 def plotPSD2d( ndimage, plot=False ):
     ### See Jessica Lu, "Fourier Transforms of Images in Python", AstroBetter ###
@@ -359,6 +365,101 @@ def rotateVolume3d( my_ndimage, box_size ):
 
     return rotated_data
 
+class FourierRotator:
+    """ Rotates volumes of one box size in Fourier space, sharing one pair of FFTW plans """
+    """ transform() once per volume, then rotate() as often as needed. Box size must be even. """
+    """ The padded transform is grid corrected for trilinear interpolation, as vol_ft does, """
+    """ and shifts are applied as phase ramps. Same geometry as transform.rotateVolume. """
+
+    def __init__(self, box_size, pfac=2, threads=1, slab=FOURIER_ROTATE_SLAB):
+        if box_size % 2:
+            print( "Error: Fourier rotation needs an even box size. Got", box_size, ". Exiting now." )
+            sys.exit()
+
+        self.box_size = box_size
+        self.pfac = pfac
+        self.padded_size = box_size * pfac
+        self.slab = slab
+
+        ### Plans are made once and reused for every volume and rotation
+        self.forward = pyfftw.builders.rfftn( pyfftw.empty_aligned( (self.padded_size,)*3, dtype='float64' ), threads=threads )
+        self.inverse = pyfftw.builders.irfftn( pyfftw.empty_aligned( (box_size, box_size, box_size//2 + 1), dtype='complex128' ),
+                                               s=(box_size,)*3, threads=threads )
+
+        ### Frequencies of the output half spectrum, in cycles per box
+        self.freq_zy = np.fft.fftfreq( box_size ) * box_size
+        self.freq_x = np.arange( box_size//2 + 1 )
+
+    def gridCorrect(self, volume):
+        """ Undo the sinc**2 attenuation that trilinear interpolation of the padded transform causes """
+        centered = np.arange( self.box_size ) - ( self.box_size // 2 )
+        sinc = np.sinc( np.true_divide( centered, self.padded_size ) )**2
+        return volume / ( sinc[:,np.newaxis,np.newaxis] * sinc[np.newaxis,:,np.newaxis] * sinc[np.newaxis,np.newaxis,:] )
+
+    def transform(self, volume):
+        """ Centered, padded half spectrum of a ZYX volume: ft[z,y,x] with z and y shifted to the middle """
+        pad = ( self.padded_size - self.box_size ) // 2
+        padded = np.pad( self.gridCorrect( np.asarray( volume, dtype=np.float64 ) ), pad, 'constant' )
+        ft = self.forward( np.fft.ifftshift( padded ) )
+        return np.fft.fftshift( ft, axes=(0,1) )
+
+    def rotate(self, ft, quat, residual=( 0, 0, 0 )):
+        """ Rotated volume, as transform.rotateVolume( volume, quat, residual ) but resampled in Fourier space """
+        """ residual is the subpixel offset, in the same order rotateVolume takes it """
+
+        box_size = self.box_size
+        half = self.padded_size // 2
+        residual = np.asarray( residual, dtype=np.float64 )
+
+        ### Output frequency k samples the input at R^T k
+        matrix = np.swapaxes( transform.quat2RotationMatrix( quat ), -1, -2 )
+
+        kx = self.freq_x[np.newaxis,np.newaxis,:]
+        ky = self.freq_zy[np.newaxis,:,np.newaxis]
+
+        rotated_ft = np.zeros( ( box_size, box_size, box_size//2 + 1 ), dtype=np.complex128 )
+        for start in range( 0, box_size, self.slab ):
+            kz = self.freq_zy[start:start+self.slab][:,np.newaxis,np.newaxis]
+            kx_b, ky_b, kz_b = np.broadcast_arrays( kx, ky, kz )
+
+            source = [ ( matrix[row,0] * kx_b ) + ( matrix[row,1] * ky_b ) + ( matrix[row,2] * kz_b ) for row in range(3) ]
+
+            ### Only kx >= 0 is stored. The rest come from Friedel symmetry.
+            flip = source[0] < 0
+            sign = np.where( flip, -1., 1. )
+            coords = np.stack( [ ( sign * source[2] * self.pfac ) + half,
+                                 ( sign * source[1] * self.pfac ) + half,
+                                 ( sign * source[0] * self.pfac ) ] )
+
+            values = ndimage.map_coordinates( ft.real, coords, order=1, mode='constant', cval=0.0, prefilter=False ) \
+                + 1j * ndimage.map_coordinates( ft.imag, coords, order=1, mode='constant', cval=0.0, prefilter=False )
+            values = np.where( flip, np.conj( values ), values )
+
+            ### Rotation about the point residual, as phase ramps in place of shifted coordinates
+            phase = ( ( source[0] - kx_b ) * residual[0] ) + ( ( source[1] - ky_b ) * residual[1] ) + ( ( source[2] - kz_b ) * residual[2] )
+            rotated_ft[start:start+self.slab] = values * np.exp( 2j * np.pi * phase / box_size )
+
+        rotated = np.fft.fftshift( self.inverse( rotated_ft ) )
+
+        ### Zero where the source lies outside the box, as it does for rotateVolume
+        rotated[ ~self.support( matrix, residual ) ] = 0
+        return rotated
+
+    def support(self, matrix, residual):
+        """ Output voxels whose source, R^T ( g - r ) + B/2 + r, is inside the input box """
+        box_size = self.box_size
+        centered = [ np.arange( box_size ) - np.true_divide( box_size, 2 ) - residual[axis] for axis in range(3) ]
+        gx = centered[0][np.newaxis,np.newaxis,:]
+        gy = centered[1][np.newaxis,:,np.newaxis]
+        gz = centered[2][:,np.newaxis,np.newaxis]
+
+        inside = np.ones( ( box_size, ) * 3, dtype=bool )
+        for row in range(3):
+            source = ( matrix[row,0] * gx ) + ( matrix[row,1] * gy ) + ( matrix[row,2] * gz ) + np.true_divide( box_size, 2 ) + residual[row]
+            inside &= ( source >= 0 ) & ( source <= box_size - 1 )
+        return inside
+
+
 def saveMRC( ndimage, filename ):
     """ Simple function to save as mrc. WILL OVERWRITE EXISTING FILES """
 
@@ -1,8 +1,15 @@
 #!/usr/bin/env python3.5
+import sys
 import numpy as np
 from isecc import transform
 from pyquaternion import Quaternion
 
+### Centroid budget for QuantileDigest. At most compression/2 + 1 centroids are kept.
+DIGEST_COMPRESSION = 1000
+
+### Values buffered by QuantileDigest before they are merged into centroids
+DIGEST_BUFFER = 100000
+
 class Particle:
     """ Contains items from data_particles """
 
@@ -92,6 +99,43 @@ class Optics:
         self.rlnImageDimensionality = imageDim
 
 
+class StarTable:
+
+    """ Columnar version of a star file data block """
+    """ Columns are typed ndarrays keyed by label, e.g. table['rlnAngleRot'] """
+    """ header holds the file's text lines ahead of the first row of the block, when known """
+    def __init__(self, labels, columns, block='data_particles', header=None):
+        self.block   = block
+        self.labels  = list(labels)
+        self.columns = dict( zip( self.labels, columns ) )
+        self.header  = header
+
+    def __len__(self):
+        """ Number of rows, as for an ndarray """
+        if not self.labels:
+            return 0
+        return len( self.columns[ self.labels[0] ] )
+
+    def __getitem__(self, label):
+        return self.columns[label]
+
+    def __setitem__(self, label, column):
+        if label not in self.columns:
+            self.labels.append( label )
+        self.columns[label] = column
+
+    def __contains__(self, label):
+        return label in self.columns
+
+    def index(self, label):
+        """ Column number, as for a header list """
+        return self.labels.index( label )
+
+    def take(self, indices):
+        """ New table holding only the requested rows, e.g. from argsort """
+        return StarTable( self.labels, [ self.columns[label][indices] for label in self.labels ], self.block, self.header )
+
+
 class AreaOfInterest:
 
     """ As written, this only works for I1 symmetry """
@@ -144,3 +188,150 @@ class AreaOfInterest:
         if not self.symindices:
             self.symindices = list(map(int, unique_indices))
 
+
+class QuantileDigest:
+
+    """ Running percentiles in bounded memory, after the merging t-digest """
+    """ Values are buffered, then sorted into weighted centroids. Centroids are sized by """
+    """ an arcsine scale, so they hold single values near either tail and more in the middle. """
+    """ Exact, as np.percentile, until buffer_size values have been seen. Digests of separate streams can be merged. """
+    def __init__(self, compression=DIGEST_COMPRESSION, buffer_size=DIGEST_BUFFER):
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.means   = np.zeros( 0 )
+        self.weights = np.zeros( 0 )
+        self.pending_means   = []
+        self.pending_weights = []
+        self.pending = 0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+
+    def update(self, values):
+        values = np.asarray( values, dtype=np.float64 ).ravel()
+        if len( values ) == 0:
+            return
+        self.minimum = min( self.minimum, values.min() )
+        self.maximum = max( self.maximum, values.max() )
+        self.addCentroids( values, np.ones( len( values ) ) )
+
+    def merge(self, other):
+        """ Add another digest's values to this one """
+        if other.minimum > other.maximum:
+            return
+        self.minimum = min( self.minimum, other.minimum )
+        self.maximum = max( self.maximum, other.maximum )
+        self.addCentroids( np.concatenate( [ other.means ] + other.pending_means ), np.concatenate( [ other.weights ] + other.pending_weights ) )
+
+    def addCentroids(self, means, weights):
+        self.pending_means.append( means )
+        self.pending_weights.append( weights )
+        self.pending += len( means )
+        if self.pending >= self.buffer_size:
+            self.compress()
+
+    def compress(self):
+        """ Merge pending values into the centroids """
+        if not self.pending:
+            return
+        means   = np.concatenate( [ self.means ] + self.pending_means )
+        weights = np.concatenate( [ self.weights ] + self.pending_weights )
+        self.pending_means   = []
+        self.pending_weights = []
+        self.pending = 0
+
+        order   = np.argsort( means, kind='stable' )
+        means   = means[order]
+        weights = weights[order]
+
+        ### Scale k runs 0 to compression/2 over the quantiles. A centroid holds whatever falls in one unit of k.
+        quantiles = ( np.cumsum( weights ) - ( weights / 2 ) ) / np.sum( weights )
+        scale = ( self.compression / ( 2 * np.pi ) ) * ( np.arcsin( ( 2 * quantiles ) - 1 ) + ( np.pi / 2 ) )
+        cluster = np.floor( scale ).astype( np.int64 )
+        starts = np.concatenate( [ [0], np.flatnonzero( np.diff( cluster ) ) + 1 ] )
+
+        self.weights = np.add.reduceat( weights, starts )
+        self.means   = np.add.reduceat( weights * means, starts ) / self.weights
+
+        ### A centroid of one value is that value exactly
+        singles = np.add.reduceat( np.ones( len( means ) ), starts ) == 1
+        self.means[singles] = means[ starts[singles] ]
+
+    def percentile(self, percentiles):
+        """ As np.percentile with linear interpolation. nan when empty. """
+        ### Raw values are used as they are, which keeps small streams exact. Overlapping centroids,
+        ### e.g. from a merge, must be compressed first to interpolate between them.
+        if len( self.means ) or any( [ np.any( weights != 1 ) for weights in self.pending_weights ] ):
+            self.compress()
+        means   = np.concatenate( [ self.means ] + self.pending_means )
+        weights = np.concatenate( [ self.weights ] + self.pending_weights )
+        order   = np.argsort( means, kind='stable' )
+        means   = means[order]
+        weights = weights[order]
+
+        percentiles = np.asarray( percentiles, dtype=np.float64 )
+        total = np.sum( weights )
+        if total == 0:
+            return np.full( percentiles.shape, np.nan )
+
+        ### Centroid i sits at the middle of its weight. For single values this puts value i at rank i + 0.5.
+        centers   = np.cumsum( weights ) - ( weights / 2 )
+        positions = ( ( percentiles / 100 ) * ( total - 1 ) ) + 0.5
+        return np.interp( positions, np.concatenate( [ [0], centers, [total] ] ),
+                          np.concatenate( [ [self.minimum], means, [self.maximum] ] ) )
+
+
+class RunningStatistics:
+
+    """ Count, mean, stdev, percentiles and a fixed-bin histogram of a stream of values, in constant memory """
+    """ Mean and variance are merged chunk by chunk with Welford's update, as Chan et al. give it for batches """
+    """ Values outside value_range are tallied in underflow and overflow rather than binned """
+    def __init__(self, bins, value_range, compression=DIGEST_COMPRESSION):
+        self.count = 0
+        self.mean  = 0.0
+        self.m2    = 0.0
+        self.bin_edges = np.linspace( value_range[0], value_range[1], bins + 1 )
+        self.histogram = np.zeros( bins, dtype=np.int64 )
+        self.underflow = 0
+        self.overflow  = 0
+        self.digest = QuantileDigest( compression )
+
+    def combine(self, count, mean, m2):
+        if count == 0:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + ( delta * count / total )
+        self.m2   = self.m2 + m2 + ( delta * delta * self.count * count / total )
+        self.count = total
+
+    def update(self, values):
+        values = np.asarray( values, dtype=np.float64 ).ravel()
+        if len( values ) == 0:
+            return
+        chunk_mean = np.mean( values )
+        self.combine( len( values ), chunk_mean, np.sum( np.square( values - chunk_mean ) ) )
+
+        self.histogram += np.histogram( values, bins=self.bin_edges )[0]
+        self.underflow += np.count_nonzero( values < self.bin_edges[0] )
+        self.overflow  += np.count_nonzero( values > self.bin_edges[-1] )
+        self.digest.update( values )
+
+    def merge(self, other):
+        """ Add the statistics of another stream, binned the same way """
+        if not np.array_equal( self.bin_edges, other.bin_edges ):
+            print( "Error: cannot merge histograms with different bins. Exiting now." )
+            sys.exit()
+        self.combine( other.count, other.mean, other.m2 )
+        self.histogram += other.histogram
+        self.underflow += other.underflow
+        self.overflow  += other.overflow
+        self.digest.merge( other.digest )
+
+    def stdev(self):
+        """ Population stdev, as np.std """
+        if self.count == 0:
+            return np.nan
+        return np.sqrt( self.m2 / self.count )
+
+    def percentile(self, percentiles):
+        return self.digest.percentile( percentiles )
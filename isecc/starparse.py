@@ -5,8 +5,60 @@ import sys
 import os
 import time
 import math
+import json
+import shutil
+import collections
+import tempfile
 import numpy as np
 from datetime import datetime
+from .isecc_classes import StarTable
+
+
+### Rows handled per block when converting star text to typed columns
+STAR_READ_CHUNK = 100000
+
+### Rows formatted per write by writeStarRows
+STAR_WRITE_CHUNK = 50000
+
+### Buffer size for streamed star output, in bytes
+STAR_WRITE_BUFFER = 4 * 1024 * 1024
+
+### Labels added by getStarHeader, with the placeholder values getStarData fills them with
+STAR_CUSTOM_LABELS = collections.OrderedDict( [ ( 'rlnImageOriginalName', 'ImageOriginalName' ),
+                                                ( 'rlnCustomUID', 'CustomUID' ),
+                                                ( 'rlnCustomVertexGroup', 'CustomVertexGroup' ),
+                                                ( 'rlnCustomOriginXYZAngstWrtParticleCenter', 'CustomOriginXYZAngst' ),
+                                                ( 'rlnCustomRelativePose', 'CustomRelativePose' ) ] )
+
+### Sidecar directory for cached star columns, and its metadata file
+STAR_CACHE_SUFFIX = '.cache'
+STAR_CACHE_METADATA = 'metadata.json'
+
+### Suffix for the sidecar of a block cached as star text rather than typed columns
+STAR_CACHE_TEXT_SUFFIX = '.text'
+
+### Blocks cached when none are named, i.e. those of a relion 3.1 particle star file
+STAR_CACHE_BLOCKS = ( 'data_optics', 'data_particles' )
+
+### Vertex orders in rlnCustomVertexGroup, e.g. 5f01a.3f01a.2f01a, and the rotation letters about each vertex
+VERTEX_GROUP_ORDERS = ( '5f', '3f', '2f' )
+VERTEX_ROTATION_LETTERS = 'abcde'
+
+### Decoded rlnCustomVertexGroup
+VERTEX_GROUP_DTYPE = np.dtype( [ ( 'Vertex5f_general', 'i4' ), ( 'Vertex5f_specific', 'i1' ),
+                                 ( 'Vertex3f_general', 'i4' ), ( 'Vertex3f_specific', 'i1' ),
+                                 ( 'Vertex2f_general', 'i4' ), ( 'Vertex2f_specific', 'i1' ) ] )
+
+### Labels kept as integers by getStarTable
+STAR_INT_LABELS = ( 'rlnClassNumber', 'rlnGroupNumber', 'rlnOpticsGroup', 'rlnRandomSubset',
+                    'rlnNrOfSignificantSamples', 'rlnImageSize', 'rlnImageDimensionality', 'rlnNrOfFrames' )
+
+### Labels kept as strings by getStarTable. Unlisted labels are float64 where possible.
+STAR_STRING_LABELS = ( 'rlnImageName', 'rlnMicrographName', 'rlnImageOriginalName', 'rlnGroupName',
+                       'rlnOpticsGroupName', 'rlnOddZernike', 'rlnEvenZernike', 'rlnCtfImage',
+                       'rlnMicrographMovieName', 'rlnOriginalParticleName', 'rlnReconstructImageName',
+                       'rlnCustomUID', 'rlnCustomVertexGroup', 'rlnCustomOriginXYZAngstWrtParticleCenter',
+                       'rlnCustomRelativePose' )
 
 
 def getStarHeader( my_star, regen_string ):     # original version
@@ -233,62 +285,714 @@ def getStarData2( my_star, header_length, header ):
         return stardata
 
 
-def getMinimalStarData( my_star, subparticle_header, subparticle_header_length, num_particles ):
+### Columns read by getMinimalStarData
+MINIMAL_STAR_LABELS = [ 'rlnImageOriginalName', 'rlnClassNumber', 'rlnAngleRot', 'rlnAngleTilt', 'rlnAnglePsi' ]
+
+MINIMAL_STAR_DTYPE = np.dtype( [ ( 'ParticleID', '<i8' ),
+                                 ( 'Class', '<i4' ),
+                                 ( 'EulerRot', '<f4' ), ( 'EulerTilt', '<f4' ), ( 'EulerPsi', '<f4' ) ] )
+
+
+def getMinimalStarData( my_star, subparticle_header, subparticle_header_length=None, num_particles=None, name_ids=None, chunk_size=STAR_READ_CHUNK, cache=False ):
+        """ Parent particle, class and Eulers for every subparticle, in one streaming pass """
+        """ Parent image names (rlnImageOriginalName) are interned to integer IDs through name_ids, """
+        """ a dict of name -> ID that gains an entry for each new name. Only the needed columns are split. """
+        """ Returns the array sorted by ParticleID then Class and Eulers, and name_ids. """
+        """ With cache=True the columns come from the binary sidecar instead. See getCachedStarBlocks. """
 
-        my_dtype = np.dtype( [  ( 'ParticleImageName', 'U200'),
-                                ( 'Class', '<i4' ),
-                                ( 'EulerRot', '<f4' ), ( 'EulerTilt', '<f4' ), ( 'EulerPsi', '<f4' ) ] ) 
-            
-        minimal_subparticle_array    =  np.zeros( ( (num_particles * 60),), dtype=my_dtype ) 
-        subparticle_index = 0
+        if name_ids is None:
+                name_ids = {}
+
+        if cache:
+                return getCachedMinimalStarData( my_star, name_ids, chunk_size )
 
         ## This function should only return class and eulers
         rot_indexSP, tilt_indexSP, psi_indexSP = getEulers( subparticle_header )
         class_indexSP = getClass( subparticle_header )
         micrographname_indexSP, imagename_indexSP, particleID_indexSP = getMicrographName( subparticle_header )
-    
+        last_index = max( rot_indexSP, tilt_indexSP, psi_indexSP, class_indexSP, particleID_indexSP )
+
+        chunks = []
+        ids, classes, rots, tilts, psis = [], [], [], [], []
+
+        def storeChunk():
+                chunk = np.zeros( len( ids ), dtype=MINIMAL_STAR_DTYPE )
+                chunk['ParticleID'] = ids
+                chunk['Class']      = np.array( classes, dtype=np.float64 )
+                chunk['EulerRot']   = np.array( rots,  dtype=np.float64 )
+                chunk['EulerTilt']  = np.array( tilts, dtype=np.float64 )
+                chunk['EulerPsi']   = np.array( psis,  dtype=np.float64 )
+                chunks.append( chunk )
+
         with open(my_star, "r") as my_star:
-                stardata = []
 
                 START_PARSE = None      # Needed for relion 3.1 star format
 
                 for line in my_star:
 
-                        if line.strip() == 'data_particles':
-                                START_PARSE = True
+                        if not START_PARSE:
+                                if line.strip() == 'data_particles':
+                                        START_PARSE = True
+                                continue
 
-                        if START_PARSE:
+                        ### Split no further than the last column we need
+                        linesplit = line.split( None, last_index + 1 )
 
-                                linesplit = line.split()
+                        if ( len( linesplit ) > last_index ) and ( linesplit[0][0] != '#' ):    # get beyond the metadata labels
 
-                                if len( linesplit ) > 4:    # get beyond the metadata labels
+                                name = linesplit[particleID_indexSP]
+                                particle_id = name_ids.get( name )
+                                if particle_id is None:
+                                        particle_id = len( name_ids )
+                                        name_ids[name] = particle_id
 
-                                    line = ' '.join( [ linesplit[particleID_indexSP], linesplit[class_indexSP], linesplit[rot_indexSP], linesplit[tilt_indexSP], linesplit[psi_indexSP] ] )
+                                ids.append( particle_id )
+                                classes.append( linesplit[class_indexSP] )
+                                rots.append( linesplit[rot_indexSP] )
+                                tilts.append( linesplit[tilt_indexSP] )
+                                psis.append( linesplit[psi_indexSP] )
 
-                                    if line[0] != '#':      # avoid the stupid comment line
-                                        stardata.append( line )
+                                if len( ids ) == chunk_size:
+                                        storeChunk()
+                                        ids, classes, rots, tilts, psis = [], [], [], [], []
 
-                                        minimal_subparticle_array[subparticle_index]['ParticleImageName'] = linesplit[particleID_indexSP] 
-                                        minimal_subparticle_array[subparticle_index]['Class']     = linesplit[ class_indexSP ]
-                                        minimal_subparticle_array[subparticle_index]['EulerRot']  = linesplit[ rot_indexSP   ]
-                                        minimal_subparticle_array[subparticle_index]['EulerTilt'] = linesplit[ tilt_indexSP  ]
-                                        minimal_subparticle_array[subparticle_index]['EulerPsi']  = linesplit[ psi_indexSP   ]
+        storeChunk()
+        minimal_subparticle_array = np.concatenate( chunks )
 
-                                        subparticle_index = subparticle_index + 1
+        return sortMinimalStarData( minimal_subparticle_array ), name_ids
 
-        print( "  --> sorting based on particle image name." )
-        minimal_subparticle_array.sort(order='ParticleImageName')
-        print( "  --> done!" )
 
-#        sys.exit()
+def getCachedMinimalStarData( my_star, name_ids, chunk_size=STAR_READ_CHUNK ):
+        """ As getMinimalStarData, from memory-mapped sidecar columns rather than the star text """
+
+        table = getStarTable( my_star, labels=MINIMAL_STAR_LABELS, chunk_size=chunk_size, cache=True )
+        names = table['rlnImageOriginalName']
+
+        ### IDs in order of first appearance, as the streaming pass hands them out
+        unique_names, first_row, name_of_row = np.unique( names, return_index=True, return_inverse=True )
+        first_order = np.argsort( first_row )
+        unique_ids = np.empty( len( unique_names ), dtype=np.int64 )
+        unique_ids[first_order] = [ name_ids.setdefault( name, len( name_ids ) ) for name in unique_names[first_order].tolist() ]
+
+        minimal_subparticle_array = np.zeros( len( table ), dtype=MINIMAL_STAR_DTYPE )
+        minimal_subparticle_array['ParticleID'] = unique_ids[name_of_row]
+        minimal_subparticle_array['Class']      = table['rlnClassNumber']
+        minimal_subparticle_array['EulerRot']   = table['rlnAngleRot']
+        minimal_subparticle_array['EulerTilt']  = table['rlnAngleTilt']
+        minimal_subparticle_array['EulerPsi']   = table['rlnAnglePsi']
+
+        return sortMinimalStarData( minimal_subparticle_array ), name_ids
+
+
+def sortMinimalStarData( minimal_subparticle_array ):
+        print( "  --> sorting based on particle." )
+        order = np.lexsort( ( minimal_subparticle_array['EulerPsi'], minimal_subparticle_array['EulerTilt'],
+                              minimal_subparticle_array['EulerRot'], minimal_subparticle_array['Class'],
+                              minimal_subparticle_array['ParticleID'] ) )
+        minimal_subparticle_array = minimal_subparticle_array[order]
+        print( "  --> done!" )
 
         return minimal_subparticle_array
 
 
+def getLabelDtype( label ):
+        """ Default column type used by getStarTable """
+        if label in STAR_INT_LABELS:
+                return np.int64
+        elif label in STAR_STRING_LABELS:
+                return str
+        else:
+                return np.float64
+
+
+def convertStarColumn( column, dtype ):
+        """ Convert one column of star text. Returns the column and the dtype actually used """
+        if dtype is str:
+                return column, str
+
+        try:
+                return column.astype( dtype ), dtype
+        except ValueError:
+                ### e.g. an integer label written as 1.000000, or free text in an unlisted label
+                if dtype is np.int64:
+                        return convertStarColumn( column, np.float64 )
+                return column, str
+
+
+class _StarBlockReader:
+        """ Collects the rows of one data block as typed columns, chunk_size rows at a time """
+
+        def __init__( self, block, header, labels, star_labels, as_text ):
+                self.block = block
+                self.header = header
+                self.star_labels = star_labels
+                self.labels = star_labels if labels is None else labels
+                self.wanted = [ star_labels.index( label ) for label in self.labels ]
+                self.dtypes = [ str if as_text else getLabelDtype( label ) for label in self.labels ]
+                self.parts = [ [] for label in self.labels ]
+                self.rows = []
+
+        def append( self, linesplit, chunk_size ):
+                self.rows.append( linesplit )
+                if len( self.rows ) >= chunk_size:
+                        self.convertChunk()
+
+        def convertChunk( self ):
+                if not self.rows:
+                        return
+                chunk = np.array( self.rows )
+                for position, column_number in enumerate( self.wanted ):
+                        column, dtype = convertStarColumn( chunk[:,column_number], self.dtypes[position] )
+                        if dtype is not self.dtypes[position]:
+                                ### Column could not keep its type. Recast what has been read so far.
+                                self.dtypes[position] = dtype
+                                self.parts[position] = [ part.astype( column.dtype ) for part in self.parts[position] ]
+                        self.parts[position].append( column )
+                del self.rows[:]
+
+        def chunk( self ):
+                """ Rows appended since the last call as a StarTable, then start over """
+                table = self.table()
+                self.parts = [ [] for label in self.labels ]
+                return table
+
+        def table( self ):
+                self.convertChunk()
+                columns = []
+                for position, label in enumerate( self.labels ):
+                        if self.parts[position]:
+                                columns.append( np.concatenate( self.parts[position] ) )
+                        else:
+                                columns.append( np.array( [], dtype=self.dtypes[position] ) )
+                return StarTable( self.labels, columns, self.block, self.header )
+
+
+def getStarBlocks( my_star, blocks=None, labels=None, text_blocks=(), chunk_size=STAR_READ_CHUNK, cache=False ):
+        """ Every data block of a star file as a StarTable, from a single pass over the text """
+        """ Returns an OrderedDict, e.g. { 'data_optics': optics, 'data_particles': particles } """
+        """ blocks limits which blocks are kept. The scan stops once all of them have been read. """
+        """ labels is a dict of block -> labels to keep. Blocks in text_blocks keep their star text """
+        """ rather than converting to numbers, e.g. so unchanged columns can be written back verbatim. """
+        """ Each table's header holds the file's text ahead of its first row, including earlier blocks. """
+        """ With cache=True the blocks, by default STAR_CACHE_BLOCKS, go through getCachedStarBlocks. """
+
+        if cache:
+                return getCachedStarBlocks( my_star, STAR_CACHE_BLOCKS if blocks is None else blocks, labels, text_blocks, chunk_size )
+
+        if labels is None:
+                labels = {}
+
+        tables = collections.OrderedDict()
+        preamble = []           # text seen so far, bar the rows of long blocks
+        pending = []            # rows of the current block, while it is short enough to keep as text
+        block = None
+        star_labels = []
+        reader = None
+        seen_rows = False
+
+        def finishBlock():
+                if reader is not None:
+                        tables[block] = reader.table()
+                elif block is not None and ( blocks is None or block in blocks ):
+                        ### No rows. Labels only.
+                        block_labels = labels.get( block )
+                        reader_empty = _StarBlockReader( block, preamble[:], block_labels, star_labels, block in text_blocks )
+                        tables[block] = reader_empty.table()
+
+        with open(my_star, "r") as f:
+
+                for line in f:
+
+                        stripped = line.strip()
+
+                        if stripped.startswith( 'data_' ):
+                                finishBlock()
+                                if blocks is not None and all( [ wanted_block in tables for wanted_block in blocks ] ):
+                                        break           # everything asked for has been read
+                                if pending is not None:
+                                        preamble.extend( pending )
+                                pending = []
+                                block = stripped
+                                star_labels = []
+                                reader = None
+                                seen_rows = False
+                                preamble.append( line.rstrip( '\n' ) )
+                                continue
+
+                        linesplit = line.split()
+
+                        if block is not None and star_labels and len( linesplit ) == len( star_labels ) and stripped[0] not in '#_':
+
+                                seen_rows = True
+                                if pending is not None:
+                                        pending.append( line.rstrip( '\n' ) )
+                                        if len( pending ) > chunk_size:
+                                                pending = None          # too long to keep a copy of the text
+
+                                if blocks is not None and block not in blocks:
+                                        continue
+
+                                if reader is None:
+                                        reader = _StarBlockReader( block, preamble[:], labels.get( block ), star_labels, block in text_blocks )
+                                reader.append( linesplit, chunk_size )
+                                continue
+
+                        if not seen_rows:
+                                preamble.append( line.rstrip( '\n' ) )
+                                if block is not None and line.startswith( '_' ):
+                                        star_labels.append( line[1:].split()[0] )
+                        elif pending is not None:
+                                pending.append( line.rstrip( '\n' ) )
+                else:
+                        finishBlock()
+
+        return tables
+
+
+def getStarTable( my_star, block='data_particles', labels=None, chunk_size=STAR_READ_CHUNK, cache=False ):
+        """ Read one data block into a StarTable of typed columns, keyed by label """
+        """ Text is converted chunk_size rows at a time, so the whole file is never held as strings """
+        """ Pass labels to keep only some columns, e.g. [ 'rlnAngleRot', 'rlnAngleTilt', 'rlnAnglePsi' ] """
+        """ With cache=True the block is loaded from, or saved to, a binary sidecar. See getCachedStarTable. """
+
+        if cache:
+                return getCachedStarTable( my_star, block, labels, chunk_size )
+
+        tables = getStarBlocks( my_star, [ block ], { block: labels }, chunk_size=chunk_size )
+        if block in tables:
+                return tables[block]
+
+        if labels is None:
+                labels = []
+        return StarTable( labels, [ np.array( [], dtype=getLabelDtype( label ) ) for label in labels ], block, [] )
+
+
+def iterStarTable( my_star, block='data_particles', labels=None, chunk_size=STAR_READ_CHUNK ):
+        """ One data block as a series of StarTables of at most chunk_size rows, typed as for getStarTable """
+        """ Only one chunk is held at a time, e.g. for running statistics over files too large to load """
+        """ Labels not in the file are left out, so check for them in each chunk """
+
+        star_labels = []
+        reader = None
+        in_block = False
+
+        with open(my_star, "r") as f:
+
+                for line in f:
+
+                        stripped = line.strip()
+
+                        if stripped.startswith( 'data_' ):
+                                if in_block:
+                                        break           # past the end of the block
+                                in_block = ( stripped == block )
+                                continue
+
+                        if not in_block:
+                                continue
+
+                        linesplit = line.split()
+
+                        if star_labels and len( linesplit ) == len( star_labels ) and stripped[0] not in '#_':
+                                if reader is None:
+                                        wanted = None if labels is None else [ label for label in labels if label in star_labels ]
+                                        reader = _StarBlockReader( block, None, wanted, star_labels, False )
+                                reader.rows.append( linesplit )
+                                if len( reader.rows ) >= chunk_size:
+                                        yield reader.chunk()
+                                continue
+
+                        if reader is None and line.startswith( '_' ):
+                                star_labels.append( line[1:].split()[0] )
+
+        if reader is not None and reader.rows:
+                yield reader.chunk()
+
+
+def joinOptics( particles, optics, labels=None ):
+        """ Copy per-optics-group values onto every particle, matched on rlnOpticsGroup """
+        """ e.g. joinOptics( particles, optics, [ 'rlnImagePixelSize' ] ). By default every optics """
+        """ label not already in particles is joined. particles is updated in place and returned. """
+
+        if labels is None:
+                labels = [ label for label in optics.labels if label not in particles and label != 'rlnOpticsGroup' ]
+
+        optics_groups = np.asarray( optics['rlnOpticsGroup'] ).astype( np.float64 ).astype( np.int64 )
+        particle_groups = np.asarray( particles['rlnOpticsGroup'] ).astype( np.float64 ).astype( np.int64 )
+
+        order = np.argsort( optics_groups )
+        rows = np.searchsorted( optics_groups, particle_groups, sorter=order )
+        rows = order[ np.minimum( rows, len( order ) - 1 ) ]
+        if len( particle_groups ) and ( len( order ) == 0 or np.any( optics_groups[rows] != particle_groups ) ):
+                print( "Error: particles refer to optics groups not found in data_optics. Exiting now." )
+                sys.exit()
+
+        for label in labels:
+                particles[label] = np.asarray( optics[label] )[rows]
+
+        return particles
+
+
+def getStarHeaderFromTable( particles, regen_string=None ):
+        """ header and full_header, as getStarHeader returns them, from a table read by getStarBlocks """
+        """ Adds the custom ISECC labels when missing. regen_string as for getStarHeader. """
+        header = list( particles.labels )
+        full_header = []
+
+        # Add run info to output star file
+        date = str( datetime.now() )
+        full_header.append( ''.join( [ '# SCRIPT_RUN_DATE: ', date ] ).strip() )
+        full_header.append( ''.join( [ '# SCRIPT_VERSION: ', sys.argv[0] ] ).strip() )
+        full_header.append( ''.join( [ '# SCRIPT_ARGS: ', ' '.join( sys.argv[1:] ) ] ).strip() )
+
+        START_PARSE = None      # Needed for relion 3.1 star format
+        for line in particles.header:
+
+                if START_PARSE == None:
+                        ### Store full header for final output
+                        full_header.append( line.strip() )
+
+                if line.strip() == particles.block:
+                        START_PARSE = True
+
+                if START_PARSE:
+                        if line.startswith('loop_'):
+                                full_header.append( '' )
+                                full_header.append( line.strip() )
+                        if line.startswith('_rln'):
+                                full_header.append( line.strip() )
+
+        for label in STAR_CUSTOM_LABELS:
+                if label not in header:
+                        header.append( label )
+                        full_header.append( ''.join( [ '_', label, ' #', str( len( header ) ) ] ) )
+
+        ### Add info for how to regenerate subparticles
+        if regen_string and '--timestamp_run' not in full_header[2] :
+                full_header[2] = ' '.join( [ full_header[2], '--timestamp_run', regen_string ] )
+
+        return header, full_header
+
+
+def getStarFile( my_star, regen_string=None, chunk_size=STAR_READ_CHUNK, cache=False ):
+        """ header, full_header and the data_particles text array as getStarHeader and getStarData """
+        """ give them, plus the typed data_optics table, from one pass over the file """
+        """ Missing custom ISECC columns are filled with the same placeholders as getStarData """
+        """ With cache=True the blocks are read through getCachedStarBlocks """
+
+        tables = getStarBlocks( my_star, text_blocks=( 'data_particles', ), chunk_size=chunk_size, cache=cache )
+        if 'data_particles' not in tables:
+                print( "Error: no data_particles block in", my_star, ". Exiting now." )
+                sys.exit()
+
+        particles = tables['data_particles']
+        header, full_header = getStarHeaderFromTable( particles, regen_string )
+
+        columns = [ particles[label] for label in particles.labels ]
+        for label in header[len( particles.labels ):]:
+                columns.append( np.full( len( particles ), STAR_CUSTOM_LABELS[label] ) )
+
+        stardata = np.stack( columns, axis=1 ) if columns else np.zeros( ( 0, 0 ), dtype=str )
+
+        return header, full_header, stardata, tables.get( 'data_optics' )
+
+
+def getStarCachePath( my_star, block='data_particles', as_text=False ):
+        """ Sidecar directory holding the cached columns of one data block """
+        """ Text columns, as getStarBlocks keeps for text_blocks, are cached apart from typed ones """
+        if as_text:
+                block = ''.join( [ block, STAR_CACHE_TEXT_SUFFIX ] )
+        return os.path.join( ''.join( [ os.path.abspath( my_star ), STAR_CACHE_SUFFIX ] ), block )
+
+
+def getStarCacheKey( my_star ):
+        """ Identifies the source file. Any change to path, size or mtime makes the cache stale. """
+        stat = os.stat( my_star )
+        return { 'source': os.path.abspath( my_star ), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns }
+
+
+def _cacheColumnPath( cache_path, position ):
+        ### By position, as labels are not guaranteed to be safe file names
+        return os.path.join( cache_path, ''.join( [ 'column', str( position ).zfill( 4 ), '.npy' ] ) )
+
+
+def writeStarCache( my_star, table, as_text=False ):
+        """ Save a StarTable as a sidecar: one .npy per column, plus labels, header and source key """
+        """ Written to a temporary directory first, so an interrupted run never leaves a partial cache """
+
+        cache_path = getStarCachePath( my_star, table.block, as_text )
+        cache_root = os.path.dirname( cache_path )
+        os.makedirs( cache_root, exist_ok=True )
+
+        temp_path = tempfile.mkdtemp( dir=cache_root, prefix='.incomplete_' )
+        try:
+                ### mkdtemp makes the directory private. Open it up as the umask allows, as for any
+                ### other new directory, so a cache written in a shared project is readable by the group.
+                umask = os.umask( 0 )
+                os.umask( umask )
+                os.chmod( temp_path, 0o777 & ~umask )
+
+                for position, label in enumerate( table.labels ):
+                        np.save( _cacheColumnPath( temp_path, position ), np.ascontiguousarray( table[label] ) )
+
+                metadata = getStarCacheKey( my_star )
+                metadata['block'] = table.block
+                metadata['as_text'] = as_text
+                metadata['labels'] = table.labels
+                metadata['header'] = table.header
+                with open( os.path.join( temp_path, STAR_CACHE_METADATA ), 'w' ) as f:
+                        json.dump( metadata, f )
+
+                if os.path.isdir( cache_path ):
+                        shutil.rmtree( cache_path )
+                os.rename( temp_path, cache_path )
+        except:
+                shutil.rmtree( temp_path, ignore_errors=True )
+                raise
+
+        return cache_path
+
+
+def readStarCache( my_star, block='data_particles', labels=None, as_text=False ):
+        """ StarTable of read-only memory-mapped columns from the sidecar """
+        """ Returns None if there is no cache, if it cannot be read, or if it no longer matches the source file """
+        """ Labels not in the block are left out, as for getStarTable """
+
+        cache_path = getStarCachePath( my_star, block, as_text )
+        try:
+                with open( os.path.join( cache_path, STAR_CACHE_METADATA ), 'r' ) as f:
+                        metadata = json.load( f )
+        except ( IOError, ValueError ):
+                return None
+
+        key = getStarCacheKey( my_star )
+        if any( [ metadata.get( item ) != key[item] for item in key ] ):
+                print( "  Cache for", my_star, "is stale and will be rebuilt." )
+                return None
+
+        if labels is None:
+                labels = metadata['labels']
+        labels = [ label for label in labels if label in metadata['labels'] ]
+
+        columns = []
+        try:
+                for label in labels:
+                        position = metadata['labels'].index( label )
+                        column = np.load( _cacheColumnPath( cache_path, position ), mmap_mode='r' )
+                        columns.append( column )
+        except ( IOError, OSError, ValueError ) as error:
+                ### e.g. a cache written by another user without group read permission
+                print( "  Could not read star cache for", my_star, ":", error )
+                return None
+
+        return StarTable( labels, columns, block, metadata['header'] )
+
+
+def getCachedStarBlocks( my_star, blocks=STAR_CACHE_BLOCKS, labels=None, text_blocks=(), chunk_size=STAR_READ_CHUNK ):
+        """ As getStarBlocks, through binary sidecars next to the star file (my.star -> my.star.cache/) """
+        """ The first call parses the text once and saves every column of each block. Later calls memory-map """
+        """ the saved columns instead. Caches are rebuilt whenever the star file's size or mtime changes. """
+        """ Blocks absent from the file are left out, and mean the text is parsed again on every call. """
+
+        if labels is None:
+                labels = {}
+
+        tables = collections.OrderedDict()
+        for block in blocks:
+                table = readStarCache( my_star, block, labels.get( block ), block in text_blocks )
+                if table is None:
+                        break
+                tables[block] = table
+        else:
+                return tables
+
+        parsed = getStarBlocks( my_star, blocks, None, text_blocks, chunk_size )
+
+        tables = collections.OrderedDict()
+        for block, table in parsed.items():
+                as_text = block in text_blocks
+                try:
+                        writeStarCache( my_star, table, as_text )
+                        cached = readStarCache( my_star, block, labels.get( block ), as_text )
+                except ( IOError, OSError ) as error:
+                        ### e.g. a read-only data directory. Carry on without the cache.
+                        print( "  Could not write star cache for", my_star, ":", error )
+                        cached = None
+
+                if cached is None:
+                        block_labels = [ label for label in labels.get( block, table.labels ) if label in table ]
+                        cached = StarTable( block_labels, [ table[label] for label in block_labels ], block, table.header )
+                tables[block] = cached
+
+        return tables
+
+
+def getCachedStarTable( my_star, block='data_particles', labels=None, chunk_size=STAR_READ_CHUNK ):
+        """ As getStarTable, through the binary sidecar of getCachedStarBlocks """
+        tables = getCachedStarBlocks( my_star, [ block ], { block: labels }, chunk_size=chunk_size )
+        if block in tables:
+                return tables[block]
+
+        if labels is None:
+                labels = []
+        return StarTable( labels, [ np.array( [], dtype=getLabelDtype( label ) ) for label in labels ], block, [] )
+
+
+def setStarHeaderValue( fullheader, block, label, value ):
+        """ Set label to value on every row of block, where the block is held in the header text """
+        """ e.g. rlnImageSize in data_optics after re-boxing. Returns a new list of header lines. """
+
+        fullheader = list( fullheader )
+        block_labels = []
+        START_PARSE = None
+
+        for line_number, line in enumerate( fullheader ):
+
+                stripped = str( line ).strip()
+
+                if stripped.startswith( 'data_' ):
+                        START_PARSE = ( stripped == block )
+                        block_labels = []
+                        continue
+
+                if not START_PARSE:
+                        continue
+
+                if stripped.startswith( '_' ):
+                        block_labels.append( stripped[1:].split()[0] )
+                        continue
+
+                linesplit = stripped.split()
+                if label in block_labels and len( linesplit ) == len( block_labels ) and stripped[0] != '#':
+                        linesplit[ block_labels.index( label ) ] = str( value )
+                        fullheader[line_number] = ' '.join( linesplit )
+
+        return fullheader
+
+
+def openStarFile( filename, fullheader ):
+        """ Buffered handle for streamed star output. The header is written before returning. """
+        f = open( filename, 'w', buffering=STAR_WRITE_BUFFER )
+        f.write( ''.join( [ ''.join( [ str(line), '\n' ] ) for line in fullheader ] ) )
+        return f
+
+
+def formatStarColumn( column ):
+        """ Text for one star column. Strings pass through, numbers print as str() would. """
+        column = np.asarray( column )
+        if column.dtype.kind == 'U':
+                return column
+        if column.dtype.kind == 'S':
+                return np.char.decode( column )
+        return column.astype( str )
+
+
+def formatStarRows( columns, start=0, stop=None ):
+        """ Star text for rows start:stop, one line per row """
+        """ columns is a 2d string ndarray (as from getStarData), or a list with one entry per label """
+        """ List entries may be typed 1d arrays or single values repeated on every row """
+
+        if isinstance( columns, np.ndarray ) and columns.ndim == 2:
+                columns = columns.T
+
+        if stop is None:
+                stop = max( [ len( column ) for column in columns if np.ndim( column ) > 0 ] + [ 0 ] )
+
+        text = []
+        for column in columns:
+                if np.ndim( column ) == 0:
+                        text.append( [ formatStarColumn( [ column ] )[0] ] * ( stop - start ) )
+                else:
+                        text.append( formatStarColumn( column[start:stop] ).tolist() )
+
+        return ''.join( [ ''.join( [ ' '.join( row ), '\n' ] ) for row in zip( *text ) ] )
+
+
+def writeStarRows( f, columns, chunk_size=STAR_WRITE_CHUNK ):
+        """ Append rows to an open star file, chunk_size rows at a time """
+        """ columns is as for formatStarRows, or text it already returned """
+
+        if isinstance( columns, str ):
+                f.write( columns )
+                return columns.count( '\n' )
+
+        if isinstance( columns, np.ndarray ) and columns.ndim == 2:
+                columns = list( columns.T )
+
+        num_rows = max( [ len( column ) for column in columns if np.ndim( column ) > 0 ] + [ 0 ] )
+
+        for start in range( 0, num_rows, chunk_size ):
+                f.write( formatStarRows( columns, start, min( start + chunk_size, num_rows ) ) )
+
+        return num_rows
+
+
+def writeStarFile( filename, fullheader, columns, chunk_size=STAR_WRITE_CHUNK ):
+        """ Header plus rows in one call. See writeStarRows. """
+        f = openStarFile( filename, fullheader )
+        writeStarRows( f, columns, chunk_size )
+        f.close()
+        return
+
+
+####
+## Decoders for the ISECC custom columns. Each parses a whole column at once.
+####
+
+def decodeVertexGroups( vertex_groups ):
+        """ rlnCustomVertexGroup strings, e.g. 5f01a.3f01a.2f01a or 5f01, as ints """
+        """ Returns a VERTEX_GROUP_DTYPE array. Vertex numbers are as written. Rotation letters a-e are 0-4, """
+        """ and -1 where there is none (a single-vertex ROI, or z). Parts absent from a string are 0 and -1. """
+        vertex_groups = np.asarray( vertex_groups ).astype( 'S17' )
+        characters = np.zeros( ( len( vertex_groups ), 18 ), dtype=np.uint8 )
+        characters[:,:17] = vertex_groups.view( np.uint8 ).reshape( len( vertex_groups ), 17 )
+
+        ### Rotation letter for every byte value
+        letters = np.full( 256, -1, dtype=np.int8 )
+        letters[ np.frombuffer( VERTEX_ROTATION_LETTERS.encode(), dtype=np.uint8 ) ] = np.arange( len( VERTEX_ROTATION_LETTERS ) )
+
+        decoded = np.zeros( len( vertex_groups ), dtype=VERTEX_GROUP_DTYPE )
+        for vertex in VERTEX_GROUP_ORDERS:
+                decoded[ ''.join( [ 'Vertex', vertex, '_specific' ] ) ] = -1
+
+        ### Up to three parts of six characters, each NNfDDx. NN says which vertex the part is for.
+        for part in range( 3 ):
+                part_characters = characters[ :, 6*part : 6*part+6 ]
+                digits = part_characters[:,2:4].astype( np.int32 ) - ord('0')
+                for vertex in VERTEX_GROUP_ORDERS:
+                        is_vertex = ( part_characters[:,0] == ord( vertex[0] ) ) & ( part_characters[:,1] == ord('f') )
+                        general = ''.join( [ 'Vertex', vertex, '_general' ] )
+                        specific = ''.join( [ 'Vertex', vertex, '_specific' ] )
+                        decoded[general] = np.where( is_vertex, ( 10 * digits[:,0] ) + digits[:,1], decoded[general] )
+                        decoded[specific] = np.where( is_vertex, letters[ part_characters[:,4] ], decoded[specific] )
+
+        return decoded
+
+
+def decodeXYZ( xyz_strings ):
+        """ rlnCustomOriginXYZAngstWrtParticleCenter strings, e.g. 12.5,-3.0,101.2, as an (N,3) float64 array """
+        xyz_strings = np.asarray( xyz_strings ).astype( str )
+        if len( xyz_strings ) == 0:
+                return np.zeros( ( 0, 3 ) )
+        return np.array( ','.join( xyz_strings ).split( ',' ), dtype=np.float64 ).reshape( len( xyz_strings ), 3 )
+
+
+def decodeUIDs( uids ):
+        """ rlnCustomUID strings, e.g. subparticleUID_000000001, as int64 numbers """
+        uids = np.asarray( uids ).astype( str )
+        return np.char.rpartition( uids, '_' )[:,2].astype( np.int64 )
+
+
+def _lookup( header, label ):
+        """ Index of label in a header list. For a StarTable, the column itself. """
+        if isinstance( header, StarTable ):
+                return header[ label ]
+        return header.index( label )
+
 
 def getApix( header ):
-        det_pixelsize_index= header.index('rlnDetectorPixelSize')
-        mag_index = header.index('rlnMagnification')
+        det_pixelsize_index= _lookup( header, 'rlnDetectorPixelSize' )
+        mag_index = _lookup( header, 'rlnMagnification' )
         return det_pixelsize_index, mag_index
 
 def calculateAngpix( detectorPixelSize, Magnification ):
@@ -298,55 +1002,73 @@ def calculateAngpix( detectorPixelSize, Magnification ):
         return apix
 
 def getEulers( header ):
-        rot_index = header.index('rlnAngleRot')
-        tilt_index = header.index('rlnAngleTilt')
-        psi_index = header.index('rlnAnglePsi')
+        rot_index = _lookup( header, 'rlnAngleRot' )
+        tilt_index = _lookup( header, 'rlnAngleTilt' )
+        psi_index = _lookup( header, 'rlnAnglePsi' )
         return rot_index, tilt_index, psi_index
 
 def getOffsets( header ):
-        originX_index = header.index('rlnOriginX')
-        originY_index = header.index('rlnOriginY')
-        originXPrior_index = header.index('rlnOriginXPrior') 
-        originYPrior_index = header.index('rlnOriginYPrior')
+        originX_index = _lookup( header, 'rlnOriginX' )
+        originY_index = _lookup( header, 'rlnOriginY' )
+        originXPrior_index = _lookup( header, 'rlnOriginXPrior' ) 
+        originYPrior_index = _lookup( header, 'rlnOriginYPrior' )
 
         return originX_index, originY_index, originXPrior_index, originYPrior_index
 
 def getOffsetAngst( header ):
-        originXAngst_index = header.index('rlnOriginXAngst')
-        originYAngst_index = header.index('rlnOriginYAngst')
+        originXAngst_index = _lookup( header, 'rlnOriginXAngst' )
+        originYAngst_index = _lookup( header, 'rlnOriginYAngst' )
 
         return originXAngst_index, originYAngst_index
 
+def getOffsetsAngst( header ):
+        return getOffsetAngst( header )
+
+def getOffsetPriorsAngst( header ):
+        return getOffsetAngstPriors( header )
+
+def getEulerPriors( header ):
+        rotPrior_index = _lookup( header, 'rlnAngleRotPrior' )
+        tiltPrior_index = _lookup( header, 'rlnAngleTiltPrior' )
+        psiPrior_index = _lookup( header, 'rlnAnglePsiPrior' )
+        return rotPrior_index, tiltPrior_index, psiPrior_index
+
+def getOffsetAngstPriors( header ):
+        originXPriorAngst_index = _lookup( header, 'rlnOriginXPriorAngst' )
+        originYPriorAngst_index = _lookup( header, 'rlnOriginYPriorAngst' )
+
+        return originXPriorAngst_index, originYPriorAngst_index
+
 def getDefocus( header ):
-        defocusU_index = header.index('rlnDefocusU')
-        defocusV_index = header.index('rlnDefocusV')
-        defocusAngle_index = header.index('rlnDefocusAngle')
+        defocusU_index = _lookup( header, 'rlnDefocusU' )
+        defocusV_index = _lookup( header, 'rlnDefocusV' )
+        defocusAngle_index = _lookup( header, 'rlnDefocusAngle' )
         return defocusU_index, defocusV_index, defocusAngle_index
 
 def getClass( header ):
-        class_index = header.index('rlnClassNumber')
+        class_index = _lookup( header, 'rlnClassNumber' )
         return class_index
 
 def getUID( header ) :
-        uid_index = header.index('rlnCustomUID')
+        uid_index = _lookup( header, 'rlnCustomUID' )
         return uid_index
 
 def getVertexGroup( header ) :
-        vertexGroup_index = header.index('rlnCustomVertexGroup')
+        vertexGroup_index = _lookup( header, 'rlnCustomVertexGroup' )
         return vertexGroup_index
 
 def getOriginXYZAngstWrtParticleCenter( header ) :
-        OriginXYZAngstWrtParticleCenter_index = header.index('rlnCustomOriginXYZAngstWrtParticleCenter')
+        OriginXYZAngstWrtParticleCenter_index = _lookup( header, 'rlnCustomOriginXYZAngstWrtParticleCenter' )
         return OriginXYZAngstWrtParticleCenter_index
 
 def getCustomRelativePose( header ) :
-        relativePose_index = header.index('rlnCustomRelativePose')
+        relativePose_index = _lookup( header, 'rlnCustomRelativePose' )
         return relativePose_index
 
 def getMicrographName( header ) :
         # rlnMicrographName
-        micrographname_index = header.index('rlnMicrographName')
-        imagename_index = header.index('rlnImageName')
-        particleID_index = header.index('rlnImageOriginalName')
+        micrographname_index = _lookup( header, 'rlnMicrographName' )
+        imagename_index = _lookup( header, 'rlnImageName' )
+        particleID_index = _lookup( header, 'rlnImageOriginalName' )
 
         return micrographname_index, imagename_index, particleID_index
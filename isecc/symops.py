@@ -1,8 +1,25 @@
 #!/usr/bin/env python3.5
 
 import numpy as np
+from scipy.spatial import cKDTree
 
-def getSymOps():
+### Golden ratio. Icosahedral quaternion components are 0, 1/(2*PHI), 1/2, PHI/2 and 1.
+PHI = np.true_divide( 1 + np.sqrt(5), 2 )
+
+### Idealized vertices, as in checks.checkVector. For I2, x and y are swapped.
+I1_AXES = { 'fivefold':  np.array( [ 0.000, np.true_divide( 1, PHI ), 1.000 ] ),
+            'threefold': np.array( [ np.true_divide( 1, PHI**2 ), 0.000, 1.000 ] ),
+            'twofold':   np.array( [ 0.000, 0.000, 1.000 ] ) }
+
+I2_AXES = { 'fivefold':  np.array( [ np.true_divide( 1, PHI ), 0.000, 1.000 ] ),
+            'threefold': np.array( [ 0.000, np.true_divide( 1, PHI**2 ), 1.000 ] ),
+            'twofold':   np.array( [ 0.000, 0.000, 1.000 ] ) }
+
+### Built once per session by getSymmetryGroup
+_symmetry_groups = {}
+
+
+def getSymOps( sym='I1' ):
 
     ### Generate array containing I1 rotations ready for pyQuaternion in format [ a, bi, cj, dk ]
     I1Quaternions = np.array( [ [ 1.000, 0.000, 0.000, 0.000 ],    [ 0.000, 1.000, 0.000, 0.000 ],
@@ -67,4 +84,119 @@ def getSymOps():
                                 [ 0.000, -0.500, 0.809, 0.309 ],   [ 0.000, 0.500, 0.809, -0.309 ],          
                                 [ 0.000, 0.809, 0.309, -0.500 ],   [ 0.000, 0.000, 1.000, 0.000 ]     ]    )
 
+    if sym == 'I2':
+        return I2Quaternions
+
     return I1Quaternions
+
+
+def idealizeQuaternions( quaternions ):
+    """ Replace the 3-decimal components of getSymOps with exact values, then renormalize """
+    exact_values = np.array( [ 0.0, np.true_divide( 1, 2*PHI ), 0.5, np.true_divide( PHI, 2 ), 1.0 ] )
+
+    magnitude = np.absolute( quaternions )
+    nearest = np.argmin( np.absolute( magnitude[...,np.newaxis] - exact_values ), axis=-1 )
+    exact = np.sign( quaternions ) * exact_values[nearest]
+
+    return exact / np.linalg.norm( exact, axis=-1, keepdims=True )
+
+
+def quaternionMatrices( quaternions ):
+    """ (N,3,3) rotation matrices for unit quaternions in [ a, bi, cj, dk ] order """
+    a, b, c, d = quaternions[:,0], quaternions[:,1], quaternions[:,2], quaternions[:,3]
+    return np.stack( [ np.stack( [ a*a + b*b - c*c - d*d, 2*(b*c - a*d), 2*(b*d + a*c) ], axis=-1 ),
+                       np.stack( [ 2*(b*c + a*d), a*a - b*b + c*c - d*d, 2*(c*d - a*b) ], axis=-1 ),
+                       np.stack( [ 2*(b*d - a*c), 2*(c*d + a*b), a*a - b*b - c*c + d*d ], axis=-1 ) ], axis=-2 )
+
+
+class SymmetryGroup:
+    """ Icosahedral rotation group with precomputed tables. Use getSymmetryGroup rather than building directly. """
+    """ Indices everywhere refer to rows of getSymOps( sym ), so lookups agree with the existing scripts. """
+
+    def __init__(self, sym='I1'):
+        self.sym = sym
+        self.order = 60
+
+        """ Exact unit quaternions and matching rotation matrices """
+        self.quaternions = idealizeQuaternions( getSymOps( sym ) )
+        self.rotation_matrices = quaternionMatrices( self.quaternions )
+
+        """ multiplication_table[i,j] is the index of quaternions[i] * quaternions[j] """
+        """ q and -q are the same rotation, so match on |q1 . q2| """
+        a1, b1, c1, d1 = [ self.quaternions[:,np.newaxis,x] for x in range(4) ]
+        a2, b2, c2, d2 = [ self.quaternions[np.newaxis,:,x] for x in range(4) ]
+        products = np.stack( [ a1*a2 - b1*b2 - c1*c2 - d1*d2,
+                               a1*b2 + b1*a2 + c1*d2 - d1*c2,
+                               a1*c2 - b1*d2 + c1*a2 + d1*b2,
+                               a1*d2 + b1*c2 - c1*b2 + d1*a2 ], axis=-1 )
+        overlap = np.absolute( np.dot( products, self.quaternions.T ) )
+        self.multiplication_table = np.argmax( overlap, axis=-1 )
+
+        """ Index of the identity, and of each operator's inverse """
+        self.identity = int( np.argmax( np.absolute( self.quaternions[:,0] ) ) )
+        self.inverse = np.argmax( self.multiplication_table == self.identity, axis=1 )
+
+        """ Coset partitions by where each operator sends the 5f, 3f and 2f axes """
+        """ Same convention as Quaternion( symop ).rotate( axis ) """
+        if sym == 'I2':
+            axes = I2_AXES
+        else:
+            axes = I1_AXES
+
+        self.axes = {}
+        self.vertices = {}
+        self.vertex_assignment = {}
+        self.partitions = {}
+
+        for roi, axis in axes.items():
+            axis = np.true_divide( axis, np.linalg.norm( axis ) )
+            rotated = np.dot( self.rotation_matrices, axis )
+
+            ### Quantize to group the images of the axis. Vertices are numbered by first appearance.
+            keys = np.around( rotated, decimals=6 ) + 0.0    # no negative zeros
+            unique_keys, first_index, assignment = np.unique( keys, axis=0, return_index=True, return_inverse=True )
+            order = np.argsort( first_index )
+            renumber = np.argsort( order )
+
+            self.axes[roi] = axis
+            self.vertices[roi] = rotated[ first_index[order] ]
+            self.vertex_assignment[roi] = renumber[ assignment.ravel() ]
+            self.partitions[roi] = [ np.where( self.vertex_assignment[roi] == vertex )[0] for vertex in range( len( order ) ) ]
+
+    def multiply(self, i, j):
+        """ Index of quaternions[i] * quaternions[j] """
+        return self.multiplication_table[i,j]
+
+    def relatedOperators(self, index, roi):
+        """ Operators that send the roi axis to the same vertex as operator index """
+        return self.partitions[roi][ self.vertex_assignment[roi][index] ]
+
+
+def uniqueOrbit( vectors, tolerance ):
+    """ Deduplicate the symmetry-expanded images of a vector, e.g. the 60 rotations of a 5f vertex """
+    """ Points within tolerance on every axis are the same point. The first occurrence is kept. """
+    """ Returns unique_indices, and for every vector the position of its point in unique_indices """
+    vectors = np.asarray( vectors, dtype=np.float64 ).reshape( -1, 3 )
+    tree = cKDTree( vectors )
+
+    ### Lowest index within tolerance, which is the vector itself when nothing earlier matches
+    first = np.array( [ min( neighbors ) for neighbors in tree.query_ball_point( vectors, r=tolerance, p=np.inf ) ] )
+
+    ### Follow chains so every vector points at the first member of its point
+    root = first[first]
+    while not np.array_equal( root, first ):
+        first = root
+        root = first[first]
+
+    unique_indices = np.where( first == np.arange( len( vectors ) ) )[0]
+    membership = np.searchsorted( unique_indices, first )
+
+    return unique_indices, membership
+
+
+def getSymmetryGroup( sym='I1' ):
+    """ Cached SymmetryGroup for I1 or I2 """
+    if sym not in _symmetry_groups:
+        _symmetry_groups[sym] = SymmetryGroup( sym )
+
+    return _symmetry_groups[sym]
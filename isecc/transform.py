@@ -6,10 +6,15 @@ import os
 import time
 import math
 import numpy as np
+from scipy import ndimage
 from pyquaternion import Quaternion
 from . import symops
 
 
+### Output planes resampled per call to map_coordinates by rotateVolume
+ROTATE_SLAB = 16
+
+
 def myEuler2Quat( phi, theta, psi ) :           # doi.org/10.1101/733881
         # Rot, Tilt, Psi
         # Phi, Theta, Psi
@@ -85,3 +90,173 @@ def rot2euler(r):                      # function modified from pyem, Daniel Asa
 
         return alpha, beta, gamma
 
+
+
+####
+## Array versions of the above. Quaternions are (N,4) arrays in [ a, bi, cj, dk ] order,
+## matching pyquaternion and symops.getSymOps(). Single quaternions broadcast against stacks.
+####
+
+def quatMatrix( q ):
+        """ (N,4,4) left-multiplication matrices, as Quaternion._q_matrix """
+        q = np.asarray( q, dtype=np.float64 )
+        a, b, c, d = q[...,0], q[...,1], q[...,2], q[...,3]
+        return np.stack( [ np.stack( [ a, -b, -c, -d ], axis=-1 ),
+                           np.stack( [ b,  a, -d,  c ], axis=-1 ),
+                           np.stack( [ c,  d,  a, -b ], axis=-1 ),
+                           np.stack( [ d, -c,  b,  a ], axis=-1 ) ], axis=-2 )
+
+
+def quatBarMatrix( q ):
+        """ (N,4,4) right-multiplication matrices, as Quaternion._q_bar_matrix """
+        q = np.asarray( q, dtype=np.float64 )
+        a, b, c, d = q[...,0], q[...,1], q[...,2], q[...,3]
+        return np.stack( [ np.stack( [ a, -b, -c, -d ], axis=-1 ),
+                           np.stack( [ b,  a,  d, -c ], axis=-1 ),
+                           np.stack( [ c, -d,  a,  b ], axis=-1 ),
+                           np.stack( [ d,  c, -b,  a ], axis=-1 ) ], axis=-2 )
+
+
+def quatSumOfSquares( q ):
+        """ q . q, kept as (N,1) for broadcasting """
+        q = np.asarray( q, dtype=np.float64 )
+        return np.matmul( q[...,np.newaxis,:], q[...,:,np.newaxis] )[...,0]
+
+
+def quatMultiply( q1, q2 ):
+        """ Hamilton product q1 * q2. Same matrix product as pyquaternion, so results agree exactly """
+        q2 = np.asarray( q2, dtype=np.float64 )
+        return np.matmul( quatMatrix( q1 ), q2[...,np.newaxis] )[...,0]
+
+
+def quatConjugate( q ):
+        q = np.asarray( q, dtype=np.float64 )
+        return q * np.array( [ 1., -1., -1., -1. ] )
+
+
+def quatInverse( q ):
+        """ Conjugate over the sum of squares, as Quaternion.inverse """
+        return quatConjugate( q ) / quatSumOfSquares( q )
+
+
+def quatNormalise( q ):
+        """ Unit quaternions. Leaves alone those already unit to 1e-14, as pyquaternion does """
+        q = np.asarray( q, dtype=np.float64 )
+        sum_of_squares = quatSumOfSquares( q )
+        is_unit = np.abs( 1.0 - sum_of_squares ) < 1e-14
+        return np.where( is_unit, q, q / np.sqrt( sum_of_squares ) )
+
+
+def quatRotate( q, vectors ):
+        """ Rotate (N,3) vectors by (N,4) quaternions, i.e. q * v * q.conjugate """
+        q = quatNormalise( q )
+        vectors = np.asarray( vectors, dtype=np.float64 )
+        zeros = np.zeros( np.broadcast( q[...,0], vectors[...,0] ).shape + (1,) )
+        pure = np.concatenate( ( zeros, vectors + zeros ), axis=-1 )
+
+        rotated = quatMultiply( quatMultiply( q, pure ), quatConjugate( q ) )
+        return rotated[...,1:]
+
+
+def quat2RotationMatrix( q ):
+        """ (N,3,3) rotation matrices for (N,4) quaternions, as Quaternion.rotation_matrix """
+        q = quatNormalise( q )
+        product_matrix = np.matmul( quatMatrix( q ), np.swapaxes( quatBarMatrix( q ), -1, -2 ) )
+        return product_matrix[...,1:,1:]
+
+
+def quatDistance( q0, q1 ):
+        """ Geodesic distance between (N,4) quaternions, as Quaternion.distance, i.e. the norm of log( q0.inverse * q1 ) """
+        q = quatMultiply( quatInverse( q0 ), q1 )
+        q_norm = np.sqrt( quatSumOfSquares( q )[...,0] )
+        v_norm = np.linalg.norm( q[...,1:], axis=-1 )
+
+        ### No imaginary part means no rotation. Clip rounding past +-1 before acos.
+        angle = np.arccos( np.clip( q[...,0] / q_norm, -1.0, 1.0 ) )
+        angle = np.where( v_norm < 1e-17, 0.0, angle )
+
+        return np.sqrt( np.square( np.log( q_norm ) ) + np.square( angle ) )
+
+
+def myEuler2QuatArray( phi, theta, psi ):
+        """ Array version of myEuler2Quat. Rot, Tilt, Psi in radians, (N,) each. Returns (N,4) """
+        zeros = np.zeros( np.broadcast( phi, theta, psi ).shape )
+        half_phi   = np.true_divide( phi,   2 ) + zeros
+        half_theta = np.true_divide( theta, 2 ) + zeros
+        half_psi   = np.true_divide( psi,   2 ) + zeros
+
+        q_phi   = np.stack( [ np.cos( half_phi ),   zeros, zeros, np.sin( half_phi ) ],   axis=-1 )
+        q_theta = np.stack( [ np.cos( half_theta ), zeros, np.sin( half_theta ), zeros ], axis=-1 )
+        q_psi   = np.stack( [ np.cos( half_psi ),   zeros, zeros, np.sin( half_psi ) ],   axis=-1 )
+
+        ## Note, operation is expressed as Rotation 2 * Rotation 1
+        return quatMultiply( quatMultiply( q_phi, q_theta ), q_psi )
+
+
+def rot2eulerArray( r ):
+        """ Array version of rot2euler for (N,3,3) matrices. Returns rot, tilt, psi in degrees """
+        # Same Shoemake decomposition and Relion conventions, including the gimbal-lock branches
+        r = np.asarray( r, dtype=np.float64 )
+        epsilon = np.finfo(np.double).eps
+
+        ### Scalar ** 2 goes through pow(), which is not always x*x. Keep it so results match rot2euler.
+        two = np.full( r.shape[:-2], 2.0 )
+        abs_sb = np.sqrt( np.float_power( r[...,0,2], two ) + np.float_power( r[...,1,2], two ) )
+        general = abs_sb > 16 * epsilon
+
+        ### General case
+        gamma = np.arctan2( r[...,1,2], -r[...,0,2] )
+        alpha = np.arctan2( r[...,2,1], r[...,2,0] )
+        sin_gamma = np.sin( gamma )
+        with np.errstate( divide='ignore', invalid='ignore' ):
+                sign_sb = np.where( np.abs( sin_gamma ) < epsilon,
+                                    np.sign( -r[...,0,2] ) / np.cos( gamma ),
+                                    np.where( sin_gamma > 0, np.sign( r[...,1,2] ), -np.sign( r[...,1,2] ) ) )
+        beta = np.arctan2( sign_sb * abs_sb, r[...,2,2] )
+
+        ### Tilt of 0 or 180, where rot and psi are degenerate
+        positive = np.sign( r[...,2,2] ) > 0
+        gamma_locked = np.where( positive, np.arctan2( -r[...,1,0], r[...,0,0] ), np.arctan2( r[...,1,0], -r[...,0,0] ) )
+        beta_locked = np.where( positive, 0., np.pi )
+
+        alpha = np.where( general, alpha, 0. )
+        beta  = np.where( general, beta,  beta_locked )
+        gamma = np.where( general, gamma, gamma_locked )
+
+        ## Convert to degrees before returning values
+        return np.degrees( alpha ), np.degrees( beta ), np.degrees( gamma )
+
+
+def quat2EulerArray( q ):
+        """ Relion Eulers in degrees for (N,4) quaternions """
+        return rot2eulerArray( quat2RotationMatrix( q ) )
+
+
+def rotateVolume( volume, quat, residual=( 0, 0, 0 ), slab=ROTATE_SLAB ):
+        """ Rotate a cubic ZYX volume by quat [ a, bi, cj, dk ] with trilinear interpolation """
+        """ Same result as rotate3d in ISECC_recombine: sampled at the rotated grid, shifted by residual """
+        """ (in the order rotate3d takes it), zero outside the box. Output is float64 in ZYX order. """
+        """ Coordinates are made slab planes at a time, so memory does not grow with box**3 """
+
+        box_size = volume.shape[0]
+
+        ### Inverse rotation takes output voxels back to the input
+        matrix = np.swapaxes( quat2RotationMatrix( quat ), -1, -2 )
+
+        ### Grid coordinates, x and residual[0] along the last axis
+        centered = [ np.arange( box_size ) - np.true_divide( box_size, 2 ) - residual[axis] for axis in range(3) ]
+        gx = centered[0][np.newaxis,np.newaxis,:]
+        gy = centered[1][np.newaxis,:,np.newaxis]
+
+        rotated = np.zeros( volume.shape, dtype=np.float64 )
+        for start in range( 0, box_size, slab ):
+                gz = centered[2][start:start+slab][:,np.newaxis,np.newaxis]
+
+                ### Input index for each output voxel, in ZYX order
+                coords = [ ( matrix[row,0] * gx ) + ( matrix[row,1] * gy ) + ( matrix[row,2] * gz ) + np.true_divide( box_size, 2 ) + residual[row]
+                           for row in ( 2, 1, 0 ) ]
+                coords = np.stack( np.broadcast_arrays( *coords ) )
+
+                ndimage.map_coordinates( volume, coords, output=rotated[start:start+slab], order=1, mode='constant', cval=0.0, prefilter=False )
+
+        return rotated
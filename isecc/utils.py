@@ -45,37 +45,38 @@ def defocusAdjust( defocusU, defocusV, deltaDefocus ) :
 def reverseDefocus( input, output, FlippedDefocusU, FlippedDefocusV, FlippedXYZ_string ) :
 
 	filename = input
-	header, fullheader = starparse.getStarHeader( filename, 'null' )
+	header, fullheader, reverse_defocus_ndarray, optics = starparse.getStarFile( filename, 'null' )
 	fullheader = fullheader[3:]
 
-	a = starparse.getStarData( filename, len( header ) )
-
-	reverse_defocus_ndarray = np.asarray( a, order='C' )
-
 	### Get the necessary indices
 	UID_index = starparse.getUID( header )
 	defocusU_index, defocusV_index, defocusAngle_index = starparse.getDefocus( header )
 	OriginXYZAngstWrtParticleCenter_index = starparse.getOriginXYZAngstWrtParticleCenter( header )
 
-	for x in range(0,len(reverse_defocus_ndarray)):
-
-		### Find the UID of the current subparticle
-		my_UID = reverse_defocus_ndarray[x][ UID_index ]
-
-		### Set the defocus equal to the flipped value from dictionary
-		reverse_defocus_ndarray[x][ defocusU_index ] = FlippedDefocusU[ my_UID ]
-		reverse_defocus_ndarray[x][ defocusV_index ] = FlippedDefocusV[ my_UID ]
-		reverse_defocus_ndarray[x][ OriginXYZAngstWrtParticleCenter_index ] = FlippedXYZ_string[ my_UID ]
+	### Flipped values as arrays, sorted by UID number
+	flipped_UIDs = list( FlippedDefocusU.keys() )
+	flipped_numbers = starparse.decodeUIDs( flipped_UIDs )
+	order = np.argsort( flipped_numbers )
+	flipped_numbers = flipped_numbers[order]
+	flipped_U = np.array( [ FlippedDefocusU[ my_UID ] for my_UID in flipped_UIDs ] )[order]
+	flipped_V = np.array( [ FlippedDefocusV[ my_UID ] for my_UID in flipped_UIDs ] )[order]
+	flipped_XYZ = np.array( [ FlippedXYZ_string[ my_UID ] for my_UID in flipped_UIDs ] )[order]
+
+	### Find the flipped values for every subparticle at once
+	my_numbers = starparse.decodeUIDs( reverse_defocus_ndarray[:,UID_index] )
+	position = np.clip( np.searchsorted( flipped_numbers, my_numbers ), 0, max( len(flipped_numbers) - 1, 0 ) )
+	if ( len(flipped_numbers) == 0 ) or np.any( flipped_numbers[position] != my_numbers ):
+		print( "Error: no flipped defocus for some subparticle UIDs in", filename, ". Exiting now." )
+		sys.exit()
+
+	### Set the defocus equal to the flipped value
+	reverse_defocus_ndarray[:,defocusU_index] = flipped_U[position]
+	reverse_defocus_ndarray[:,defocusV_index] = flipped_V[position]
+	reverse_defocus_ndarray[:,OriginXYZAngstWrtParticleCenter_index] = flipped_XYZ[position]
 
 	my_output = output
 
-	f = open( my_output, 'w' )
-	np.savetxt( f, fullheader, delimiter=' ', fmt="%s" )
-	f.close()
-
-	f = open( my_output, 'a' )
-	np.savetxt( f, reverse_defocus_ndarray, delimiter=' ', fmt="%s" )
-	f.close()
+	starparse.writeStarFile( my_output, fullheader, reverse_defocus_ndarray )
 
 	return
 
@@ -1,3 +1,4 @@
+import itertools
 import matplotlib.pyplot as plt
 import numpy as np
 from matplotlib import colors
@@ -5,22 +6,47 @@ from matplotlib.ticker import PercentFormatter
 from matplotlib.offsetbox import AnchoredText
 from scipy.stats import norm
 
-my_data = np.loadtxt('temp.txt')
-N_points = len(my_data)
-N_unique = np.unique(my_data).shape
+from isecc.isecc_classes import RunningStatistics
 
-# For gaussian curve
-mu, std = norm.fit(my_data)
-percentile_5 = np.percentile(my_data, 5)
-percentile_95 = np.percentile(my_data, 95)
+### Values in temp.txt are read this many lines at a time, so the file is never held whole
+HISTOGRAM_CHUNK = 1000000
+
+def readChunks(filename, chunk_size=HISTOGRAM_CHUNK):
+    """ Values of a whitespace-separated text file as float arrays, chunk_size lines at a time """
+    with open(filename, 'r') as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                break
+            yield np.array(' '.join(lines).split(), dtype=np.float64)
 
 n_bins = 75
-print(my_data, N_points, N_unique[0])
-print(np.percentile(my_data, 5), np.percentile(my_data, 95))
-print(np.mean(my_data))
+
+# First pass for the range, so the bins are those plt.hist would choose for the whole file
+data_min, data_max = np.inf, -np.inf
+for chunk in readChunks('temp.txt'):
+    if len(chunk):
+        data_min = min(data_min, chunk.min())
+        data_max = max(data_max, chunk.max())
+if data_min == data_max:
+    data_min, data_max = data_min - 0.5, data_max + 0.5
+
+# Second pass for running mean, stdev, percentiles and histogram
+statistics = RunningStatistics(n_bins, (data_min, data_max))
+for chunk in readChunks('temp.txt'):
+    statistics.update(chunk)
+N_points = statistics.count
+
+# For gaussian curve. norm.fit gives the mean and the population stdev.
+mu, std = statistics.mean, statistics.stdev()
+percentile_5, percentile_95 = statistics.percentile([5, 95])
+
+print(N_points)
+print(percentile_5, percentile_95)
+print(mu)
 
 # Pliot the histogram
-plt.hist(my_data, bins=n_bins, density=True, alpha=0.6)
+plt.hist(statistics.bin_edges[:-1], bins=statistics.bin_edges, weights=statistics.histogram, density=True, alpha=0.6)
 
 # Plot it
 xmin, xmax = plt.xlim()
@@ -35,7 +61,7 @@ plt.title('HPV2020 Diameter')
 plt.xlabel('O/E')
 plt.ylabel('Count')
 
-annotation = " mean: %.3f\n std: %.3f\n bins: %.0f\n datapoints: %.0f\n\n  5th percentile: %.3f\n 95th percentile: %.3f" % (np.mean(my_data), np.std(my_data), n_bins, N_points, percentile_5, percentile_95)
+annotation = " mean: %.3f\n std: %.3f\n bins: %.0f\n datapoints: %.0f\n\n  5th percentile: %.3f\n 95th percentile: %.3f" % (mu, std, n_bins, N_points, percentile_5, percentile_95)
 
 plt.annotate(annotation, xy=(0.65,0.65), xycoords='axes fraction')
 